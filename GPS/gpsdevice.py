@@ -1,62 +1,81 @@
 import os
 import sys
 import subprocess
-import gps
 import threading
 import time
 import pickle
 import json
+import socket
 import serial
 import logging
+import hal
+import utils
+import metrics
+from GPS import ubx
+from telemetry import gps_fix
 
 
 class GPSPoller(threading.Thread):
 
-    def __init__(self, save_dir_time, gps_fix_indicator, configure_gps=True):
+    # Serializations of the records in gps.dat
+    FORMATS = ("pickle", "jsonl")
+
+    def __init__(self, save_dir_time, gps_fix_indicator, configure_gps=True, save_location="/sensor_data",
+                 context=None, rate_ms=100, baudrate=115200, record_format="pickle", prune_nmea=True,
+                 save_config=False):
         threading.Thread.__init__(self)
 
         # Setup logging
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        if record_format not in self.FORMATS:
+            raise ValueError(f"Unknown GPS record format {record_format}, expected one of {', '.join(self.FORMATS)}")
+        self.rate_ms = rate_ms
+        self.baudrate = baudrate
+        self.record_format = record_format
+
         # Configure GPS only if required
         if configure_gps:
             # Configure the GPS unit
-            self.logger.info("Configuring GPS for BAUD of 115200 and rate of 10Hz")
+            self.logger.info(f"Configuring GPS for BAUD of {baudrate} and rate of {1000 / rate_ms:g}Hz")
             gpsc = GPSCommandSender(baudrate=9600)
-            # Update GPS DAQ params
-            gpsc.send_command("rate-10")
-            time.sleep(1)
-            gpsc.send_command("baud-115200")
+            # Update GPS DAQ params, only what differs from the receiver state
+            gpsc.configure(rate_ms=rate_ms, baudrate=baudrate, save=save_config,
+                           messages=GPSCommandSender.daq_messages(rate_ms) if prune_nmea else None)
+            gpsc.close()
 
-        self.gpsd = gps.gps(mode=gps.WATCH_ENABLE)
+        self.gpsd = hal.gps_client()
         self.gps_fix_indicator = gps_fix_indicator
+        # Shared state of the DAQ, the last position is published for the IMU pipeline
+        self.context = context
         self.running = False
+        self.recording = False
 
         # Time Management
         self.start_time = None
         self.stop_time = None
         self.save_dir_time = save_dir_time
+        self.save_location = save_location
 
         # Metadata
         self.current_save_dir = None
         self.metadata = {}
 
+        # Metrics
+        self.records_total = metrics.REGISTRY.counter("gps_records_total", "Records received from gpsd")
+        self.fix_mode = metrics.REGISTRY.gauge("gps_fix_mode", "GPS fix mode, 0 unknown to 3 for 3D fix")
+        self.satellites_used = metrics.REGISTRY.gauge("gps_satellites_used", "Satellites used in the solution")
+
     def run(self):
         """
-        Start the thread responsible for GPS DAQ
+        Start the thread responsible for GPS DAQ. While armed the records only update the fix state, once the
+        recording starts they are stored
 
         :return: None
         """
 
-        self.start_time = time.monotonic()
-
-        # Make directories
-        self.current_save_dir = "/sensor_data" + "/" + self.save_dir_time
-        if not os.path.exists(self.current_save_dir):
-            os.makedirs(self.current_save_dir)
-
-        self.logger.info("Starting GPS DAQ")
-        with open(self.current_save_dir + "/" + "gps.dat", "wb") as fh:
+        fh = None
+        try:
             while self.running:
                 gps_info = self.gpsd.next()
 
@@ -64,16 +83,35 @@ class GPSPoller(threading.Thread):
                 try:
                     if gps_info["class"] == "TPV":
                         self.gps_fix_indicator[0] = gps_info.mode
+                        self.fix_mode.set(gps_info.mode)
+                        if self.context is not None and gps_info.mode >= 2:
+                            self.context["gps_position"] = (gps_info.lat, gps_info.lon)
+                            self.context["gps_fix"] = gps_fix(gps_info)
+                    elif gps_info["class"] == "SKY":
+                        self.satellites_used.set(sum(1 for sat in gps_info.get("satellites", []) if sat.get("used")))
                 except Exception:
                     pass
-
-                # Serialize and store data
-                pickle.dump(gps_info, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                self.records_total.inc()
+
+                if self.recording:
+                    if fh is None:
+                        self.logger.info("Starting GPS DAQ")
+                        fh = open(self.current_save_dir + "/" + "gps.dat", "wb")
+
+                    # Serialize and store data
+                    if self.record_format == "jsonl":
+                        # The gps client wraps the nested reports in objects that keep the fields in __dict__
+                        fh.write(json.dumps(gps_info, default=vars).encode() + b"\n")
+                    else:
+                        pickle.dump(gps_info, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            if fh is not None:
+                fh.close()
         self.logger.info("Stopping GPS DAQ")
 
-    def start_polling(self):
+    def arm(self):
         """
-        Start the DAQ process for GPS
+        Start following gpsd so that the DAQ can start without delay
 
         :return: None
         """
@@ -82,9 +120,32 @@ class GPSPoller(threading.Thread):
             self.running = True
             self.start()
 
+    def start_polling(self, save_dir_time=None, request_time=None):
+        """
+        Start the DAQ process for GPS. Arms the poller first if required
+
+        :param save_dir_time: Name of the trial directory
+        :param request_time: Monotonic time of the start request, not used as the GPS records are not timed to it
+        :return: None
+        """
+
+        if save_dir_time is not None:
+            self.save_dir_time = save_dir_time
+        if self.recording:
+            return
+
+        # Make directories
+        self.current_save_dir = os.path.join(self.save_location, self.save_dir_time)
+        if not os.path.exists(self.current_save_dir):
+            os.makedirs(self.current_save_dir)
+
+        self.start_time = time.monotonic()
+        self.recording = True
+        self.arm()
+
     def stop_polling(self):
         """
-        Stop the DAQ process for GPS
+        Stop the DAQ process for GPS, or disarm the poller
 
         :return: None
         """
@@ -92,14 +153,16 @@ class GPSPoller(threading.Thread):
         if self.running:
             self.running = False
             self.stop_time = time.monotonic()
-            self.metadata["elapsed_time"] = self.stop_time - self.start_time
 
             self.join()
 
             # Write the metadata
-            with open(self.current_save_dir + "/" + "gps.meta", "w") as fh:
-                json_string = json.dumps(self.metadata)
-                fh.write(json_string + "\n")
+            if self.recording:
+                self.metadata["elapsed_time"] = self.stop_time - self.start_time
+                self.metadata["rate_ms"] = self.rate_ms
+                self.metadata["baudrate"] = self.baudrate
+                self.metadata["format"] = self.record_format
+                utils.write_metadata(self.current_save_dir, "gps", self.metadata)
 
     def stop(self):
         """
@@ -115,48 +178,297 @@ class GPSCommandSender:
     """
     Responsible for sending commands over serial to the GPS module of BerryGPS-IMU v4 module
     """
-    def __init__(self, port="/dev/serial0", baudrate=9600):
+
+    # Last verified receiver state, kept across boots
+    STATE_FILE = "/var/drivesense/gps_state.json"
+
+    def __init__(self, port="/dev/serial0", baudrate=9600, state_file=STATE_FILE, manage_gpsd=True):
         self.port = port
         self.baudrate = baudrate
-        self.ser = serial.Serial(port, baudrate, timeout=5)
+        self.state_file = state_file
+        # gpsd is stopped while the receiver is configured, not when the receiver is simulated
+        self.manage_gpsd = manage_gpsd
+        # The port is opened on first use, opening it reconfigures the tty under gpsd
+        self.ser = serial.Serial(baudrate=baudrate, timeout=5)
+        self.ser.port = port
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def load_state(self):
+        """
+        Load the last verified receiver state
+
+        :return: A dict with the baud rate and measurement rate, None if unknown
+        """
+
+        try:
+            with open(self.state_file, "r") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self, state):
+        """
+        Persist the verified receiver state
+
+        :param state: A dict with the baud rate and measurement rate
+        :return: None
+        """
+
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            with open(self.state_file, "w") as fh:
+                json.dump(state, fh)
+        except OSError as e:
+            self.logger.warning(f"Could not save GPS state: {e}")
+
+    def gpsd_baudrate(self, host="127.0.0.1", port=2947, timeout=1.5):
+        """
+        Ask gpsd for the speed it reads the receiver at
+
+        :param host: gpsd host
+        :param port: gpsd port
+        :param timeout: Time to wait in seconds
+        :return: The baud rate, None if gpsd did not report it
+        """
+
+        deadline = time.monotonic() + timeout
+        try:
+            with socket.create_connection((host, port), timeout=timeout) as sock:
+                sock.sendall(b"?DEVICES;\n")
+                buffer = b""
+                while time.monotonic() < deadline:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    buffer += chunk
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        try:
+                            report = json.loads(line)
+                        except ValueError:
+                            continue
+                        if report.get("class") == "DEVICES":
+                            for device in report.get("devices", []):
+                                if device.get("bps"):
+                                    return device["bps"]
+                            return None
+        except OSError:
+            pass
+        return None
+
+    def probe(self, baudrates, timeout=1.0):
+        """
+        Find the baud rate the receiver talks at and poll its configuration with CFG-RATE and CFG-PRT
+
+        :param baudrates: Candidate baud rates, in the order to try
+        :param timeout: Time to wait for each response in seconds
+        :return: A dict with the receiver state, None if the receiver did not answer
+        """
+
+        for baudrate in baudrates:
+            self.ser.baudrate = baudrate
+            self.ser.reset_input_buffer()
+            reader = ubx.UBXReader(self.ser)
+
+            self.ser.write(ubx.poll_rate())
+            rate = reader.wait_for(ubx.CLS_CFG, ubx.CFG_RATE, timeout=timeout)
+            if rate is None:
+                continue
+            state = {"baudrate": baudrate, "rate_ms": ubx.parse_rate(rate)["meas_rate_ms"]}
+
+            self.ser.write(ubx.poll_prt())
+            prt = reader.wait_for(ubx.CLS_CFG, ubx.CFG_PRT, timeout=timeout)
+            if prt is not None:
+                port = ubx.parse_prt(prt)
+                state["in_proto"] = port["in_proto"]
+                state["out_proto"] = port["out_proto"]
+
+            self.logger.info(f"GPS receiver state: {state}")
+            return state
+        return None
+
+    def send_and_confirm(self, command, msg_id, timeout=1.0):
+        """
+        Send a configuration message and wait for the ACK-ACK
+
+        :param command: The UBX frame
+        :param msg_id: The CFG message id, to match the acknowledgement
+        :param timeout: Time to wait in seconds
+        :return: True, if acknowledged
+        """
+
+        reader = ubx.UBXReader(self.ser)
+        self.ser.write(command)
+        ack = reader.wait_for_ack(ubx.CLS_CFG, msg_id, timeout=timeout)
+        if not ack:
+            self.logger.error(f"GPS configuration {'rejected' if ack is False else 'not acknowledged'}: {command.hex()}")
+        return bool(ack)
+
+    @staticmethod
+    def daq_messages(rate_ms):
+        """
+        Output of the receiver during the DAQ, the sentences gpsd needs for the fix at every solution and the satellites
+        once a second. The sentences gpsd does not use are disabled, so that high rates fit the UART
+
+        :param rate_ms: Time between measurements in milliseconds
+        :return: A dict of the message name to the output rate in solutions, 0 to disable
+        """
+
+        return {"GGA": 1, "RMC": 1, "GSA": 1, "GSV": max(1, round(1000 / rate_ms)), "GLL": 0, "VTG": 0}
+
+    def configure_messages(self, reader, messages, timeout=1.0):
+        """
+        Set the output rates of messages on UART1, keeping the rates of the other ports. Only the rates that differ
+        are sent, a message whose rates are not known because the poll was not answered is set with the short form
+        of CFG-MSG, for the port of the serial connection only
+
+        :param reader: UBX reader of the serial port
+        :param messages: A dict of the message name to the output rate
+        :param timeout: Time to wait for each response in seconds
+        :return: True, if all the rates are acknowledged
+        """
+
+        confirmed = True
+        for name, rate in messages.items():
+            self.ser.write(ubx.poll_msg(name))
+            current = reader.wait_for(ubx.CLS_CFG, ubx.CFG_MSG, timeout=timeout)
+            rates = ubx.parse_msg(current)["rates"] if current is not None else None
+            if rates is not None and rates[ubx.PORT_UART1] == rate:
+                continue
+            confirmed &= self.send_and_confirm(ubx.cfg_msg(name, rate, rates=rates), ubx.CFG_MSG, timeout=timeout)
+        return confirmed
+
+    def configure(self, rate_ms=100, baudrate=115200, messages=None, save=False):
+        """
+        Bring the receiver to a measurement rate, baud rate and message output. Commands are only sent when the
+        receiver state differs, and gpsd is only stopped when the state has to be probed
+
+        :param rate_ms: Time between measurements in milliseconds, down to ubx.MIN_MEAS_RATE_MS
+        :param baudrate: The baud rate of the receiver UART
+        :param messages: A dict of the message name to the output rate on UART1, e.g. daq_messages(rate_ms). The
+            output is left alone if None
+        :param save: Save the configuration to the flash of the receiver, so that it survives a power cycle
+        :return: True, if the receiver is verified to be in the requested state
+        """
+
+        if not ubx.MIN_MEAS_RATE_MS <= rate_ms:
+            raise ValueError(f"Measurement rate {rate_ms} ms is faster than the receiver allows")
+        target = {"baudrate": baudrate, "rate_ms": rate_ms}
+        if messages is not None:
+            target["messages"] = dict(messages)
+        if save:
+            target["saved"] = True
+        cached = self.load_state()
+
+        # The receiver keeps the rate and baud rate together. If gpsd still reads it at the configured baud rate, the
+        # configuration from the last boot survived
+        if cached is not None and {k: cached.get(k) for k in target} == target \
+                and (not self.manage_gpsd or self.gpsd_baudrate() == baudrate):
+            self.logger.info("GPS already configured, skipping reconfiguration")
+            return True
+
+        if self.manage_gpsd:
+            self.stop_gpsd()
+        try:
+            if not self.ser.is_open:
+                self.ser.open()
+
+            # Most likely baud rates first
+            candidates = [cached.get("baudrate") if cached else None, baudrate, self.baudrate, 9600, 115200]
+            state = self.probe([x for i, x in enumerate(candidates) if x and x not in candidates[:i]])
+            if state is None:
+                self.logger.error("GPS receiver did not answer the UBX polls, sending the configuration blind")
+                self.ser.baudrate = self.baudrate
+                for name, rate in (messages or {}).items():
+                    self.ser.write(ubx.cfg_msg(name, rate))
+                self.ser.write(ubx.cfg_rate(rate_ms))
+                self.ser.write(ubx.cfg_prt_uart(baudrate))
+                self.ser.flush()
+                return False
+
+            # The unused sentences go first, the output then fits the UART at the higher rate
+            messages_confirmed = True
+            if messages is not None:
+                messages_confirmed = self.configure_messages(ubx.UBXReader(self.ser), messages)
+
+            if state["baudrate"] != baudrate:
+                # The acknowledgement is not reliable across the baud rate switch, verify by probing instead
+                out_proto = state.get("out_proto", ubx.PROTO_UBX | ubx.PROTO_NMEA)
+                self.ser.write(ubx.cfg_prt_uart(baudrate, out_proto=out_proto))
+                self.ser.flush()
+                time.sleep(0.1)
+                state = self.probe([baudrate]) or state
+
+            if state["rate_ms"] != rate_ms and state["baudrate"] == baudrate:
+                self.send_and_confirm(ubx.cfg_rate(rate_ms), ubx.CFG_RATE)
+                state = self.probe([baudrate])
+
+            verified = state is not None and state["rate_ms"] == rate_ms and state["baudrate"] == baudrate \
+                and messages_confirmed
+            if verified and save:
+                verified = self.send_and_confirm(ubx.cfg_cfg(save=ubx.CFG_SECTIONS_ALL), ubx.CFG_CFG)
+            if verified:
+                self.save_state(dict(state, **target))
+            else:
+                self.logger.error(f"GPS configuration could not be verified: {state}")
+            return verified
+        finally:
+            if self.manage_gpsd:
+                self.start_gpsd()
+
+    @staticmethod
+    def command_frame(ctype):
+        """
+        The UBX frame of a command
+
+        :param ctype: A string indicating the type of command: reset, rate-<Hz>, baud-<baud rate>, save, sleep or wake
+        :return: The frame bytes
+        """
+
+        # Determine based on command type
+        try:
+            if ctype == "reset":
+                return ubx.cfg_rst()
+            elif ctype.startswith("rate-"):
+                return ubx.cfg_rate(round(1000 / float(ctype[len("rate-"):])))
+            elif ctype.startswith("baud-"):
+                return ubx.cfg_prt_uart(int(ctype[len("baud-"):]))
+            elif ctype == "save":
+                return ubx.cfg_cfg(save=ubx.CFG_SECTIONS_ALL)
+            elif ctype == "sleep":
+                return ubx.cfg_pwr(ubx.PWR_STOP)
+            elif ctype == "wake":
+                return ubx.cfg_pwr(ubx.PWR_RUN)
+        except ZeroDivisionError:
+            pass
+        raise ValueError(f"{ctype} is not a command")
 
     def send_command(self, ctype: str):
         """
         Send a command to the GPS module
 
-        :param ctype: A string indicating the type pf command
+        :param ctype: A string indicating the type of command: reset, rate-<Hz>, baud-<baud rate>, save, sleep or wake
         :return:
         """
 
-        # Determine based on command type
-        if ctype == "reset":
-            command = b"\xb5\x62\x06\x04\x04\x00\xff\xff\x02\x00\x0e\x61"
-        elif ctype == "rate-2":
-            command = b"\xB5\x62\x06\x08\x06\x00\xF4\x01\x01\x00\x01\x00\x0B\x77"
-        elif ctype == "rate-5":
-            command = b"\xB5\x62\x06\x08\x06\x00\xC8\x00\x01\x00\x01\x00\xDE\x6A"
-        elif ctype == "rate-10":
-            command = b"\xB5\x62\x06\x08\x06\x00\x64\x00\x01\x00\x01\x00\x7A\x12"
-        elif ctype == "baud-115200":
-            command = b"\xB5\x62\x06\x00\x14\x00\x01\x00\x00\x00\xD0\x08\x00\x00\x00\xC2\x01\x00\x07\x00\x03\x00\x00\x00\x00\x00\xC0\x7E"
-        elif ctype == "baud-9600":
-            command = b"\xB5\x62\x06\x00\x14\x00\x01\x00\x00\x00\xD0\x08\x00\x00\x80\x25\x00\x00\x07\x00\x03\x00\x00\x00\x00\x00\xA2\xB5"
-        elif ctype == "sleep":
-            command = b"\xB5\x62\x06\x57\x08\x00\x01\x00\x00\x00\x50\x4F\x54\x53\xAC\x85"
-        elif ctype == "wake":
-            command = b"\xB5\x62\x06\x57\x08\x00\x01\x00\x00\x00\x20\x4E\x55\x52\x7B\xC3"
-        else:
+        try:
+            command = self.command_frame(ctype)
+        except ValueError:
             sys.stdout.write(ctype + " is not supported for sending commands\n")
             return
 
         try:
-            self.stop_gpsd()
+            if self.manage_gpsd:
+                self.stop_gpsd()
 
             if not self.ser.is_open:
                 self.ser.open()
             self.ser.write(command)
         finally:
-            self.start_gpsd()
+            if self.manage_gpsd:
+                self.start_gpsd()
 
     def stop_gpsd(self):
         """
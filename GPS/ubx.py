@@ -0,0 +1,357 @@
+import time
+import struct
+
+
+# Frame
+SYNC = b"\xb5\x62"
+
+# Classes
+CLS_NAV = 0x01
+CLS_ACK = 0x05
+CLS_CFG = 0x06
+CLS_NMEA = 0xF0
+
+# Message ids
+ACK_NAK = 0x00
+ACK_ACK = 0x01
+CFG_PRT = 0x00
+CFG_MSG = 0x01
+CFG_RST = 0x04
+CFG_RATE = 0x08
+CFG_CFG = 0x09
+CFG_PWR = 0x57
+
+# Output messages by name, the NMEA sentences and the UBX navigation messages gpsd understands
+MESSAGES = {
+    "GGA": (CLS_NMEA, 0x00), "GLL": (CLS_NMEA, 0x01), "GSA": (CLS_NMEA, 0x02), "GSV": (CLS_NMEA, 0x03),
+    "RMC": (CLS_NMEA, 0x04), "VTG": (CLS_NMEA, 0x05), "GRS": (CLS_NMEA, 0x06), "GST": (CLS_NMEA, 0x07),
+    "ZDA": (CLS_NMEA, 0x08), "GBS": (CLS_NMEA, 0x09), "DTM": (CLS_NMEA, 0x0A), "GNS": (CLS_NMEA, 0x0D),
+    "NAV-POSLLH": (CLS_NAV, 0x02), "NAV-STATUS": (CLS_NAV, 0x03), "NAV-DOP": (CLS_NAV, 0x04),
+    "NAV-PVT": (CLS_NAV, 0x07), "NAV-VELNED": (CLS_NAV, 0x12), "NAV-TIMEGPS": (CLS_NAV, 0x20),
+    "NAV-SAT": (CLS_NAV, 0x35),
+}
+
+# Port ids, the order of the rates in CFG-MSG
+PORT_I2C = 0x00
+PORT_UART1 = 0x01
+PORT_UART2 = 0x02
+PORT_USB = 0x03
+PORT_SPI = 0x04
+PORTS = 6
+
+# Protocol masks
+PROTO_UBX = 0x01
+PROTO_NMEA = 0x02
+PROTO_RTCM = 0x04
+
+
+def checksum(data):
+    """
+    8-bit Fletcher checksum over the class, id, length and payload
+
+    :param data: Bytes to compute the checksum for
+    :return: The two checksum bytes
+    """
+
+    ck_a = ck_b = 0
+    for byte in data:
+        ck_a = (ck_a + byte) & 0xFF
+        ck_b = (ck_b + ck_a) & 0xFF
+    return bytes((ck_a, ck_b))
+
+
+def build(msg_class, msg_id, payload=b""):
+    """
+    Build a UBX frame
+
+    :param msg_class: The message class
+    :param msg_id: The message id
+    :param payload: The message payload
+    :return: The frame bytes
+    """
+
+    body = struct.pack("<BBH", msg_class, msg_id, len(payload)) + bytes(payload)
+    return SYNC + body + checksum(body)
+
+
+# Fastest measurement rate of the M8 receivers, 25 Hz with a single GNSS
+MIN_MEAS_RATE_MS = 40
+
+# CFG-CFG configuration sections and devices
+CFG_SECTIONS_ALL = 0x00001F1F
+DEVICE_BBR = 0x01
+DEVICE_FLASH = 0x02
+DEVICE_EEPROM = 0x04
+DEVICE_SPI_FLASH = 0x10
+
+# CFG-PWR states
+PWR_RUN = 0x52554E20
+PWR_STOP = 0x53544F50
+PWR_BACKUP = 0x42434B50
+
+
+def poll_prt(port_id=PORT_UART1):
+    """
+    Poll for the configuration of a port
+
+    :param port_id: The port to poll
+    :return: The frame bytes
+    """
+
+    return build(CLS_CFG, CFG_PRT, bytes((port_id,)))
+
+
+def poll_rate():
+    """
+    Poll for the navigation and measurement rate
+
+    :return: The frame bytes
+    """
+
+    return build(CLS_CFG, CFG_RATE)
+
+
+def cfg_rate(meas_rate_ms, nav_rate=1, time_ref=1):
+    """
+    Set the measurement rate
+
+    :param meas_rate_ms: Time between measurements in milliseconds
+    :param nav_rate: Measurements per navigation solution
+    :param time_ref: 0 for UTC, 1 for GPS time
+    :return: The frame bytes
+    """
+
+    if not MIN_MEAS_RATE_MS <= meas_rate_ms <= 0xFFFF:
+        raise ValueError(f"Measurement rate {meas_rate_ms} ms is out of range, the fastest is {MIN_MEAS_RATE_MS} ms")
+    return build(CLS_CFG, CFG_RATE, struct.pack("<HHH", meas_rate_ms, nav_rate, time_ref))
+
+
+def message_id(name):
+    """
+    Class and id of an output message
+
+    :param name: Name of the message, e.g. GSV or NAV-PVT
+    :return: The class and id
+    """
+
+    try:
+        return MESSAGES[name.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown message {name}, expected one of {', '.join(MESSAGES)}") from None
+
+
+def poll_msg(name):
+    """
+    Poll for the output rates of a message on all ports
+
+    :param name: Name of the message
+    :return: The frame bytes
+    """
+
+    return build(CLS_CFG, CFG_MSG, bytes(message_id(name)))
+
+
+def cfg_msg(name, rate, port_ids=(PORT_UART1,), rates=None):
+    """
+    Set the output rate of a message
+
+    :param name: Name of the message, e.g. GSV or NAV-PVT
+    :param rate: Output every this many navigation solutions, 0 to disable
+    :param port_ids: Ports the rate is set for
+    :param rates: The current rates of the message on the ports, the rates of the other ports are kept. If None the
+        short form is sent, which sets the rate of the port the command is received on only
+    :return: The frame bytes
+    """
+
+    msg_class, msg_id = message_id(name)
+    if not 0 <= rate <= 0xFF:
+        raise ValueError(f"Message rate {rate} is out of range")
+    if rates is None:
+        return build(CLS_CFG, CFG_MSG, bytes((msg_class, msg_id, rate)))
+    port_rates = list(rates)
+    for port_id in port_ids:
+        port_rates[port_id] = rate
+    return build(CLS_CFG, CFG_MSG, bytes([msg_class, msg_id] + port_rates))
+
+
+def parse_msg(payload):
+    """
+    Parse a CFG-MSG response
+
+    :param payload: The message payload
+    :return: A dict with the class, id and the rates per port
+    """
+
+    return {"msg_class": payload[0], "msg_id": payload[1], "rates": list(payload[2:2 + PORTS])}
+
+
+def cfg_cfg(save=0, clear=0, load=0, devices=DEVICE_BBR | DEVICE_FLASH):
+    """
+    Save, clear or load the configuration of the non-volatile memory
+
+    :param save: Sections to save from the current configuration, CFG_SECTIONS_ALL for all
+    :param clear: Sections to reset to the defaults in the non-volatile memory
+    :param load: Sections to load from the non-volatile memory into the current configuration
+    :param devices: Mask of the memories, the battery backed RAM and the flash by default
+    :return: The frame bytes
+    """
+
+    return build(CLS_CFG, CFG_CFG, struct.pack("<IIIB", clear, save, load, devices))
+
+
+def cfg_rst(nav_bbr_mask=0xFFFF, reset_mode=0x02):
+    """
+    Reset the receiver. There is no acknowledgement
+
+    :param nav_bbr_mask: Battery backed RAM sections to clear, 0xFFFF for a cold start
+    :param reset_mode: 0x00 hardware reset, 0x01 software reset, 0x02 software reset of the GNSS only
+    :return: The frame bytes
+    """
+
+    return build(CLS_CFG, CFG_RST, struct.pack("<HBx", nav_bbr_mask, reset_mode))
+
+
+def cfg_pwr(state):
+    """
+    Put the receiver to sleep or wake it
+
+    :param state: PWR_RUN, PWR_STOP or PWR_BACKUP
+    :return: The frame bytes
+    """
+
+    return build(CLS_CFG, CFG_PWR, struct.pack("<B3xI", 1, state))
+
+
+def cfg_prt_uart(baudrate, port_id=PORT_UART1, in_proto=PROTO_UBX | PROTO_NMEA | PROTO_RTCM,
+                 out_proto=PROTO_UBX | PROTO_NMEA):
+    """
+    Configure a UART port for 8N1 at a baud rate
+
+    :param baudrate: The baud rate
+    :param port_id: The port to configure
+    :param in_proto: Mask of the input protocols
+    :param out_proto: Mask of the output protocols
+    :return: The frame bytes
+    """
+
+    mode = 0x000008D0    # 8 bits, no parity, 1 stop bit
+    return build(CLS_CFG, CFG_PRT, struct.pack("<BBHIIHHHH", port_id, 0, 0, mode, baudrate, in_proto, out_proto, 0, 0))
+
+
+def parse_prt(payload):
+    """
+    Parse a CFG-PRT response for a UART port
+
+    :param payload: The message payload
+    :return: A dict with the port configuration
+    """
+
+    port_id, _, _, mode, baudrate, in_proto, out_proto, _, _ = struct.unpack("<BBHIIHHHH", payload[:20])
+    return {"port_id": port_id, "mode": mode, "baudrate": baudrate, "in_proto": in_proto, "out_proto": out_proto}
+
+
+def parse_rate(payload):
+    """
+    Parse a CFG-RATE response
+
+    :param payload: The message payload
+    :return: A dict with the rate configuration
+    """
+
+    meas_rate, nav_rate, time_ref = struct.unpack("<HHH", payload[:6])
+    return {"meas_rate_ms": meas_rate, "nav_rate": nav_rate, "time_ref": time_ref}
+
+
+class UBXReader:
+    """
+    Extracts UBX frames from a serial stream that also carries NMEA sentences
+    """
+
+    def __init__(self, ser):
+        self.ser = ser
+        self.buffer = bytearray()
+
+    def next_frame(self):
+        """
+        Pop the next complete frame from the buffer
+
+        :return: A (class, id, payload) tuple, None if there is no complete frame
+        """
+
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                # Keep a trailing sync byte
+                del self.buffer[:max(len(self.buffer) - 1, 0)]
+                return None
+            del self.buffer[:start]
+            if len(self.buffer) < 6:
+                return None
+            length = struct.unpack_from("<H", self.buffer, 4)[0]
+            if len(self.buffer) < 8 + length:
+                return None
+            frame = bytes(self.buffer[:8 + length])
+            if checksum(frame[2:-2]) == frame[-2:]:
+                del self.buffer[:8 + length]
+                return frame[2], frame[3], frame[6:-2]
+            # Corrupt frame or a false sync, skip the sync bytes
+            del self.buffer[:2]
+
+    def read_frame(self, deadline):
+        """
+        Read from the serial port until a complete frame is available
+
+        :param deadline: Monotonic time to give up
+        :return: A (class, id, payload) tuple, None on timeout
+        """
+
+        timeout = self.ser.timeout
+        try:
+            while True:
+                frame = self.next_frame()
+                if frame is not None:
+                    return frame
+                now = time.monotonic()
+                if now >= deadline:
+                    return None
+                # A read of a silent port returns at the deadline, not after the timeout of the port
+                self.ser.timeout = max(deadline - now, 0)
+                self.buffer.extend(self.ser.read(self.ser.in_waiting or 1))
+        finally:
+            self.ser.timeout = timeout
+
+    def wait_for(self, msg_class, msg_id, timeout=1.0):
+        """
+        Read from the serial port until a message arrives
+
+        :param msg_class: The message class to wait for
+        :param msg_id: The message id to wait for
+        :param timeout: Time to wait in seconds
+        :return: The message payload, None on timeout
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.read_frame(deadline)
+            if frame is None:
+                return None
+            if frame[0] == msg_class and frame[1] == msg_id:
+                return frame[2]
+
+    def wait_for_ack(self, msg_class, msg_id, timeout=1.0):
+        """
+        Wait for the acknowledgement of a configuration message
+
+        :param msg_class: The class of the acknowledged message
+        :param msg_id: The id of the acknowledged message
+        :param timeout: Time to wait in seconds
+        :return: True for ACK-ACK, False for ACK-NAK, None on timeout
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = self.read_frame(deadline)
+            if frame is None:
+                return None
+            if frame[0] == CLS_ACK and frame[2][:2] == bytes((msg_class, msg_id)):
+                return frame[1] == ACK_ACK
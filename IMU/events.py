@@ -0,0 +1,254 @@
+import os
+from array import array
+from IMU.pipeline import PipelineStage
+
+
+class RingWindow:
+    """
+    Rolling mean and RMS over a fixed number of samples with O(1) work per sample
+    """
+
+    __slots__ = ("values", "size", "index", "count", "total", "squares", "pushes")
+
+    def __init__(self, size):
+        self.size = max(1, int(size))
+        self.values = array("d", bytes(8 * self.size))
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.pushes = 0
+
+    def push(self, value):
+        old = self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+            old = 0.0
+        self.total += value - old
+        self.squares += value * value - old * old
+        self.pushes += 1
+        # Start over from the buffer now and then, so that the rounding errors do not add up
+        if self.pushes % (self.size * 64) == 0:
+            self.total = sum(self.values)
+            self.squares = sum(v * v for v in self.values)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def rms(self):
+        return (max(self.squares, 0.0) / self.count) ** 0.5 if self.count else 0.0
+
+    @property
+    def full(self):
+        return self.count == self.size
+
+
+class EventTracker:
+    """
+    Turns a feature into events. An event starts when the feature exceeds the threshold and ends once it stayed below
+    for the hold time. Events closer than the minimum gap to the previous one are merged into it
+    """
+
+    __slots__ = ("kind", "threshold", "hold", "min_gap", "active", "peak", "peak_offset", "start_offset", "below",
+                 "last_end")
+
+    def __init__(self, kind, threshold, hold, min_gap):
+        self.kind = kind
+        self.threshold = threshold
+        self.hold = hold
+        self.min_gap = min_gap
+        self.active = False
+        self.peak = 0.0
+        self.peak_offset = 0
+        self.start_offset = 0
+        self.below = 0
+        self.last_end = None
+
+    def update(self, value, offset):
+        """
+        Feed the feature of a sample
+
+        :param value: The feature value
+        :param offset: Index of the sample in the trial
+        :return: A finished (kind, start, peak offset, peak) event, or None
+        """
+
+        if value >= self.threshold:
+            if not self.active:
+                if self.last_end is not None and offset - self.last_end < self.min_gap:
+                    # Continuation of the previous event, which was already reported
+                    self.last_end = offset
+                    return None
+                self.active = True
+                self.start_offset = offset
+                self.peak = value
+                self.peak_offset = offset
+            elif value > self.peak:
+                self.peak = value
+                self.peak_offset = offset
+            self.below = 0
+        elif self.active:
+            self.below += 1
+            if self.below >= self.hold:
+                return self.finish(offset)
+        return None
+
+    def finish(self, offset):
+        self.active = False
+        self.below = 0
+        self.last_end = offset
+        return self.kind, self.start_offset, self.peak_offset, self.peak
+
+
+class EventStage(PipelineStage):
+    """
+    Detects road events on the stream of IMU samples and writes them to events.csv, so that they can be found without
+    reading the whole trial. Braking, acceleration and cornering are found on the mean of the longitudinal and lateral
+    acceleration over a window, potholes and bumps on the peak and jerk of the vertical acceleration against its mean
+    """
+
+    name = "events"
+    file_name = "events.csv"
+    COLUMNS = ("time_s", "type", "severity_g", "sample_offset", "duration_s", "lat", "lon")
+
+    # Thresholds in g, g/s and seconds
+    DEFAULTS = {
+        "axes": {"longitudinal": 0, "lateral": 1, "vertical": 2},
+        "longitudinal_sign": 1,
+        "window_s": 0.5,
+        "baseline_s": 1.0,
+        "smoothing_s": 0.01,
+        "hold_s": 0.2,
+        "min_gap_s": 2.0,
+        "harsh_braking_g": 0.35,
+        "harsh_acceleration_g": 0.3,
+        "cornering_g": 0.4,
+        "pothole_peak_g": 0.5,
+        "pothole_jerk_g_s": 40.0,
+    }
+
+    def __init__(self, odr_hz, prefix="", context=None, **options):
+        """
+        :param odr_hz: Output data rate of the samples
+        :param prefix: Prefix of the output file
+        :param context: Shared state of the DAQ, the GPS position is taken from its gps_position
+        :param options: Overrides of the DEFAULTS
+        """
+
+        super().__init__(odr_hz, prefix=prefix, context=context)
+        unknown = set(options) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown event options: {', '.join(sorted(unknown))}")
+        self.options = dict(self.DEFAULTS, **options)
+        self.fh = None
+        self.counts = {}
+        self.reset()
+
+    def reset(self):
+        o = self.options
+        rate = self.odr_hz
+        self.window_lon = RingWindow(o["window_s"] * rate)
+        self.window_lat = RingWindow(o["window_s"] * rate)
+        self.baseline = RingWindow(o["baseline_s"] * rate)
+        self.smoothed = RingWindow(o["smoothing_s"] * rate)
+        self.previous_smoothed = None
+        hold = max(1, int(o["hold_s"] * rate))
+        gap = int(o["min_gap_s"] * rate)
+        self.trackers = [
+            EventTracker("harsh_braking", o["harsh_braking_g"], hold, gap),
+            EventTracker("harsh_acceleration", o["harsh_acceleration_g"], hold, gap),
+            EventTracker("cornering", o["cornering_g"], hold, gap),
+            EventTracker("pothole", o["pothole_peak_g"], hold, gap),
+        ]
+        self.counts = {tracker.kind: 0 for tracker in self.trackers}
+
+    def open(self, save_dir):
+        self.reset()
+        self.fh = open(os.path.join(save_dir, self.prefix + self.file_name), "w")
+        self.fh.write(",".join(self.COLUMNS) + "\n")
+
+    def write(self, event, offset):
+        kind, start, peak_offset, peak = event
+        position = self.context.get("gps_position") or (None, None)
+        lat, lon = ("" if v is None else f"{v:.7f}" for v in position[:2])
+        self.fh.write(f"{peak_offset / self.odr_hz:.3f},{kind},{peak:.3f},{peak_offset},"
+                      f"{(offset - start) / self.odr_hz:.3f},{lat},{lon}\n")
+        self.counts[kind] += 1
+
+    def process(self, samples, offset):
+        o = self.options
+        scale = self.ACCEL_G_PER_LSB
+        i_lon = 3 + o["axes"]["longitudinal"]
+        i_lat = 3 + o["axes"]["lateral"]
+        i_vert = 3 + o["axes"]["vertical"]
+        sign = o["longitudinal_sign"]
+        jerk_threshold = o["pothole_jerk_g_s"]
+        rate = self.odr_hz
+        window_lon, window_lat, baseline, smoothed = self.window_lon, self.window_lat, self.baseline, self.smoothed
+        braking, acceleration, cornering, pothole = self.trackers
+        previous = self.previous_smoothed
+
+        for n, i in enumerate(range(0, len(samples) - 5, 6)):
+            index = offset + n
+            lon = samples[i + i_lon] * scale * sign
+            vert = samples[i + i_vert] * scale
+            window_lon.push(lon)
+            window_lat.push(samples[i + i_lat] * scale)
+            baseline.push(vert)
+            smoothed.push(vert)
+
+            # Sustained horizontal acceleration
+            mean_lon = window_lon.mean
+            e1 = braking.update(-mean_lon, index)
+            e2 = acceleration.update(mean_lon, index)
+            e3 = cornering.update(abs(window_lat.mean), index)
+
+            # Sharp vertical peaks, only once the baseline is settled
+            current = smoothed.mean
+            jerk = 0.0 if previous is None else abs(current - previous) * rate
+            previous = current
+            peak = abs(vert - baseline.mean) if baseline.full else 0.0
+            e4 = pothole.update(peak if jerk >= jerk_threshold or pothole.active else 0.0, index)
+
+            if e1 or e2 or e3 or e4:
+                for event in (e1, e2, e3, e4):
+                    if event:
+                        self.write(event, index)
+
+        self.previous_smoothed = previous
+
+    def close(self):
+        if self.fh is None:
+            return {}
+        end = self.window_lon.pushes
+        for tracker in self.trackers:
+            if tracker.active:
+                self.write(tracker.finish(end), end)
+        self.fh.close()
+        self.fh = None
+        return {"file": self.prefix + self.file_name, "events": self.counts,
+                "thresholds": {k: v for k, v in self.options.items() if k.endswith(("_g", "_g_s"))}}
+
+
+def load_events(path):
+    """
+    Read an events.csv file
+
+    :param path: Path to the file
+    :return: A list of dicts, one per event
+    """
+
+    events = []
+    with open(path, "r") as fh:
+        columns = fh.readline().strip().split(",")
+        for line in fh:
+            row = dict(zip(columns, line.rstrip("\n").split(",")))
+            for key in ("time_s", "severity_g", "duration_s", "lat", "lon"):
+                row[key] = float(row[key]) if row.get(key) else None
+            row["sample_offset"] = int(row["sample_offset"])
+            events.append(row)
+    return events
@@ -1,29 +1,62 @@
-import json
 import sys
 import threading
 import time
 import os
 import struct
 import logging
-import RPi.GPIO as GPIO
 from queue import Queue
+import hal
 import utils
+import metrics
+import realtime
+from power import PowerMonitor
 from IMU import lsm6dsl
 
+GPIO = hal.gpio()
+
 
 class IMUPoller(threading.Thread):
-    def __init__(self, save_dir_time, bus=0, device=0, max_speed_hz=10000000, drdy_pin=24):
+    def __init__(self, save_dir_time=None, bus=0, device=0, max_speed_hz=10000000, drdy_pin=24, low_power=False,
+                 fifo_threshold=1920, writer_buffer_size=4096, save_location="/sensor_data",
+                 pipeline=None, realtime_priority=None, cpu=None, odr_hz=833, accel_range_g=16, gyro_range_dps=2000,
+                 writer_flush="buffered"):
         threading.Thread.__init__(self)
         self.file_writer_thread = None
         self.imu_device = lsm6dsl.LSM6DSL(spi_bus=bus, spi_dev=device, speed=max_speed_hz, drdy_pin=drdy_pin)
+        self.odr_hz = odr_hz
+        self.accel_range_g = accel_range_g
+        self.gyro_range_dps = gyro_range_dps
 
         self.running = False
+        self.armed = False
+        self.recording = threading.Event()
         self.data_queue = Queue()
 
+        # Optional processing of the samples, e.g. the orientation estimation
+        self.pipeline = pipeline
+
+        # Power management
+        self.low_power = low_power
+        self.fifo_threshold = fifo_threshold
+        self.writer_buffer_size = writer_buffer_size
+        self.writer_flush = writer_flush
+        self.wakeups = 0
+        self.sample_count = 0
+        self.overruns = 0
+        self.jitter = realtime.JitterTracer()
+
+        # Real time scheduling of the acquisition loop, on a CPU of its own
+        self.realtime_priority = realtime_priority
+        self.cpu = cpu
+        self.power_monitor = PowerMonitor()
+
         # Time Management
         self.start_time = None
         self.stop_time = None
+        self.start_request = None
+        self.first_batch_time = None
         self.save_dir_time = save_dir_time
+        self.save_location = save_location
 
         # Metadata
         self.current_save_dir = None
@@ -32,6 +65,44 @@ class IMUPoller(threading.Thread):
         # Logging
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        # Metrics
+        self.samples_total = metrics.REGISTRY.counter("imu_samples_total", "IMU samples read from the FIFO")
+        self.fifo_reads_total = metrics.REGISTRY.counter("imu_fifo_reads_total", "FIFO burst reads")
+        self.fifo_words = metrics.REGISTRY.histogram("imu_fifo_words", "Words per FIFO burst read",
+                                                     buckets=(96, 192, 384, 768, 1536, 2048))
+        self.queue_depth = metrics.REGISTRY.gauge("imu_queue_depth", "Records waiting for the IMU writer")
+        self.overruns_total = metrics.REGISTRY.counter("imu_fifo_overruns_total", "FIFO overruns, samples were lost")
+        self.read_lag = metrics.REGISTRY.histogram("imu_read_lag_seconds", "Delay of a FIFO read after the watermark",
+                                                   buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+    @staticmethod
+    def decode(fifo_data, accel_scale=0.000488):
+        """
+        Decode a FIFO burst into the records of imu.dat
+
+        :param fifo_data: The FIFO bytes, a gyroscope and accelerometer sample per 12 bytes
+        :param accel_scale: Accelerometer g per LSB of the configured full scale
+        :return: The encoded records
+        """
+
+        records = []
+        for i in range(0, len(fifo_data), 12):
+            gx = struct.unpack('<h', bytes(fifo_data[i:i + 2]))[0]
+            gy = struct.unpack('<h', bytes(fifo_data[i + 2:i + 4]))[0]
+            gz = struct.unpack('<h', bytes(fifo_data[i + 4:i + 6]))[0]
+            ax = struct.unpack('<h', bytes(fifo_data[i + 6:i + 8]))[0]
+            ay = struct.unpack('<h', bytes(fifo_data[i + 8:i + 10]))[0]
+            az = struct.unpack('<h', bytes(fifo_data[i + 10:i + 12]))[0]
+
+            ax_g = ax * accel_scale
+            ay_g = ay * accel_scale
+            az_g = az * accel_scale
+
+            records.append(f"{gx},{gy},{gz},{round(ax_g, 4)},{round(ay_g, 4)},{round(az_g, 4)}\n")
+            # print(f"Acceleration - X: {ax_g:.6f} g, Y: {ay_g:.6f} g, Z: {az_g:.6f} g")
+
+        return "".join(records).encode()
+
     def data_ready_callback(self):
         """
         Queries the sensor data from FIFO and adds to a queue
@@ -39,26 +110,34 @@ class IMUPoller(threading.Thread):
         :return: None
         """
 
-        status1, status2, status3, status4 = self.imu_device.read_fifo_status()
-        num_words = (status2 & 0x0F) << 8 | status1
+        read_start = time.monotonic()
+        num_words, status2 = self.imu_device.fifo_level()
+
+        # The FIFO filled up before it was read, the oldest samples were overwritten
+        if status2 & lsm6dsl.LSM6DSL.FIFO_OVER_RUN:
+            self.overruns += 1
+            self.overruns_total.inc()
+            self.logger.warning("IMU FIFO overrun, samples were lost")
 
         if num_words > 0:
             fifo_data = self.imu_device.read_fifo_data(num_words)
+            if self.first_batch_time is None:
+                self.first_batch_time = time.monotonic()
+            # From the watermark to the samples read: the samples above the watermark and the read
+            lag = max(num_words - self.fifo_threshold, 0) / 6 / self.odr_hz + time.monotonic() - read_start
+            self.read_lag.observe(lag)
+            self.jitter.record(lag)
 
-            for i in range(0, len(fifo_data), 12):
-                gx = struct.unpack('<h', bytes(fifo_data[i:i + 2]))[0]
-                gy = struct.unpack('<h', bytes(fifo_data[i + 2:i + 4]))[0]
-                gz = struct.unpack('<h', bytes(fifo_data[i + 4:i + 6]))[0]
-                ax = struct.unpack('<h', bytes(fifo_data[i + 6:i + 8]))[0]
-                ay = struct.unpack('<h', bytes(fifo_data[i + 8:i + 10]))[0]
-                az = struct.unpack('<h', bytes(fifo_data[i + 10:i + 12]))[0]
-
-                ax_g = ax * 0.000488
-                ay_g = ay * 0.000488
-                az_g = az * 0.000488
+            # One write-back per FIFO burst
+            self.data_queue.put(self.decode(fifo_data, self.imu_device.scale[1]))
+            if self.pipeline is not None:
+                self.pipeline.submit(fifo_data)
 
-                self.data_queue.put(f"{gx},{gy},{gz},{round(ax_g, 4)},{round(ay_g, 4)},{round(az_g, 4)}\n".encode())
-                # print(f"Acceleration - X: {ax_g:.6f} g, Y: {ay_g:.6f} g, Z: {az_g:.6f} g")
+            self.sample_count += len(fifo_data) // 12
+            self.samples_total.inc(len(fifo_data) // 12)
+            self.fifo_reads_total.inc()
+            self.fifo_words.observe(num_words)
+            self.queue_depth.set(self.data_queue.qsize())
 
     def run(self):
         """
@@ -67,10 +146,14 @@ class IMUPoller(threading.Thread):
         :return: None
         """
 
-        self.start_time = time.monotonic()
+        # Armed, wait for the recording to start
+        while self.running and not self.recording.wait(0.5):
+            pass
+        if not self.recording.is_set():
+            return
 
         # Saving the data periodically - Make directories
-        self.current_save_dir = "/sensor_data" + "/" + self.save_dir_time
+        self.current_save_dir = os.path.join(self.save_location, self.save_dir_time)
         if not os.path.exists(self.current_save_dir):
             os.makedirs(self.current_save_dir)
         output_file = os.path.join(self.current_save_dir, "imu.dat")
@@ -80,41 +163,84 @@ class IMUPoller(threading.Thread):
             fh.write("gx,gy,gz,ax_g,ay_g,az_g\n")
 
         # Start the writing file thread
-        self.file_writer_thread = threading.Thread(target=utils.file_writer, args=(self.data_queue, output_file))
+        self.file_writer_thread = threading.Thread(target=utils.file_writer,
+                                                   args=(self.data_queue, output_file, self.writer_buffer_size,
+                                                         self.writer_flush))
         self.file_writer_thread.start()
+        if self.pipeline is not None:
+            self.pipeline.open(self.current_save_dir)
 
-        self.logger.info("Starting IMU DAQ")
+        # Samples are collected from here on
+        self.imu_device.start_fifo()
+        self.start_time = time.monotonic()
+        self.metadata["start_latency_ms"] = (self.start_time - self.start_request) * 1000
+        self.logger.info(f"Starting IMU DAQ{' in low power mode' if self.low_power else ''}, "
+                         f"{self.metadata['start_latency_ms']:.1f} ms after the start request")
+        self.power_monitor.start()
+        self.metadata["realtime"] = realtime.set_realtime(self.realtime_priority, self.cpu)
+        drdy_pin = self.imu_device.drdy_pin
         while self.running:
-            if GPIO.input(self.imu_device.drdy_pin) == GPIO.HIGH:
+            if GPIO.input(drdy_pin) == GPIO.HIGH:
                 self.data_ready_callback()
+            elif self.low_power:
+                # Sleep until the FIFO watermark is reached. The timeout covers an edge missed before the wait. Only
+                # the sleeps count as wakeups, the busy polling never leaves the CPU and is in the CPU time
+                GPIO.wait_for_edge(drdy_pin, GPIO.RISING, timeout=500)
+                self.wakeups += 1
         self.logger.info("Stopping IMU DAQ")
 
         self.data_queue.put(None)
         self.file_writer_thread.join()
+        if self.pipeline is not None:
+            self.metadata["pipeline"] = self.pipeline.close()
 
-    def start_polling(self):
+    def arm(self):
         """
-        Start the DAQ process if all conditions are met
+        Prepare the sensor so that the DAQ can start without delay. The sensor is configured with the FIFO held in
+        bypass mode and the thread waits for the start
 
-        :return: None
+        :return: True, if the device is armed
         """
 
-        if not self.running:
+        if not self.armed:
             # Configure sensor and initiate
             self.imu_device.open()
             time.sleep(1)
-            self.running = self.imu_device.detect_device()
-            if self.running:
-                self.start()
-                self.imu_device.configure_sensor()
-                return True
-            else:
-                self.logger.error("IMU Device not detected. DAQ Process not started")
+            if not self.imu_device.detect_device():
+                self.logger.error("IMU Device not detected. DAQ Process not armed")
                 return False
+            self.imu_device.configure_sensor(fifo_threshold=self.fifo_threshold, start_fifo=False, odr_hz=self.odr_hz,
+                                             accel_range_g=self.accel_range_g, gyro_range_dps=self.gyro_range_dps)
+            self.armed = True
+            self.running = True
+            self.start()
+            self.logger.info("IMU armed")
+        return True
+
+    def start_polling(self, save_dir_time=None, request_time=None):
+        """
+        Start the DAQ process if all conditions are met. Arms the device first if required
+
+        :param save_dir_time: Name of the trial directory
+        :param request_time: Monotonic time of the start request, to measure the start latency
+        :return: True, if the DAQ started
+        """
+
+        if save_dir_time is not None:
+            self.save_dir_time = save_dir_time
+        if self.recording.is_set():
+            return True
+
+        self.start_request = request_time if request_time is not None else time.monotonic()
+        if not self.arm():
+            self.logger.error("IMU Device not detected. DAQ Process not started")
+            return False
+        self.recording.set()
+        return True
 
     def stop_polling(self):
         """
-        Stop the DAQ process if it is running
+        Stop the DAQ process if it is running, or disarm the device
 
         :return: None
         """
@@ -124,14 +250,27 @@ class IMUPoller(threading.Thread):
 
             # Stop the DAQ process
             self.stop_time = time.monotonic()
-            self.metadata["elapsed_time"] = self.stop_time - self.start_time
+            recorded = self.recording.is_set()
 
             # Stop the DAQ
             self.join()
 
             # Write the metadata
-            with open(self.current_save_dir + "/" + "imu.meta", "w") as fh:
-                json_string = json.dumps(self.metadata)
-                fh.write(json_string + "\n")
+            if recorded:
+                self.metadata["elapsed_time"] = self.stop_time - self.start_time
+                self.metadata["low_power"] = self.low_power
+                self.metadata["odr_hz"] = self.odr_hz
+                self.metadata["accel_range_g"] = self.accel_range_g
+                self.metadata["gyro_range_dps"] = self.gyro_range_dps
+                self.metadata["fifo_threshold"] = self.fifo_threshold
+                self.metadata["writer"] = {"buffer_size": self.writer_buffer_size, "flush": self.writer_flush}
+                self.metadata["fifo_overruns"] = self.overruns
+                self.metadata["samples"] = self.sample_count
+                self.metadata["read_lag_ms"] = self.jitter.report()
+                self.metadata["power"] = self.power_monitor.report(self.sample_count, self.wakeups)
+                if self.first_batch_time is not None:
+                    self.metadata["first_batch_ms"] = (self.first_batch_time - self.start_request) * 1000
+                utils.write_metadata(self.current_save_dir, "imu", self.metadata)
 
             self.imu_device.close()
+            self.armed = False
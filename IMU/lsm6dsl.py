@@ -1,9 +1,10 @@
-import spidev
 import struct
-import RPi.GPIO as GPIO
 import time
 import sys
 import logging
+import hal
+
+GPIO = hal.gpio()
 
 
 class LSM6DSL:
@@ -53,13 +54,36 @@ class LSM6DSL:
     # Data Read
     FIFO_DATA_OUT_L = 0x3E
     FIFO_DATA_OUT_H = 0x3F
+    # FIFO_STATUS2 flags
+    FIFO_OVER_RUN = 0x40
+
+    # Words the FIFO holds, 4 kB
+    FIFO_WORDS = 2048
+
+    # FIFO modes
+    FIFO_BYPASS = 0x00
+    FIFO_CONTINUOUS = 0x3E      # FIFO ODR 0.83 kHz, continuous mode
+    FIFO_MODE_CONTINUOUS = 0x06
+
+    # Output data rate in Hz to the ODR bits of CTRL1_XL, CTRL2_G and FIFO_CTRL5
+    ODR_CODES = {12.5: 0x1, 26: 0x2, 52: 0x3, 104: 0x4, 208: 0x5, 416: 0x6, 833: 0x7, 1666: 0x8, 3332: 0x9, 6664: 0xA}
+
+    # Full scales to the FS bits and the sensitivity, in g or dps per LSB
+    ACCEL_RANGES = {2: (0x0, 0.000061), 4: (0x2, 0.000122), 8: (0x3, 0.000244), 16: (0x1, 0.000488)}
+    GYRO_RANGES = {125: (0x2, 0.004375), 250: (0x0, 0.00875), 500: (0x4, 0.0175), 1000: (0x8, 0.035),
+                   2000: (0xC, 0.07)}
+
+    # Output data rate and full scales of the configuration, the defaults until configure_sensor sets them
+    ODR_HZ = 833
+    ACCEL_RANGE_G = 16
+    GYRO_RANGE_DPS = 2000
 
     def __init__(self, spi_bus=0, spi_dev=0, speed=10000000, drdy_pin=24):
         # Initialization
         self.spi_bus = spi_bus
         self.spi_dev = spi_dev
         self.speed = speed
-        self.spi = spidev.SpiDev()
+        self.spi = hal.spi_device()
 
         # Logging
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -107,21 +131,45 @@ class LSM6DSL:
         rx = self.spi.xfer2([register | 0x80, 0x00])
         return rx[1]
 
-    def configure_sensor(self):
+    @property
+    def scale(self):
+        """
+        Sensitivity of the configured full scales
+
+        :return: The gyroscope dps and accelerometer g per LSB
+        """
+
+        return self.GYRO_RANGES[self.GYRO_RANGE_DPS][1], self.ACCEL_RANGES[self.ACCEL_RANGE_G][1]
+
+    def configure_sensor(self, fifo_threshold=1920, start_fifo=True, odr_hz=833, accel_range_g=16,
+                         gyro_range_dps=2000):
         """
         Configure the IMU sensor in the BerryGPS-IMU v4 device
 
+        :param fifo_threshold: FIFO watermark in words that raises the INT2 pin, at most 2047
+        :param start_fifo: If False, the FIFO is left in bypass mode until start_fifo is called
+        :param odr_hz: Output data rate of both sensors and the FIFO, one of ODR_CODES
+        :param accel_range_g: Accelerometer full scale, one of ACCEL_RANGES
+        :param gyro_range_dps: Gyroscope full scale, one of GYRO_RANGES
         :return: None
         """
 
+        if odr_hz not in self.ODR_CODES or accel_range_g not in self.ACCEL_RANGES \
+                or gyro_range_dps not in self.GYRO_RANGES:
+            raise ValueError(f"Unsupported configuration: {odr_hz} Hz, {accel_range_g} g, {gyro_range_dps} dps")
+        self.ODR_HZ = odr_hz
+        self.ACCEL_RANGE_G = accel_range_g
+        self.GYRO_RANGE_DPS = gyro_range_dps
+        odr_code = self.ODR_CODES[odr_hz]
+
         # Reset device
         self.write_register(self.CTRL3_C, 0x01)     # SW Reset
         time.sleep(0.1)
 
-        # Initialize the sensor
-        self.write_register(self.CTRL1_XL, 0x77)     # ODR 0.83 kHz, +/- 16g, BW=400Hz
+        # Initialize the sensor, 0x77 and 0x7C at the default 0.83 kHz, +/- 16g and 2000 dps
+        self.write_register(self.CTRL1_XL, odr_code << 4 | self.ACCEL_RANGES[accel_range_g][0] << 2 | 0x03)  # BW=400Hz
         self.write_register(self.CTRL8_XL, 0xC8)     # Low pass filter enabled, BW9, composite filter
-        self.write_register(self.CTRL2_G, 0x7C)      # ODR 0.83 kHz, 2000 dps
+        self.write_register(self.CTRL2_G, odr_code << 4 | self.GYRO_RANGES[gyro_range_dps][0])
         self.write_register(self.CTRL3_C, 0x44)      # BDU=1, IF_INC=1
         self.write_register(self.CTRL4_C, 0x04)      # Enable data-ready interrupt
 
@@ -130,15 +178,33 @@ class LSM6DSL:
         self.write_register(self.CTRL10_C, 0x38)  # Enable X, Y, Z axes of gyroscope
 
         # Configure FIFO Control
-        self.write_register(self.FIFO_CTRL1, 0x80)
-        self.write_register(self.FIFO_CTRL2, 0x07)
+        self.write_register(self.FIFO_CTRL1, fifo_threshold & 0xFF)           # Watermark, 1920 words by default
+        self.write_register(self.FIFO_CTRL2, (fifo_threshold >> 8) & 0x07)
         self.write_register(self.FIFO_CTRL3, 0x09)
         self.write_register(self.FIFO_CTRL4, 0x00)
-        self.write_register(self.FIFO_CTRL5, 0x3E)
+        self.write_register(self.FIFO_CTRL5, self.fifo_continuous() if start_fifo else self.FIFO_BYPASS)
 
         # Data ready interrupt
         self.write_register(self.INT2_CTRL, 0x08)
 
+    def start_fifo(self):
+        """
+        Start collecting samples in the FIFO. The FIFO starts empty as it was held in bypass mode
+
+        :return: None
+        """
+
+        self.write_register(self.FIFO_CTRL5, self.fifo_continuous())
+
+    def fifo_continuous(self):
+        """
+        FIFO_CTRL5 value of the continuous mode at the configured output data rate
+
+        :return: The register value, FIFO_CONTINUOUS at 0.83 kHz
+        """
+
+        return self.ODR_CODES[self.ODR_HZ] << 3 | self.FIFO_MODE_CONTINUOUS
+
     def read_bulk_data(self):
         """
         Read a bulk of 12 bytes from SPI on the BerryGPS-IMU v4 device spanning across accelerometer and gyroscope
@@ -169,16 +235,23 @@ class LSM6DSL:
 
     def read_fifo_status(self):
         """
-        Read four status values for the FIFO
+        Read four status values for the FIFO, in one auto increment burst so that the word count of FIFO_STATUS1 and
+        FIFO_STATUS2 is from the same moment
 
         :return: A tuple of four status values
         """
 
-        status1 = self.read_register(self.FIFO_STATUS1)
-        status2 = self.read_register(self.FIFO_STATUS2)
-        status3 = self.read_register(self.FIFO_STATUS3)
-        status4 = self.read_register(self.FIFO_STATUS4)
-        return status1, status2, status3, status4
+        return tuple(self.spi.xfer2([self.FIFO_STATUS1 | 0x80] + [0x00] * 4)[1:])
+
+    def fifo_level(self):
+        """
+        Words in the FIFO and the FIFO_STATUS2 flags
+
+        :return: A tuple of the number of words, at most the size of the FIFO, and FIFO_STATUS2
+        """
+
+        status1, status2, _, _ = self.read_fifo_status()
+        return min((status2 & 0x0F) << 8 | status1, self.FIFO_WORDS), status2
 
     def read_fifo_data(self, num_words):
         """
@@ -0,0 +1,174 @@
+import os
+import sys
+import math
+from array import array
+from IMU.pipeline import PipelineStage
+
+
+class OrientationStage(PipelineStage):
+    """
+    Madgwick filter over the gyroscope and accelerometer samples. Writes orientation.dat with the orientation
+    quaternion and the acceleration without gravity for every sample, as 7 little endian 16 bit integers:
+    qw, qx, qy, qz scaled by 32767 and ax, ay, az in mg in the sensor frame. The samples the pipeline dropped are rows
+    of zeros, so that the rows stay aligned with imu.dat, and the filter starts over after them
+    """
+
+    name = "orientation"
+    file_name = "orientation.dat"
+    QUATERNION_SCALE = 32767
+    WORDS = 7
+
+    def __init__(self, odr_hz, prefix="", context=None, beta=0.05):
+        """
+        :param odr_hz: Output data rate of the samples
+        :param prefix: Prefix of the output file
+        :param context: Shared state of the DAQ
+        :param beta: Filter gain, larger values trust the accelerometer more
+        """
+
+        super().__init__(odr_hz, prefix=prefix, context=context)
+        self.beta = beta
+        self.q = None
+        self.fh = None
+        self.samples = 0
+        self.gap_samples = 0
+
+    def open(self, save_dir):
+        self.fh = open(os.path.join(save_dir, self.prefix + self.file_name), "wb")
+        self.q = None
+        self.samples = 0
+        self.gap_samples = 0
+
+    @staticmethod
+    def initial_quaternion(ax, ay, az):
+        """
+        Orientation that aligns the gravity with the measured acceleration, at zero yaw
+
+        :return: The quaternion
+        """
+
+        roll = math.atan2(ay, az)
+        pitch = math.atan2(-ax, math.sqrt(ay * ay + az * az))
+        cr, sr = math.cos(roll / 2), math.sin(roll / 2)
+        cp, sp = math.cos(pitch / 2), math.sin(pitch / 2)
+        return cr * cp, sr * cp, cr * sp, -sr * sp
+
+    def skip(self, count):
+        """
+        Pad the rows of dropped samples and restart the filter, it cannot integrate over the gap
+
+        :param count: Number of dropped samples
+        :return: None
+        """
+
+        self.fh.write(bytes(2 * self.WORDS * count))
+        self.gap_samples += count
+        self.q = None
+
+    def process(self, samples, offset):
+        if offset > self.samples + self.gap_samples:
+            self.skip(offset - self.samples - self.gap_samples)
+
+        gyro_scale = self.GYRO_DPS_PER_LSB * math.pi / 180
+        accel_scale = self.ACCEL_G_PER_LSB
+        dt = 1 / self.odr_hz
+        beta = self.beta
+        sqrt = math.sqrt
+        q_scale = self.QUATERNION_SCALE
+
+        if self.q is None:
+            self.q = self.initial_quaternion(samples[3], samples[4], samples[5])
+        q0, q1, q2, q3 = self.q
+
+        out = array("h", bytes(2 * self.WORDS * (len(samples) // 6)))
+        o = 0
+        for i in range(0, len(samples) - 5, 6):
+            gx = samples[i] * gyro_scale
+            gy = samples[i + 1] * gyro_scale
+            gz = samples[i + 2] * gyro_scale
+            ax = samples[i + 3] * accel_scale
+            ay = samples[i + 4] * accel_scale
+            az = samples[i + 5] * accel_scale
+
+            # Rate of change of the quaternion from the gyroscope
+            qd0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+            qd1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+            qd2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+            qd3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+            # Gradient descent step towards the measured gravity
+            norm = ax * ax + ay * ay + az * az
+            if norm > 0:
+                norm = 1 / sqrt(norm)
+                nx, ny, nz = ax * norm, ay * norm, az * norm
+                _2q0, _2q1, _2q2, _2q3 = 2 * q0, 2 * q1, 2 * q2, 2 * q3
+                _4q0, _4q1, _4q2 = 4 * q0, 4 * q1, 4 * q2
+                _8q1, _8q2 = 8 * q1, 8 * q2
+                q0q0, q1q1, q2q2, q3q3 = q0 * q0, q1 * q1, q2 * q2, q3 * q3
+                s0 = _4q0 * q2q2 + _2q2 * nx + _4q0 * q1q1 - _2q1 * ny
+                s1 = _4q1 * q3q3 - _2q3 * nx + 4 * q0q0 * q1 - _2q0 * ny - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * nz
+                s2 = 4 * q0q0 * q2 + _2q0 * nx + _4q2 * q3q3 - _2q3 * ny - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * nz
+                s3 = 4 * q1q1 * q3 - _2q1 * nx + 4 * q2q2 * q3 - _2q2 * ny
+                norm = s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3
+                if norm > 0:
+                    norm = beta / sqrt(norm)
+                    qd0 -= norm * s0
+                    qd1 -= norm * s1
+                    qd2 -= norm * s2
+                    qd3 -= norm * s3
+
+            q0 += qd0 * dt
+            q1 += qd1 * dt
+            q2 += qd2 * dt
+            q3 += qd3 * dt
+            norm = 1 / sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+            q0 *= norm
+            q1 *= norm
+            q2 *= norm
+            q3 *= norm
+
+            # Gravity in the sensor frame, removed from the acceleration
+            lx = ax - 2 * (q1 * q3 - q0 * q2)
+            ly = ay - 2 * (q0 * q1 + q2 * q3)
+            lz = az - (q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3)
+
+            out[o] = int(q0 * q_scale)
+            out[o + 1] = int(q1 * q_scale)
+            out[o + 2] = int(q2 * q_scale)
+            out[o + 3] = int(q3 * q_scale)
+            out[o + 4] = max(-32768, min(32767, int(lx * 1000)))
+            out[o + 5] = max(-32768, min(32767, int(ly * 1000)))
+            out[o + 6] = max(-32768, min(32767, int(lz * 1000)))
+            o += 7
+
+        self.q = (q0, q1, q2, q3)
+        self.samples += len(samples) // 6
+        if sys.byteorder == "big":
+            out.byteswap()
+        self.fh.write(out.tobytes())
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+        return {"file": self.prefix + self.file_name, "samples": self.samples, "gap_samples": self.gap_samples,
+                "beta": self.beta, "odr_hz": self.odr_hz, "format": "int16 qw,qx,qy,qz * 32767, ax,ay,az mg"}
+
+
+def load_orientation(path):
+    """
+    Read an orientation.dat file
+
+    :param path: Path to the file
+    :return: A list of (qw, qx, qy, qz, ax_g, ay_g, az_g) tuples, all zero for the dropped samples
+    """
+
+    words = array("h")
+    with open(path, "rb") as fh:
+        words.frombytes(fh.read())
+    if sys.byteorder == "big":
+        words.byteswap()
+    scale = OrientationStage.QUATERNION_SCALE
+    return [(words[i] / scale, words[i + 1] / scale, words[i + 2] / scale, words[i + 3] / scale,
+             words[i + 4] / 1000, words[i + 5] / 1000, words[i + 6] / 1000)
+            for i in range(0, len(words) - 6, 7)]
@@ -0,0 +1,184 @@
+import abc
+import sys
+import time
+import queue
+import logging
+import threading
+from array import array
+import metrics
+
+
+class PipelineStage(abc.ABC):
+    """
+    A processing stage for the IMU samples. The stages see every FIFO batch in order, as a flat array of the raw
+    16 bit words with 6 words per sample: gx, gy, gz, ax, ay, az
+    """
+
+    name = None
+
+    # Scale of the raw words for the default full scales, 2000 dps and +/- 16 g, build_pipeline sets the scale of
+    # other full scales
+    GYRO_DPS_PER_LSB = 0.07
+    ACCEL_G_PER_LSB = 0.000488
+
+    def __init__(self, odr_hz, prefix="", context=None):
+        """
+        :param odr_hz: Output data rate of the samples
+        :param prefix: Prefix of the output files, to tell the outputs of several IMUs apart
+        :param context: Shared state of the DAQ, e.g. the GPS position
+        """
+
+        self.odr_hz = odr_hz
+        self.prefix = prefix
+        self.context = context if context is not None else {}
+
+    def open(self, save_dir):
+        """
+        The recording starts
+
+        :param save_dir: The trial directory for the outputs
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def process(self, samples, offset):
+        """
+        Process a batch. The offset of a batch is past the end of the previous one if batches were dropped
+
+        :param samples: The raw words of the batch
+        :param offset: Index of the first sample of the batch in the trial
+        :return: None
+        """
+
+    def close(self):
+        """
+        The recording stopped
+
+        :return: A dict with the metadata of the stage
+        """
+
+        return {}
+
+
+class BatchPipeline(threading.Thread):
+    """
+    Runs the stages over the FIFO batches in a thread of its own. The IMU thread only hands the batches over, if the
+    stages fall behind batches are dropped from the pipeline and never from the raw data
+    """
+
+    def __init__(self, stages, max_pending=64):
+        threading.Thread.__init__(self, name="IMUPipeline", daemon=True)
+        self.stages = list(stages)
+        self.batches = queue.Queue(maxsize=max_pending)
+        self.samples = 0
+        self.dropped_batches = 0
+        self.dropped_samples = 0
+        self.cpu_seconds = {stage.name: 0.0 for stage in self.stages}
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # Metrics
+        self.batch_seconds = metrics.REGISTRY.histogram("imu_pipeline_seconds", "Pipeline time per FIFO batch",
+                                                        buckets=(0.001, 0.005, 0.02, 0.05, 0.1, 0.5))
+        self.dropped_total = metrics.REGISTRY.counter("imu_pipeline_dropped_batches_total",
+                                                      "FIFO batches the pipeline could not keep up with")
+
+    def open(self, save_dir):
+        """
+        Open the stage outputs and start processing
+
+        :param save_dir: The trial directory
+        :return: None
+        """
+
+        for stage in self.stages:
+            stage.open(save_dir)
+        self.start()
+
+    def submit(self, fifo_data):
+        """
+        Hand a FIFO batch over, without blocking
+
+        :param fifo_data: The FIFO bytes
+        :return: None
+        """
+
+        count = len(fifo_data) // 12
+        try:
+            self.batches.put_nowait((bytes(fifo_data[:count * 12]), self.samples))
+        except queue.Full:
+            self.dropped_batches += 1
+            self.dropped_samples += count
+            self.dropped_total.inc()
+        self.samples += count
+
+    def run(self):
+        while True:
+            item = self.batches.get()
+            if item is None:
+                break
+            raw, offset = item
+            samples = array("h")
+            samples.frombytes(raw)
+            if sys.byteorder == "big":
+                samples.byteswap()
+
+            batch_start = time.perf_counter()
+            for stage in self.stages:
+                stage_start = time.thread_time()
+                try:
+                    stage.process(samples, offset)
+                except Exception as e:
+                    self.logger.error(f"Error in the {stage.name} stage: {e}")
+                self.cpu_seconds[stage.name] += time.thread_time() - stage_start
+            self.batch_seconds.observe(time.perf_counter() - batch_start)
+
+    def close(self):
+        """
+        Process the pending batches and close the stage outputs
+
+        :return: A dict with the metadata of the pipeline and the stages
+        """
+
+        if self.is_alive():
+            self.batches.put(None)
+            self.join()
+        metadata = {"samples": self.samples, "dropped_batches": self.dropped_batches,
+                    "dropped_samples": self.dropped_samples, "cpu_seconds": self.cpu_seconds}
+        for stage in self.stages:
+            metadata[stage.name] = stage.close()
+        if self.dropped_batches:
+            self.logger.warning(f"The pipeline dropped {self.dropped_batches} batches")
+        return metadata
+
+
+def build_pipeline(names, odr_hz, context=None, prefix="", scale=None):
+    """
+    Create a pipeline from the names of the stages
+
+    :param names: The stages in order, by name or as a dict with the name and the options of the stage
+    :param odr_hz: Output data rate of the samples
+    :param context: Shared state of the DAQ, e.g. the GPS position
+    :param prefix: Prefix of the output files
+    :param scale: Gyroscope dps and accelerometer g per LSB if the full scales differ from the defaults
+    :return: The pipeline, None if there are no stages
+    """
+
+    from IMU.orientation import OrientationStage
+    from IMU.events import EventStage
+    from IMU.summary import SummaryStage
+    from telemetry import TelemetryStage
+    stage_types = {"orientation": OrientationStage, "events": EventStage, "summary": SummaryStage,
+                   "telemetry": TelemetryStage}
+
+    stages = []
+    for entry in names:
+        name, options = (entry, {}) if isinstance(entry, str) else (entry["name"], entry.get("options", {}))
+        if name not in stage_types:
+            raise ValueError(f"Unknown pipeline stage {name}, expected one of {', '.join(sorted(stage_types))}")
+        stage = stage_types[name](odr_hz, prefix=prefix, context=context, **options)
+        if scale is not None:
+            stage.GYRO_DPS_PER_LSB, stage.ACCEL_G_PER_LSB = scale
+        stages.append(stage)
+    return BatchPipeline(stages) if stages else None
@@ -0,0 +1,513 @@
+import os
+import time
+import queue
+import struct
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import hal
+import utils
+import metrics
+import realtime
+from IMU.imudevice import IMUPoller
+from IMU.lsm6dsl import LSM6DSL
+
+
+class SharedRing:
+    """
+    Byte ring in shared memory for one producer and one consumer process. Every record is a 32 bit length and the
+    payload. The producer only moves the write position and the consumer the read position, both are 32 bit counters
+    that wrap, so that every update is a single aligned store and no lock is needed. Records that do not fit are
+    dropped and counted
+    """
+
+    # Capacity, write position, read position, dropped records, FIFO overruns seen by the producer
+    HEADER = struct.Struct("<IIIII")
+    LENGTH = struct.Struct("<I")
+    MASK = 0xFFFFFFFF
+
+    def __init__(self, name=None, capacity=4 * 1024 * 1024):
+        """
+        :param name: Name of an existing ring to attach to, a new ring is created if None
+        :param capacity: Bytes of records, for a new ring
+        """
+
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER.size + capacity)
+            self.HEADER.pack_into(self.shm.buf, 0, capacity, 0, 0, 0, 0)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.buf = self.shm.buf
+        self.capacity = self.HEADER.unpack_from(self.buf, 0)[0]
+        self.data = self.buf[self.HEADER.size:self.HEADER.size + self.capacity]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def counter(self, index):
+        return struct.unpack_from("<I", self.buf, index * 4)[0]
+
+    def set_counter(self, index, value):
+        struct.pack_into("<I", self.buf, index * 4, value & self.MASK)
+
+    @property
+    def dropped(self):
+        return self.counter(3)
+
+    @property
+    def overruns(self):
+        return self.counter(4)
+
+    def add_overrun(self):
+        self.set_counter(4, self.counter(4) + 1)
+
+    def used(self):
+        return (self.counter(1) - self.counter(2)) & self.MASK
+
+    def copy_in(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.data[offset:offset + first] = data[:first]
+        if first < len(data):
+            self.data[:len(data) - first] = data[first:]
+
+    def copy_out(self, position, size):
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        if first == size:
+            return bytes(self.data[offset:offset + size])
+        return bytes(self.data[offset:offset + first]) + bytes(self.data[:size - first])
+
+    def push(self, payload):
+        """
+        Append a record, producer side
+
+        :param payload: The bytes of the record
+        :return: False, if the record was dropped as the ring is full
+        """
+
+        size = self.LENGTH.size + len(payload)
+        if size > self.capacity - self.used():
+            self.set_counter(3, self.dropped + 1)
+            return False
+        write = self.counter(1)
+        self.copy_in(write, self.LENGTH.pack(len(payload)))
+        self.copy_in(write + self.LENGTH.size, payload)
+        # The record is complete before the consumer can see it
+        self.set_counter(1, write + size)
+        return True
+
+    def pop(self):
+        """
+        Take the oldest record, consumer side
+
+        :return: The bytes of the record, None if the ring is empty
+        """
+
+        if not self.used():
+            return None
+        read = self.counter(2)
+        length = self.LENGTH.unpack(self.copy_out(read, self.LENGTH.size))[0]
+        payload = self.copy_out(read + self.LENGTH.size, length)
+        self.set_counter(2, read + self.LENGTH.size + length)
+        return payload
+
+    def close(self):
+        self.data.release()
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# A record of the ring, the read lag in seconds, the monotonic time of the read and the FIFO bytes
+BATCH = struct.Struct("<fd")
+
+
+def acquire(ring_name, running, recording, results, options):
+    """
+    The IMU acquisition of the child process. Configures the sensor, waits for the recording to start and hands the
+    FIFO batches to the ring until it is stopped
+
+    :param ring_name: Name of the shared ring
+    :param running: Event, cleared to stop the acquisition
+    :param recording: Event, set to start the recording
+    :param results: Queue for the state messages to the parent
+    :param options: Sensor and acquisition options
+    :return: None
+    """
+
+    from power import PowerMonitor
+    gpio = hal.gpio()
+
+    ring = SharedRing(ring_name)
+    device = LSM6DSL(spi_bus=options["bus"], spi_dev=options["device"], speed=options["max_speed_hz"],
+                      drdy_pin=options["drdy_pin"])
+    device.open()
+    time.sleep(options["settle_time"])
+    if not device.detect_device():
+        results.put({"error": "IMU device not detected"})
+        ring.close()
+        return
+    device.configure_sensor(fifo_threshold=options["fifo_threshold"], start_fifo=False, odr_hz=options["odr_hz"],
+                            accel_range_g=options["accel_range_g"], gyro_range_dps=options["gyro_range_dps"])
+    results.put({"armed": True})
+
+    # Armed, wait for the recording to start
+    parent = os.getppid()
+    while running.is_set() and not recording.wait(0.5):
+        if os.getppid() != parent:
+            running.clear()
+    if not recording.is_set():
+        device.close()
+        ring.close()
+        return
+
+    device.start_fifo()
+    start_time = time.monotonic()
+    # The process is only the acquisition, all of its memory is locked
+    realtime_applied = realtime.set_realtime(options["realtime_priority"], options["cpu"])
+    if realtime_applied:
+        realtime.lock_memory()
+    results.put({"started": start_time, "realtime": realtime_applied})
+    power_monitor = PowerMonitor()
+    power_monitor.start()
+
+    threshold = options["fifo_threshold"]
+    low_power = options["low_power"]
+    drdy_pin = device.drdy_pin
+    loops = wakeups = samples = 0
+    next_parent_check = start_time + 1
+    while running.is_set():
+        loops += 1
+        if gpio.input(drdy_pin) == gpio.HIGH:
+            read_start = time.monotonic()
+            num_words, status2 = device.fifo_level()
+            if status2 & LSM6DSL.FIFO_OVER_RUN:
+                ring.add_overrun()
+            if num_words > 0:
+                fifo_data = device.read_fifo_data(num_words)
+                read_time = time.monotonic()
+                lag = max(num_words - threshold, 0) / 6 / device.ODR_HZ + read_time - read_start
+                ring.push(BATCH.pack(lag, read_time) + bytes(fifo_data))
+                samples += len(fifo_data) // 12
+        elif low_power:
+            gpio.wait_for_edge(drdy_pin, gpio.RISING, timeout=500)
+            # Only the sleeps count as wakeups, the busy polling is in the CPU time
+            wakeups += 1
+
+        # Stop with the parent
+        if loops % 64 == 0 and time.monotonic() > next_parent_check:
+            next_parent_check += 1
+            if os.getppid() != parent:
+                break
+
+    result = {"stopped": time.monotonic(), "wakeups": wakeups, "samples": samples,
+              "power": power_monitor.report(samples, wakeups)}
+    if hal.SIMULATED:
+        result["simulation"] = hal.simulation().stats()["imu"]
+    device.close()
+    ring.close()
+    results.put(result)
+
+
+class IMUProcessPoller:
+    """
+    Runs the IMU acquisition in a child process, so that the FIFO is drained without waiting for the GIL of the main
+    process. The child hands the FIFO batches over through a shared memory ring, a thread of the main process decodes
+    them into imu.dat and feeds the pipeline. A child that dies while recording is restarted and keeps appending to
+    the trial. Same interface as the IMUPoller
+    """
+
+    def __init__(self, save_dir_time=None, bus=0, device=0, max_speed_hz=10000000, drdy_pin=24, low_power=False,
+                 fifo_threshold=1920, writer_buffer_size=4096, save_location="/sensor_data", pipeline=None,
+                 ring_bytes=4 * 1024 * 1024, max_restarts=3, realtime_priority=None, cpu=None, odr_hz=833,
+                 accel_range_g=16, gyro_range_dps=2000, writer_flush="buffered"):
+        self.options = {"bus": bus, "device": device, "max_speed_hz": max_speed_hz, "drdy_pin": drdy_pin,
+                        "low_power": low_power, "fifo_threshold": fifo_threshold,
+                        "realtime_priority": realtime_priority, "cpu": cpu, "odr_hz": odr_hz,
+                        "accel_range_g": accel_range_g, "gyro_range_dps": gyro_range_dps}
+        self.ring_bytes = ring_bytes
+        self.max_restarts = max_restarts
+        self.context = multiprocessing.get_context("spawn")
+
+        self.ring = None
+        self.process = None
+        self.running = None
+        self.recording = None
+        self.results = None
+        self.drain_thread = None
+        self.stopping = threading.Event()
+
+        self.armed = False
+        self.low_power = low_power
+        self.fifo_threshold = fifo_threshold
+        self.writer_buffer_size = writer_buffer_size
+        self.writer_flush = writer_flush
+        self.odr_hz = odr_hz
+        self.accel_scale = LSM6DSL.ACCEL_RANGES[accel_range_g][1]
+        self.pipeline = pipeline
+        self.data_queue = queue.Queue()
+        self.file_writer_thread = None
+
+        # Counters
+        self.sample_count = 0
+        self.overruns = 0
+        self.restarts = 0
+        self.jitter = realtime.JitterTracer()
+        self.first_batch_time = None
+
+        # Time Management
+        self.start_time = None
+        self.stop_time = None
+        self.start_request = None
+        self.save_dir_time = save_dir_time
+        self.save_location = save_location
+
+        # Metadata
+        self.current_save_dir = None
+        self.metadata = {}
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # Metrics
+        self.samples_total = metrics.REGISTRY.counter("imu_samples_total", "IMU samples read from the FIFO")
+        self.fifo_reads_total = metrics.REGISTRY.counter("imu_fifo_reads_total", "FIFO burst reads")
+        self.queue_depth = metrics.REGISTRY.gauge("imu_queue_depth", "Records waiting for the IMU writer")
+        self.overruns_total = metrics.REGISTRY.counter("imu_fifo_overruns_total", "FIFO overruns, samples were lost")
+        self.read_lag = metrics.REGISTRY.histogram("imu_read_lag_seconds", "Delay of a FIFO read after the watermark",
+                                                   buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1))
+        self.ring_bytes_used = metrics.REGISTRY.gauge("imu_ring_bytes", "Bytes waiting in the IMU ring")
+        self.restarts_total = metrics.REGISTRY.counter("imu_process_restarts_total", "Restarts of the IMU process")
+
+    def spawn(self, settle_time=1.0):
+        """
+        Start a child process and wait until it configured the sensor
+
+        :param settle_time: Seconds to wait for the sensor after opening the bus
+        :return: True, if the sensor is armed
+        """
+
+        self.running = self.context.Event()
+        self.recording = self.context.Event()
+        self.results = self.context.Queue()
+        self.running.set()
+        # The child simulates its own IMU, it is configured through the environment as the module state of hal is
+        # not inherited by a spawned process
+        if hal.SIMULATED:
+            os.environ["DRIVESENSE_HAL"] = "sim"
+            os.environ["DRIVESENSE_SIM_ODR"] = str(hal.simulation().imu.odr_override or 0)
+        self.process = self.context.Process(target=acquire, name="IMUAcquisition", daemon=True,
+                                            args=(self.ring.name, self.running, self.recording, self.results,
+                                                  dict(self.options, settle_time=settle_time)))
+        self.process.start()
+        try:
+            message = self.results.get(timeout=30)
+        except queue.Empty:
+            message = {"error": "IMU process did not start"}
+        if "error" in message:
+            self.logger.error(f"{message['error']}. DAQ Process not armed")
+            self.running.clear()
+            self.process.join(5)
+            return False
+        return True
+
+    def arm(self):
+        """
+        Start the child process with the sensor configured and the FIFO held in bypass mode
+
+        :return: True, if the device is armed
+        """
+
+        if not self.armed:
+            self.ring = SharedRing(capacity=self.ring_bytes)
+            if not self.spawn():
+                self.ring.close()
+                self.ring = None
+                return False
+            self.armed = True
+            self.logger.info(f"IMU armed in process {self.process.pid}")
+        return True
+
+    def start_polling(self, save_dir_time=None, request_time=None):
+        """
+        Start the DAQ process. Arms the device first if required
+
+        :param save_dir_time: Name of the trial directory
+        :param request_time: Monotonic time of the start request, to measure the start latency
+        :return: True, if the DAQ started
+        """
+
+        if save_dir_time is not None:
+            self.save_dir_time = save_dir_time
+        if self.recording is not None and self.recording.is_set():
+            return True
+
+        self.start_request = request_time if request_time is not None else time.monotonic()
+        if not self.arm():
+            self.logger.error("IMU Device not detected. DAQ Process not started")
+            return False
+        # The child starts the FIFO right away, the batches wait in the ring until the outputs are open
+        self.recording.set()
+
+        self.current_save_dir = os.path.join(self.save_location, self.save_dir_time)
+        os.makedirs(self.current_save_dir, exist_ok=True)
+        output_file = os.path.join(self.current_save_dir, "imu.dat")
+        with open(output_file, "w") as fh:
+            fh.write("gx,gy,gz,ax_g,ay_g,az_g\n")
+        self.file_writer_thread = threading.Thread(target=utils.file_writer,
+                                                   args=(self.data_queue, output_file, self.writer_buffer_size,
+                                                         self.writer_flush))
+        self.file_writer_thread.start()
+        if self.pipeline is not None:
+            self.pipeline.open(self.current_save_dir)
+
+        self.drain_thread = threading.Thread(target=self.drain, name="IMURingDrain", daemon=True)
+        self.drain_thread.start()
+        return True
+
+    def wait_started(self):
+        try:
+            message = self.results.get(timeout=5)
+        except queue.Empty:
+            return
+        if "started" in message:
+            self.metadata["realtime"] = message["realtime"]
+            if self.start_time is None:
+                self.start_time = message["started"]
+                self.metadata["start_latency_ms"] = (self.start_time - self.start_request) * 1000
+                self.logger.info(f"Starting IMU DAQ in process {self.process.pid}"
+                                 f"{' in low power mode' if self.low_power else ''}, "
+                                 f"{self.metadata['start_latency_ms']:.1f} ms after the start request")
+
+    def take(self):
+        """
+        Hand the batches in the ring to the writer and the pipeline
+
+        :return: Number of batches
+        """
+
+        batches = 0
+        while True:
+            record = self.ring.pop()
+            if record is None:
+                break
+            lag, read_time = BATCH.unpack_from(record)
+            if self.first_batch_time is None:
+                self.first_batch_time = read_time
+            fifo_data = record[BATCH.size:]
+            self.data_queue.put(IMUPoller.decode(fifo_data, self.accel_scale))
+            if self.pipeline is not None:
+                self.pipeline.submit(fifo_data)
+
+            count = len(fifo_data) // 12
+            self.sample_count += count
+            self.samples_total.inc(count)
+            self.fifo_reads_total.inc()
+            self.read_lag.observe(lag)
+            self.jitter.record(lag)
+            batches += 1
+
+        overruns = self.ring.overruns
+        if overruns != self.overruns:
+            self.overruns_total.inc(overruns - self.overruns)
+            self.logger.warning("IMU FIFO overrun, samples were lost")
+            self.overruns = overruns
+        self.queue_depth.set(self.data_queue.qsize())
+        return batches
+
+    def drain(self):
+        """
+        Thread taking the batches from the ring. Restarts the child process if it died
+
+        :return: None
+        """
+
+        self.wait_started()
+        # A quarter of the time to the watermark
+        interval = min(self.fifo_threshold / 6 / self.odr_hz / 4, 0.05)
+        while not self.stopping.is_set():
+            if not self.take():
+                self.stopping.wait(interval)
+            self.ring_bytes_used.set(self.ring.used())
+
+            if not self.process.is_alive() and not self.stopping.is_set():
+                self.logger.error(f"IMU process exited with {self.process.exitcode} while recording")
+                self.take()
+                # The sensor is powered already, it is only configured again
+                if self.restarts >= self.max_restarts or not self.spawn(settle_time=0.1):
+                    self.logger.error("IMU process not restarted, the IMU recording stopped")
+                    self.metadata["failed"] = True
+                    break
+                self.restarts += 1
+                self.restarts_total.inc()
+                self.recording.set()
+                self.logger.warning(f"IMU process restarted as {self.process.pid}")
+
+    def stop_polling(self):
+        """
+        Stop the DAQ process if it is running, or disarm the device
+
+        :return: None
+        """
+
+        if not self.armed:
+            return
+
+        self.stop_time = time.monotonic()
+        recorded = self.recording.is_set()
+        if recorded:
+            # The drain thread is stopped first, so that it does not take the stopping child for a crash and restart it
+            self.stopping.set()
+            self.drain_thread.join()
+        self.running.clear()
+        self.process.join(10)
+        if self.process.is_alive():
+            self.logger.error("IMU process did not stop, terminating it")
+            self.process.terminate()
+            self.process.join()
+
+        if recorded:
+            # The batches since the drain thread stopped
+            self.take()
+            self.logger.info("Stopping IMU DAQ")
+            try:
+                result = self.results.get(timeout=5)
+                while "stopped" not in result:
+                    result = self.results.get(timeout=5)
+            except queue.Empty:
+                result = {}
+
+            self.data_queue.put(None)
+            self.file_writer_thread.join()
+            if self.pipeline is not None:
+                self.metadata["pipeline"] = self.pipeline.close()
+
+            self.metadata["elapsed_time"] = self.stop_time - (self.start_time or self.stop_time)
+            self.metadata["low_power"] = self.low_power
+            for key in ("odr_hz", "accel_range_g", "gyro_range_dps", "fifo_threshold"):
+                self.metadata[key] = self.options[key]
+            self.metadata["writer"] = {"buffer_size": self.writer_buffer_size, "flush": self.writer_flush}
+            self.metadata["fifo_overruns"] = self.overruns
+            self.metadata["samples"] = self.sample_count
+            self.metadata["read_lag_ms"] = self.jitter.report()
+            self.metadata["process"] = {"restarts": self.restarts, "ring_dropped": self.ring.dropped}
+            if self.ring.dropped:
+                self.logger.warning(f"The IMU ring was full, {self.ring.dropped} batches were lost")
+            if "power" in result:
+                self.metadata["power"] = result["power"]
+            if self.first_batch_time is not None:
+                self.metadata["first_batch_ms"] = (self.first_batch_time - self.start_request) * 1000
+            if "simulation" in result:
+                self.metadata["simulation"] = result["simulation"]
+            utils.write_metadata(self.current_save_dir, "imu", self.metadata)
+
+        self.results.close()
+        self.ring.close()
+        self.ring = None
+        self.armed = False
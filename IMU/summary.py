@@ -0,0 +1,202 @@
+import os
+import json
+import math
+import struct
+import operator
+from IMU.pipeline import PipelineStage
+
+
+# Layout of summary.dat. A JSON header line, then blocks of bins of one level: a block header with the level, the
+# number of bins and the index of the first bin, and per bin its index, the number of samples and the min, max, mean
+# and RMS of the 6 channels as raw 16 bit values
+MAGIC = b"DSSUM2"
+BLOCK_HEADER = struct.Struct("<4sBxHI")
+BLOCK_MAGIC = b"BLK0"
+BIN = struct.Struct("<II24h")
+# The first version kept the number of samples in 16 bits, capped at 65535
+MAGIC_V1 = b"DSSUM1"
+BIN_V1 = struct.Struct("<IHxx24h")
+CHANNELS = ("gx", "gy", "gz", "ax", "ay", "az")
+
+
+class Accumulator:
+    """
+    Min, max, sum and sum of squares of the 6 channels
+    """
+
+    __slots__ = ("count", "minimum", "maximum", "total", "squares")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.minimum = [32767] * 6
+        self.maximum = [-32768] * 6
+        self.total = [0] * 6
+        self.squares = [0] * 6
+
+    def add_samples(self, samples, count):
+        """
+        Add samples, each channel is reduced in one pass
+
+        :param samples: The raw words, 6 per sample
+        :param count: Number of samples
+        :return: None
+        """
+
+        for c in range(6):
+            channel = samples[c::6]
+            low, high = min(channel), max(channel)
+            if low < self.minimum[c]:
+                self.minimum[c] = low
+            if high > self.maximum[c]:
+                self.maximum[c] = high
+            self.total[c] += sum(channel)
+            self.squares[c] += sum(map(operator.mul, channel, channel))
+        self.count += count
+
+    def add(self, other):
+        for c in range(6):
+            if other.minimum[c] < self.minimum[c]:
+                self.minimum[c] = other.minimum[c]
+            if other.maximum[c] > self.maximum[c]:
+                self.maximum[c] = other.maximum[c]
+            self.total[c] += other.total[c]
+            self.squares[c] += other.squares[c]
+        self.count += other.count
+
+    def pack(self, index):
+        values = []
+        for c in range(6):
+            mean = self.total[c] / self.count
+            rms = math.sqrt(self.squares[c] / self.count)
+            values += [self.minimum[c], self.maximum[c], round(mean), min(round(rms), 32767)]
+        return BIN.pack(index, self.count, *values)
+
+
+class SummaryStage(PipelineStage):
+    """
+    Maintains min, max, mean and RMS summaries of the channels at several resolutions, written to summary.dat. The
+    finest level is reduced from the samples, the coarser ones from the finished bins of the level below. The bins
+    are placed by the index of the samples in the trial, the samples the pipeline dropped leave bins out or partly
+    filled
+    """
+
+    name = "summary"
+    file_name = "summary.dat"
+    BLOCK_BINS = 256
+
+    def __init__(self, odr_hz, prefix="", context=None, levels=(0.1, 1, 10, 60)):
+        """
+        :param odr_hz: Output data rate of the samples
+        :param prefix: Prefix of the output file
+        :param context: Shared state of the DAQ
+        :param levels: Bin lengths in seconds, each a whole multiple of the previous one
+        """
+
+        super().__init__(odr_hz, prefix=prefix, context=context)
+        self.base_samples = max(1, round(levels[0] * odr_hz))
+        self.factors = [1]
+        for finer, coarser in zip(levels, levels[1:]):
+            factor = coarser / finer
+            if factor < 2 or abs(factor - round(factor)) > 1e-6:
+                raise ValueError(f"Summary level {coarser} s is not a multiple of {finer} s")
+            self.factors.append(round(factor))
+        self.levels = levels
+        self.fh = None
+
+    def bin_seconds(self, level):
+        return self.base_samples * math.prod(self.factors[:level + 1]) / self.odr_hz
+
+    def open(self, save_dir):
+        self.fh = open(os.path.join(save_dir, self.prefix + self.file_name), "wb")
+        header = {"odr_hz": self.odr_hz, "channels": CHANNELS,
+                  "bin_seconds": [self.bin_seconds(level) for level in range(len(self.levels))],
+                  "scale": {"gyro_dps_per_lsb": self.GYRO_DPS_PER_LSB, "accel_g_per_lsb": self.ACCEL_G_PER_LSB}}
+        self.fh.write(MAGIC + json.dumps(header).encode() + b"\n")
+        self.accumulators = [Accumulator() for _ in self.levels]
+        # Samples per bin of each level
+        self.sizes = [self.base_samples * math.prod(self.factors[:level + 1]) for level in range(len(self.levels))]
+        self.bins = [0] * len(self.levels)
+        self.pending = [[] for _ in self.levels]
+        self.first_bin = [0] * len(self.levels)
+        # Index of the next sample in the trial
+        self.position = 0
+        self.gaps = 0
+
+    def emit(self, level):
+        """
+        Finish the current bin of a level and fold it into the level above
+
+        :param level: The level
+        :return: None
+        """
+
+        accumulator = self.accumulators[level]
+        if not accumulator.count:
+            return
+        # The bin of the last sample added
+        index = (self.position - 1) // self.sizes[level]
+        if self.pending[level] and index != self.first_bin[level] + len(self.pending[level]):
+            # A block holds consecutive bins
+            self.flush(level)
+        if not self.pending[level]:
+            self.first_bin[level] = index
+        self.pending[level].append(accumulator.pack(index))
+        self.bins[level] += 1
+        if len(self.pending[level]) >= self.BLOCK_BINS:
+            self.flush(level)
+
+        if level + 1 < len(self.levels):
+            self.accumulators[level + 1].add(accumulator)
+            if self.position % self.sizes[level + 1] == 0:
+                self.emit(level + 1)
+        accumulator.clear()
+
+    def skip(self, offset):
+        """
+        Samples were dropped up to an offset. The bins the gap cuts short are finished with the samples they have
+
+        :param offset: Index of the next sample in the trial
+        :return: None
+        """
+
+        for level, size in enumerate(self.sizes):
+            if offset // size != self.position // size:
+                self.emit(level)
+        self.position = offset
+        self.gaps += 1
+
+    def flush(self, level):
+        bins = self.pending[level]
+        if bins:
+            self.fh.write(BLOCK_HEADER.pack(BLOCK_MAGIC, level, len(bins), self.first_bin[level]))
+            self.fh.write(b"".join(bins))
+            self.pending[level] = []
+
+    def process(self, samples, offset):
+        if offset > self.position:
+            self.skip(offset)
+        base = self.accumulators[0]
+        count = len(samples) // 6
+        position = 0
+        while position < count:
+            take = min(self.base_samples - self.position % self.base_samples, count - position)
+            base.add_samples(samples[position * 6:(position + take) * 6], take)
+            position += take
+            self.position += take
+            if self.position % self.base_samples == 0:
+                self.emit(0)
+
+    def close(self):
+        if self.fh is None:
+            return {}
+        # The partial bins at the end
+        for level in range(len(self.levels)):
+            self.emit(level)
+        for level in range(len(self.levels)):
+            self.flush(level)
+        self.fh.close()
+        self.fh = None
+        return {"file": self.prefix + self.file_name, "levels_s": list(self.levels), "bins": self.bins, "gaps": self.gaps}
@@ -21,8 +21,9 @@ if [ -f "$UPDATE_FILE" ]; then
     if [ -f "$UPDATE_DIR/$DRIVESENSE_FILE" ]; then
         echo "drivesense file found. Updating..."
 
-        # Copy the drivesense file to the target location
-        cp "$UPDATE_DIR/$DRIVESENSE_FILE" "$TARGET_DIR/"
+        # Copy the drivesense executable and its one-dir bundle to the target location
+        rm -rf "$TARGET_DIR/_internal"
+        cp -r "$UPDATE_DIR"/. "$TARGET_DIR/"
 
         # Clean up the temporary update directory
         rm -rf "$UPDATE_DIR"
@@ -0,0 +1,878 @@
+import os
+import sys
+import json
+import time
+import queue
+import pickle
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hal
+
+# The benchmarks run against the simulated devices
+simulation = hal.enable_simulation()
+
+import utils
+from IMU.imudevice import IMUPoller
+from simulator import run as simulator_run
+from simulator.gpsd_sim import GpsdRecord, synthetic_records
+from data_loader.usb import SensorDataCopier
+
+# Most words the FIFO hands over at once, as read at the default watermark
+BURST_SAMPLES = 320
+
+
+def percentiles(values):
+    """
+    Summary of a list of durations
+
+    :param values: Durations in seconds
+    :return: A dict with the median, 99th percentile and maximum in microseconds
+    """
+
+    values = sorted(values)
+    return {"p50_us": values[len(values) // 2] * 1e6, "p99_us": values[int(len(values) * 0.99)] * 1e6,
+            "max_us": values[-1] * 1e6}
+
+
+def fifo_bursts(count):
+    """
+    FIFO bursts of the simulated signal
+
+    :param count: Number of bursts
+    :return: A list of bursts in the FIFO layout
+    """
+
+    signal = simulation.imu.signal
+    size = BURST_SAMPLES * 12
+    return [signal[(i * size) % (len(signal) - size):][:size] for i in range(count)]
+
+
+def bench_fifo_decode(bursts=200):
+    """
+    Decoding of FIFO bursts into imu.dat records
+
+    :param bursts: Number of bursts to decode
+    :return: The results
+    """
+
+    data = [list(b) for b in fifo_bursts(bursts)]
+    durations = []
+    for burst in data:
+        start = time.perf_counter()
+        IMUPoller.decode(burst)
+        durations.append(time.perf_counter() - start)
+    return {"samples_per_second": BURST_SAMPLES * len(data) / sum(durations),
+            "burst_samples": BURST_SAMPLES, "burst": percentiles(durations)}
+
+
+def bench_writer(directory, chunks=2000, latency_chunks=200, buffer_size=4096):
+    """
+    Throughput of the file writer and the latency from a queued burst to the data being in the file
+
+    :param directory: Directory for the output
+    :param chunks: Number of bursts for the throughput
+    :param latency_chunks: Number of bursts for the latency
+    :param buffer_size: Writer buffer size
+    :return: The results
+    """
+
+    chunk = IMUPoller.decode(list(fifo_bursts(1)[0]))
+
+    # Throughput
+    output_file = os.path.join(directory, "writer-throughput.dat")
+    data_queue = queue.Queue()
+    writer = threading.Thread(target=utils.file_writer, args=(data_queue, output_file, buffer_size))
+    start = time.perf_counter()
+    writer.start()
+    for _ in range(chunks):
+        data_queue.put(chunk)
+    data_queue.put(None)
+    writer.join()
+    elapsed = time.perf_counter() - start
+    written = os.path.getsize(output_file)
+
+    # Latency, one burst at a time
+    output_file = os.path.join(directory, "writer-latency.dat")
+    data_queue = queue.Queue()
+    writer = threading.Thread(target=utils.file_writer, args=(data_queue, output_file, buffer_size))
+    writer.start()
+    expected = 0
+    durations = []
+    for _ in range(latency_chunks):
+        expected += len(chunk)
+        start = time.perf_counter()
+        data_queue.put(chunk)
+        while not os.path.exists(output_file) or os.path.getsize(output_file) < expected:
+            time.sleep(0)
+        durations.append(time.perf_counter() - start)
+    data_queue.put(None)
+    writer.join()
+
+    return {"megabytes_per_second": written / elapsed / 1e6, "burst_bytes": len(chunk),
+            "buffer_size": buffer_size, "latency": percentiles(durations)}
+
+
+def bench_gps_serialization(directory, seconds=600):
+    """
+    Serialization of gpsd records into gps.dat
+
+    :param directory: Directory for the output
+    :param seconds: Length of the drive to serialize at 10 Hz
+    :return: The results
+    """
+
+    records = [GpsdRecord(r) for r in synthetic_records(seconds=seconds)]
+    output_file = os.path.join(directory, "gps.dat")
+    with open(output_file, "wb") as fh:
+        start = time.perf_counter()
+        for record in records:
+            pickle.dump(record, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        elapsed = time.perf_counter() - start
+    return {"records_per_second": len(records) / elapsed,
+            "bytes_per_record": os.path.getsize(output_file) / len(records)}
+
+
+def bench_copy(directory, trials=3, imu_megabytes=16):
+    """
+    Copy of trials to the USB drive by SensorDataCopier.copy_sensor_data, with the drive simulated by a directory
+
+    :param directory: Directory for the source and destination
+    :param trials: Number of trials
+    :param imu_megabytes: Size of imu.dat in each trial
+    :return: The results
+    """
+
+    from display.ssd1306 import Display
+
+    source = os.path.join(directory, "sensor_data")
+    destination = os.path.join(directory, "usb")
+    block = IMUPoller.decode(list(fifo_bursts(1)[0]))
+    for trial in range(1, trials + 1):
+        trial_dir = os.path.join(source, f"trial-{trial}")
+        os.makedirs(trial_dir)
+        with open(os.path.join(trial_dir, "imu.dat"), "wb") as fh:
+            for _ in range(imu_megabytes * 1_000_000 // len(block)):
+                fh.write(block)
+        shutil.copy(os.path.join(directory, "gps.dat"), trial_dir)
+
+    os.makedirs(destination)
+    simulation.insert_usb(destination)
+    copier = SensorDataCopier(Display(), sensor_data_path=source, usb_mount_point=destination)
+    total = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(source) for f in files)
+    start = time.perf_counter()
+    copier.copy_sensor_data()
+    elapsed = time.perf_counter() - start
+    copied = sum(os.path.getsize(os.path.join(root, f))
+                 for root, _, files in os.walk(os.path.join(destination, "uw-sensor-data")) for f in files)
+    return {"megabytes_per_second": total / elapsed / 1e6, "bytes": total, "complete": copied == total,
+            "unmounted": simulation.usb is None}
+
+
+def bench_upload(directory, trials=3, imu_megabytes=8, drop_every=3_000_000):
+    """
+    Upload of trials to the stand-in collection server, without and with link drops in the middle of the chunks.
+    The uploaded files are compared with the originals
+
+    :param directory: Directory for the trials and the server
+    :param trials: Number of trials
+    :param imu_megabytes: Size of imu.dat in each trial
+    :param drop_every: Bytes between the link drops
+    :return: The results
+    """
+
+    import filecmp
+    import http.client
+    from catalog import TrialCatalog
+    from data_loader.upload import TrialUploader, UploadError
+    from simulator.upload_server import FakeUploadServer
+
+    results = {}
+    block = IMUPoller.decode(list(fifo_bursts(1)[0]))
+    for mode, drops in (("steady", None), ("link_drops", drop_every)):
+        source = os.path.join(directory, f"upload-{mode}")
+        for trial in range(1, trials + 1):
+            trial_dir = os.path.join(source, f"trial-{trial}")
+            os.makedirs(trial_dir)
+            with open(os.path.join(trial_dir, "imu.dat"), "wb") as fh:
+                for _ in range(imu_megabytes * 1_000_000 // len(block)):
+                    fh.write(block)
+        catalog = TrialCatalog(source)
+        server = FakeUploadServer(os.path.join(directory, f"server-{mode}"), drop_every=drops).start()
+        uploader = TrialUploader(catalog, server.url, save_location=source, device_id="bench")
+
+        retries = 0
+        start = time.perf_counter()
+        while catalog.pending_upload():
+            try:
+                uploader.upload_pending()
+            except (OSError, http.client.HTTPException, UploadError):
+                retries += 1
+        elapsed = time.perf_counter() - start
+        uploader.disconnect()
+        server.stop()
+        catalog.close()
+
+        total = trials * os.path.getsize(os.path.join(source, "trial-1", "imu.dat"))
+        identical = all(filecmp.cmp(os.path.join(source, f"trial-{trial}", "imu.dat"),
+                                    os.path.join(server.directory, "bench", f"trial-{trial}", "imu.dat"),
+                                    shallow=False) for trial in range(1, trials + 1))
+        results[mode] = {"megabytes_per_second": total / elapsed / 1e6, "bytes": total, "link_drops": server.drops,
+                         "retries": retries, "identical": identical}
+    return results
+
+
+def bench_display_render(frames=300):
+    """
+    Cost and bus traffic of the display screens
+
+    :param frames: Number of frames per screen
+    :return: The results
+    """
+
+    from display.ssd1306 import Display
+
+    display = Display()
+    oled = simulation.oled
+    screens = {
+        "header_and_status": lambda i: display.display_header_and_status("DAQ", f"Elapsed time: {i} min",
+                                                                         indicator=3),
+        "progress": lambda i: display.display_progress("Data Copy", (i % 100) / 100),
+        "diagnostics": lambda i: display.display_diagnostics("Diagnostics", [f"IMU {833 + i % 7} Hz", "Queue 0",
+                                                                             "GPS 3D 9 sats", "Load 0.3 41 C"]),
+        "system_props": lambda i: display.display_system_props(),
+    }
+
+    results = {}
+    for name, draw in screens.items():
+        oled.reset_counters()
+        durations = []
+        for i in range(frames):
+            start = time.perf_counter()
+            draw(i)
+            durations.append(time.perf_counter() - start)
+        results[name] = dict(percentiles(durations), bytes_per_frame=oled.bytes_sent / frames)
+    return results
+
+
+def bench_orientation(directory, bursts=100, odr_hz=3330, trial_seconds=5.0):
+    """
+    Cost of the orientation stage, alone and in a trial at a high output data rate. The trial passes if neither the
+    raw data nor the pipeline lost samples
+
+    :param directory: Directory for the outputs
+    :param bursts: Number of bursts for the stage alone
+    :param odr_hz: Output data rate of the trial
+    :param trial_seconds: Length of the trial
+    :return: The results
+    """
+
+    from array import array
+    from IMU.orientation import OrientationStage
+
+    stage = OrientationStage(odr_hz)
+    stage.open(directory)
+    data = []
+    for burst in fifo_bursts(bursts):
+        samples = array("h")
+        samples.frombytes(burst)
+        data.append(samples)
+    durations = []
+    for offset, samples in enumerate(data):
+        start = time.perf_counter()
+        stage.process(samples, offset * BURST_SAMPLES)
+        durations.append(time.perf_counter() - start)
+    stage.close()
+    rate = BURST_SAMPLES * len(data) / sum(durations)
+
+    summary = simulator_run.run(duration=trial_seconds, odr_hz=odr_hz, data_dir=directory,
+                                imu_stages=["orientation"])
+    shutil.rmtree(summary["trial_dir"], ignore_errors=True)
+    pipeline = summary["pipeline"]
+    return {"samples_per_second": rate, "realtime_factor": rate / odr_hz, "burst": percentiles(durations),
+            "trial": {"odr_hz": odr_hz, "samples": summary["imu_samples"],
+                      "samples_dropped": summary["imu_samples_dropped"],
+                      "pipeline_samples_dropped": pipeline["dropped_samples"],
+                      "pipeline_cpu_seconds": pipeline["cpu_seconds"]["orientation"],
+                      "sustained": summary["imu_samples_dropped"] == 0 and pipeline["dropped_samples"] == 0}}
+
+
+def bench_events(directory, bursts=200, odr_hz=833):
+    """
+    Per sample cost of the road event detector
+
+    :param directory: Directory for the outputs
+    :param bursts: Number of bursts
+    :param odr_hz: Output data rate of the samples
+    :return: The results
+    """
+
+    from array import array
+    from IMU.events import EventStage
+
+    stage = EventStage(odr_hz)
+    stage.open(directory)
+    durations = []
+    for offset, burst in enumerate(fifo_bursts(bursts)):
+        samples = array("h")
+        samples.frombytes(burst)
+        start = time.perf_counter()
+        stage.process(samples, offset * BURST_SAMPLES)
+        durations.append(time.perf_counter() - start)
+    metadata = stage.close()
+    return {"samples_per_second": BURST_SAMPLES * len(durations) / sum(durations),
+            "us_per_sample": sum(durations) / (BURST_SAMPLES * len(durations)) * 1e6,
+            "burst": percentiles(durations), "events": metadata["events"]}
+
+
+def bench_summary(directory, bursts=200, odr_hz=833):
+    """
+    Per sample cost of the summary pyramid and the time to read a plot of a whole trial from it
+
+    :param directory: Directory for the outputs
+    :param bursts: Number of bursts
+    :param odr_hz: Output data rate of the samples
+    :return: The results
+    """
+
+    from array import array
+    from IMU.summary import SummaryStage
+    from data_loader.summary import SummaryReader
+
+    stage = SummaryStage(odr_hz)
+    stage.open(directory)
+    durations = []
+    for offset, burst in enumerate(fifo_bursts(bursts)):
+        samples = array("h")
+        samples.frombytes(burst)
+        start = time.perf_counter()
+        stage.process(samples, offset * BURST_SAMPLES)
+        durations.append(time.perf_counter() - start)
+    stage.close()
+
+    start = time.perf_counter()
+    plot = SummaryReader(directory).read(width_px=1000)
+    read_seconds = time.perf_counter() - start
+    return {"samples_per_second": BURST_SAMPLES * len(durations) / sum(durations),
+            "us_per_sample": sum(durations) / (BURST_SAMPLES * len(durations)) * 1e6,
+            "burst": percentiles(durations), "file_bytes": os.path.getsize(os.path.join(directory, stage.file_name)),
+            "read_ms": read_seconds * 1000, "read_bins": len(plot["time_s"])}
+
+
+def search_max_odr(directory, probe_seconds=5.0, start_hz=833, max_hz=200_000, tolerance=0.05):
+    """
+    Find the highest IMU output data rate that the acquisition sustains without losing samples. Each probe runs a
+    trial end to end through the DataHandler with the simulated devices
+
+    :param directory: Directory for the trials
+    :param probe_seconds: Length of each trial
+    :param start_hz: First rate to try
+    :param max_hz: Highest rate to try
+    :param tolerance: Relative width of the final interval
+    :return: The results
+    """
+
+    probes = []
+
+    def sustained(odr_hz):
+        summary = simulator_run.run(duration=probe_seconds, odr_hz=odr_hz, data_dir=directory)
+        shutil.rmtree(summary["trial_dir"], ignore_errors=True)
+        ok = summary["imu_samples_dropped"] == 0 and not summary["imu_fifo_overruns"]
+        probes.append({"odr_hz": odr_hz, "sustained": ok, "samples": summary["imu_samples"],
+                       "dropped": summary["imu_samples_dropped"],
+                       "cpu_utilization": summary["power"]["cpu_utilization"]})
+        return ok
+
+    # Grow until the pipeline falls behind, then bisect
+    low, high = 0, None
+    odr = start_hz
+    while odr <= max_hz:
+        if not sustained(odr):
+            high = odr
+            break
+        low = odr
+        odr *= 2
+    if high is not None and low:
+        while (high - low) / low > tolerance:
+            middle = round((low + high) / 2)
+            if sustained(middle):
+                low = middle
+            else:
+                high = middle
+
+    return {"max_sustained_odr_hz": low, "first_failing_odr_hz": high, "probe_seconds": probe_seconds,
+            "sensor_max_odr_hz": max(simulation.imu.FIFO_ODR.values()), "probes": probes}
+
+
+def bench_gil_contention(directory, probe_seconds=5.0, hold_ms=50):
+    """
+    Delay of the IMU FIFO reads while another thread of the application holds the GIL in long calls, like a large
+    pickle.dump or a render, with the IMU read in a thread and in a child process
+
+    :param directory: Directory for the trials
+    :param probe_seconds: Length of each trial
+    :param hold_ms: Approximate length of each call holding the GIL
+    :return: The results
+    """
+
+    # Size the payload to the hold time on this machine
+    payload = list(range(10000))
+    start = time.perf_counter()
+    pickle.dumps(payload)
+    payload = list(range(int(10000 * hold_ms / 1000 / max(time.perf_counter() - start, 1e-6))))
+
+    results = {}
+    for mode in ("thread", "process"):
+        stop = threading.Event()
+        holds = []
+
+        def hog():
+            while not stop.is_set():
+                call_start = time.perf_counter()
+                pickle.dumps(payload)
+                holds.append(time.perf_counter() - call_start)
+
+        hog_thread = threading.Thread(target=hog, daemon=True)
+        hog_thread.start()
+        try:
+            summary = simulator_run.run(duration=probe_seconds, data_dir=directory, imu_process=mode == "process")
+        finally:
+            stop.set()
+            hog_thread.join()
+        shutil.rmtree(summary["trial_dir"], ignore_errors=True)
+        results[mode] = {"read_lag_ms": summary["read_lag_ms"], "fifo_overruns": summary["imu_fifo_overruns"],
+                         "samples": summary["imu_samples"], "samples_dropped": summary["imu_samples_dropped"],
+                         "gil_hold": percentiles(holds)}
+    return results
+
+
+def bench_telemetry(seconds=5.0, odr_hz=833, subscribers=(0, 1, 4)):
+    """
+    CPU cost of the live telemetry stream with no, one and several listeners, fed with bursts at the pace of the IMU.
+    One of the listeners never reads, on loopback the kernel drops its datagrams at the receiver and the server sees
+    no difference. The backpressure run publishes the bursts as fast as the stage takes them to a server that sends
+    only once a second with short queues, so that the queues overflow and drop their oldest messages, and reports the
+    time the stage takes per burst
+
+    :param seconds: Length of each run
+    :param odr_hz: Output data rate of the samples
+    :param subscribers: Numbers of listeners to measure
+    :return: The results
+    """
+
+    import socket
+    from array import array
+    import metrics
+    from telemetry import TelemetryServer, TelemetryStage
+
+    bursts = []
+    for burst in fifo_bursts(50):
+        samples = array("h")
+        samples.frombytes(burst)
+        bursts.append(samples)
+
+    results = {}
+    for count in subscribers:
+        server = TelemetryServer(port=0, registry=metrics.MetricsRegistry())
+        server.start()
+        stage = TelemetryStage(odr_hz, context={"telemetry": server})
+        stage.open(None)
+
+        listeners = []
+        for i in range(count):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            listener.bind(("127.0.0.1", 0))
+            listener.settimeout(0.01)
+            listener.sendto(b"subscribe", ("127.0.0.1", server.port))
+            # The last listener never reads
+            listeners.append((listener, i < count - 1 or count == 1))
+        while len(server.subscribers) < count:
+            time.sleep(0.01)
+
+        received = [0] * count
+        stop = threading.Event()
+
+        def read():
+            while not stop.is_set():
+                for index, (listener, reads) in enumerate(listeners):
+                    if not reads:
+                        continue
+                    try:
+                        while True:
+                            listener.recv(65536)
+                            received[index] += 1
+                    except (socket.timeout, BlockingIOError):
+                        pass
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        stage_cpu = 0.0
+        interval = BURST_SAMPLES / odr_hz
+        start = time.monotonic()
+        offset = 0
+        while time.monotonic() - start < seconds:
+            samples = bursts[offset % len(bursts)]
+            cpu_start = time.thread_time()
+            stage.process(samples, offset * BURST_SAMPLES)
+            stage_cpu += time.thread_time() - cpu_start
+            offset += 1
+            time.sleep(max(0.0, start + offset * interval - time.monotonic()))
+        elapsed = time.monotonic() - start
+
+        stats = server.stats()
+        server.stop()
+        stop.set()
+        reader.join()
+        for listener, _ in listeners:
+            listener.close()
+        results[f"{count}_subscribers"] = {
+            "cpu_percent": (stage_cpu + server.cpu_seconds) / elapsed * 100,
+            "stage_cpu_percent": stage_cpu / elapsed * 100, "server_cpu_percent": server.cpu_seconds / elapsed * 100,
+            "messages_received": received, "listeners": stats}
+
+    # Publishing faster than the server sends
+    server = TelemetryServer(port=0, registry=metrics.MetricsRegistry(), queue_size=8, interval=1.0)
+    server.start()
+    stage = TelemetryStage(odr_hz, context={"telemetry": server})
+    stage.open(None)
+    listeners = []
+    for _ in range(2):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.sendto(b"subscribe", ("127.0.0.1", server.port))
+        listeners.append(listener)
+    while len(server.subscribers) < len(listeners):
+        time.sleep(0.01)
+
+    durations = []
+    start = time.monotonic()
+    offset = 0
+    while time.monotonic() - start < seconds:
+        process_start = time.perf_counter()
+        stage.process(bursts[offset % len(bursts)], offset * BURST_SAMPLES)
+        durations.append(time.perf_counter() - process_start)
+        offset += 1
+    elapsed = time.monotonic() - start
+    stats = server.stats()
+    server.stop()
+    for listener in listeners:
+        listener.close()
+    results["backpressure"] = {
+        "bursts_per_second": offset / elapsed, "stage": percentiles(durations), "listeners": stats,
+        "dropped": sum(listener["dropped"] for listener in stats.values())}
+    return results
+
+
+def bench_gps_config(seconds=2.0, rates_hz=(10, 18, 25), baudrate=115200):
+    """
+    UART load of the GPS receiver at high measurement rates, with the default NMEA output and with the output pruned
+    to what gpsd needs. The receiver is the pty based fake, configured from its factory defaults by the
+    GPSCommandSender
+
+    :param seconds: Time the output is read for at each rate
+    :param rates_hz: Measurement rates
+    :param baudrate: Baud rate of the receiver UART
+    :return: The results
+    """
+
+    import serial
+    from simulator.ubx_receiver import FakeReceiver
+    from GPS.gpsdevice import GPSCommandSender
+
+    results = {}
+    state_directory = tempfile.mkdtemp(prefix="drivesense-gps-")
+    try:
+        for rate_hz in rates_hz:
+            rate_ms = round(1000 / rate_hz)
+            for prune in (False, True):
+                receiver = FakeReceiver().start()
+                name = f"{rate_hz}hz_{'pruned' if prune else 'default'}"
+                sender = GPSCommandSender(port=receiver.port, state_file=os.path.join(state_directory, name + ".json"),
+                                          manage_gpsd=False)
+                start = time.perf_counter()
+                verified = sender.configure(rate_ms=rate_ms, baudrate=baudrate,
+                                            messages=GPSCommandSender.daq_messages(rate_ms) if prune else None)
+                configure_seconds = time.perf_counter() - start
+                sender.close()
+
+                with serial.Serial(receiver.port, baudrate, timeout=0.05) as ser:
+                    ser.reset_input_buffer()
+                    epochs, dropped = receiver.epochs, receiver.bytes_dropped
+                    start = time.monotonic()
+                    data = bytearray()
+                    while time.monotonic() - start < seconds:
+                        data += ser.read(4096)
+                    elapsed = time.monotonic() - start
+                receiver.stop()
+                results[name] = {
+                    "verified": verified, "configure_seconds": configure_seconds,
+                    "solutions_per_second": (receiver.epochs - epochs) / elapsed,
+                    "fixes_per_second": data.count(b"GGA,") / elapsed,
+                    "uart_utilization": len(data) / elapsed / (baudrate / 10),
+                    "bytes_dropped": receiver.bytes_dropped - dropped}
+    finally:
+        shutil.rmtree(state_directory, ignore_errors=True)
+    return results
+
+
+# The frames of the commands as they were written out by hand before the UBX builders, the builders must not drift
+# from them
+UBX_COMMAND_FRAMES = {
+    "reset": b"\xb5\x62\x06\x04\x04\x00\xff\xff\x02\x00\x0e\x61",
+    "rate-2": b"\xB5\x62\x06\x08\x06\x00\xF4\x01\x01\x00\x01\x00\x0B\x77",
+    "rate-5": b"\xB5\x62\x06\x08\x06\x00\xC8\x00\x01\x00\x01\x00\xDE\x6A",
+    "rate-10": b"\xB5\x62\x06\x08\x06\x00\x64\x00\x01\x00\x01\x00\x7A\x12",
+    "baud-115200": b"\xB5\x62\x06\x00\x14\x00\x01\x00\x00\x00\xD0\x08\x00\x00\x00\xC2\x01\x00\x07\x00\x03\x00\x00"
+                   b"\x00\x00\x00\xC0\x7E",
+    "baud-9600": b"\xB5\x62\x06\x00\x14\x00\x01\x00\x00\x00\xD0\x08\x00\x00\x80\x25\x00\x00\x07\x00\x03\x00\x00"
+                 b"\x00\x00\x00\xA2\xB5",
+    "sleep": b"\xB5\x62\x06\x57\x08\x00\x01\x00\x00\x00\x50\x4F\x54\x53\xAC\x85",
+    "wake": b"\xB5\x62\x06\x57\x08\x00\x01\x00\x00\x00\x20\x4E\x55\x52\x7B\xC3",
+}
+
+
+def bench_ubx_frames(repeat=1000):
+    """
+    Check of the GPS commands against their known frames, and the cost of building them. The run fails if a frame
+    differs
+
+    :param repeat: Times each frame is built
+    :return: The results
+    """
+
+    from GPS.gpsdevice import GPSCommandSender
+
+    mismatched = [ctype for ctype, frame in UBX_COMMAND_FRAMES.items()
+                  if GPSCommandSender.command_frame(ctype) != frame]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for ctype in UBX_COMMAND_FRAMES:
+            GPSCommandSender.command_frame(ctype)
+    elapsed = time.perf_counter() - start
+    return {"frames": len(UBX_COMMAND_FRAMES), "identical": not mismatched, "mismatched": mismatched,
+            "build_us": elapsed / (repeat * len(UBX_COMMAND_FRAMES)) * 1e6}
+
+
+def bench_commands(directory, hold_seconds=3.2, record_seconds=2.0):
+    """
+    Latency of the button commands of the DataHandler, with the buttons driven through mock pins: from the button
+    event to the acknowledgement of the command, and the wait for the DAQ worker. A copy is requested during the
+    trial and refused, the status press after the stop waits behind the arming of the next trial
+
+    :param directory: Directory for the trials
+    :param hold_seconds: Length of a held press, the buttons need 3 s
+    :param record_seconds: Length of the trial
+    :return: The results
+    """
+
+    from gpiozero import Device
+    from display.ssd1306 import Display
+    from display.service import DisplayService
+    from data_handler import DataHandler
+
+    simulation.start_gpsd()
+    display = DisplayService(Display())
+    display.start()
+    handler = DataHandler(display=display, gps_fix_state=[0], save_location=directory,
+                          profile_file=os.path.join(directory, "profile.json"))
+    handler.initialize()
+    daq_pin, download_pin = Device.pin_factory.pin(16), Device.pin_factory.pin(12)
+
+    def press(pin, seconds):
+        pin.drive_low()
+        time.sleep(seconds)
+        pin.drive_high()
+
+    def wait_idle(timeout=30):
+        deadline = time.monotonic() + timeout
+        while (handler.pending or handler.state != handler.IDLE) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    try:
+        wait_idle()
+        press(daq_pin, hold_seconds)
+        time.sleep(record_seconds)
+        press(download_pin, hold_seconds)
+        press(daq_pin, hold_seconds)
+        # Once the next trial is arming
+        time.sleep(0.2)
+        press(download_pin, 0.1)
+        wait_idle()
+    finally:
+        handler.close()
+        display.stop()
+        simulation.stop()
+
+    acks = [entry for entry in handler.command_log if "ack_ms" in entry]
+    runs = [entry for entry in handler.command_log if "wait_ms" in entry]
+    return {"ack": percentiles([entry["ack_ms"] / 1000 for entry in acks]),
+            "commands": [{"command": entry["command"], "accepted": entry["accepted"], "ack_us": entry["ack_ms"] * 1000}
+                         for entry in acks],
+            "runs": [{"command": entry["command"], "wait_ms": entry["wait_ms"], "run_ms": entry["run_ms"]}
+                     for entry in runs],
+            "transitions": [(entry["from"], entry["to"], entry["command"]) for entry in handler.transitions],
+            "rejected": handler.rejected_total.value}
+
+
+def bench_analytics(directory, trials=16, seconds=120, odr_hz=833):
+    """
+    Batch analytics of a copied collection: the trials per second with 1, 2 and 4 worker processes up to the number
+    of CPUs, and a run again from the cache, with the modification times unchanged and after the files were touched
+
+    :param directory: Directory for the collection
+    :param trials: Number of trials
+    :param seconds: Length of each trial
+    :param odr_hz: IMU output data rate of the trials
+    :return: The results
+    """
+
+    from data_loader.analytics import analyze_collection
+
+    collection = os.path.join(directory, "uw-sensor-data")
+    block = b"".join(IMUPoller.decode(burst) for burst in fifo_bursts(20))
+    samples_per_block = block.count(b"\n")
+    gps = [GpsdRecord(r) for r in synthetic_records(seconds=seconds)]
+    for n in range(1, trials + 1):
+        trial_dir = os.path.join(collection, f"trial-{n}")
+        os.makedirs(trial_dir, exist_ok=True)
+        blocks = int(seconds * odr_hz / samples_per_block)
+        with open(os.path.join(trial_dir, "imu.dat"), "wb") as fh:
+            fh.write(b"gx,gy,gz,ax_g,ay_g,az_g\n")
+            for _ in range(blocks):
+                fh.write(block)
+        with open(os.path.join(trial_dir, "gps.dat"), "wb") as fh:
+            for record in gps:
+                pickle.dump(record, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        utils.write_metadata(trial_dir, "imu", {"elapsed_time": seconds, "odr_hz": odr_hz,
+                                                "samples": blocks * samples_per_block, "fifo_overruns": 0})
+        utils.write_metadata(trial_dir, "gps", {"elapsed_time": seconds})
+
+    cpus = os.cpu_count() or 1
+    runs = []
+    for jobs in sorted({1, min(2, cpus), min(4, cpus), cpus}):
+        _, stats = analyze_collection(collection, jobs=jobs)
+        runs.append({"jobs": jobs, "seconds": stats["seconds"], "trials_per_second": trials / stats["seconds"],
+                     "speedup": runs[0]["seconds"] / stats["seconds"] if runs else 1.0})
+
+    cache_dir = os.path.join(directory, "analytics-cache")
+    analyze_collection(collection, cache_dir=cache_dir)
+    _, cached = analyze_collection(collection, cache_dir=cache_dir)
+    for n in range(1, trials + 1):
+        os.utime(os.path.join(collection, f"trial-{n}", "imu.dat"))
+    _, hashed = analyze_collection(collection, cache_dir=cache_dir)
+    shutil.rmtree(collection, ignore_errors=True)
+    return {"trials": trials, "imu_megabytes_per_trial": len(block) * blocks / 1e6, "cpus": cpus, "runs": runs,
+            "cached_seconds": cached["seconds"], "touched_seconds": hashed["seconds"], "touched_hashed": hashed["hashed"]}
+
+
+BENCHMARKS = ["fifo_decode", "writer", "gps_serialization", "copy", "display_render", "orientation", "events",
+              "summary", "gil_contention", "upload", "telemetry", "ubx_frames", "gps_config", "commands",
+              "analytics", "max_odr"]
+
+
+def environment():
+    """
+    Description of the machine and the code that was benchmarked
+
+    :return: A dict
+    """
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+            "machine": platform.machine(), "platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+
+def run(selected=BENCHMARKS, probe_seconds=5.0):
+    """
+    Run the benchmarks
+
+    :param selected: Names of the benchmarks to run
+    :param probe_seconds: Length of each trial of the ODR search
+    :return: A dict with the environment and the results
+    """
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix="drivesense-bench-")
+    try:
+        for name in selected:
+            start = time.perf_counter()
+            if name == "fifo_decode":
+                results[name] = bench_fifo_decode()
+            elif name == "writer":
+                results[name] = bench_writer(directory)
+            elif name == "gps_serialization":
+                results[name] = bench_gps_serialization(directory)
+            elif name == "copy":
+                if not os.path.exists(os.path.join(directory, "gps.dat")):
+                    bench_gps_serialization(directory)
+                results[name] = bench_copy(directory)
+            elif name == "upload":
+                results[name] = bench_upload(directory)
+            elif name == "display_render":
+                results[name] = bench_display_render()
+            elif name == "orientation":
+                results[name] = bench_orientation(directory)
+            elif name == "events":
+                results[name] = bench_events(directory)
+            elif name == "summary":
+                results[name] = bench_summary(directory)
+            elif name == "telemetry":
+                results[name] = bench_telemetry(seconds=probe_seconds)
+            elif name == "ubx_frames":
+                results[name] = bench_ubx_frames()
+            elif name == "gps_config":
+                results[name] = bench_gps_config()
+            elif name == "commands":
+                results[name] = bench_commands(directory)
+            elif name == "analytics":
+                results[name] = bench_analytics(directory)
+            elif name == "gil_contention":
+                results[name] = bench_gil_contention(directory, probe_seconds=probe_seconds)
+            elif name == "max_odr":
+                results[name] = search_max_odr(directory, probe_seconds=probe_seconds)
+            logging.getLogger("benchmarks").info(f"{name} done in {time.perf_counter() - start:.1f} s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {"environment": environment(), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the acquisition pipeline with the simulated devices")
+    parser.add_argument("benchmarks", nargs="*", help=f"Benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--probe-seconds", type=float, default=5.0, help="Trial length of the ODR search")
+    parser.add_argument("-o", "--output", default=None, help="Write the results to a JSON file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log the progress to stderr")
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    report = run(args.benchmarks or BENCHMARKS, probe_seconds=args.probe_seconds)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(output + "\n")
+    print(output)
+
+    # The benchmarks that check the code fail the run
+    mismatched = report["results"].get("ubx_frames", {}).get("mismatched")
+    if mismatched:
+        parser.exit(1, f"UBX frames differ from the known frames: {', '.join(mismatched)}\n")
+
+
+if __name__ == "__main__":
+    main()
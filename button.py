@@ -1,5 +1,9 @@
 from gpiozero import Button
 import time
+import hal
+
+# Mock pins for the simulated hardware
+hal.button_pin_factory()
 
 
 class ButtonHandler:
@@ -8,7 +12,7 @@ class ButtonHandler:
     """
 
     def __init__(self, pin, press_duration, on_button_held_callback=None, on_button_released_callback=None,
-                 release_required=True):
+                 release_required=True, on_button_pressed_callback=None):
         self.button = Button(pin)
         self.button_press_time = 0
         self.press_duration = press_duration
@@ -18,6 +22,7 @@ class ButtonHandler:
         # Callbacks
         self.on_button_held_callback = on_button_held_callback
         self.on_button_released_callback = on_button_released_callback
+        self.on_button_pressed_callback = on_button_pressed_callback
 
         # Attach to press and release events
         self.button.when_pressed = self.button_pressed
@@ -31,6 +36,8 @@ class ButtonHandler:
         """
 
         self.button_press_time = time.monotonic()
+        if self.on_button_pressed_callback:
+            self.on_button_pressed_callback()
 
     def button_released(self):
         """
@@ -42,10 +49,10 @@ class ButtonHandler:
         press_duration = time.monotonic() - self.button_press_time
         if not self.button_held and press_duration > self.press_duration:
             self.button_held = True
-            self.on_button_held()
+            accepted = self.on_button_held()
 
-            # If release not required
-            if not self.release_required:
+            # If release not required, or the action was refused
+            if not self.release_required or accepted is False:
                 self.button_held = False
 
         elif self.button_held and press_duration > self.press_duration:
@@ -56,11 +63,12 @@ class ButtonHandler:
         """
         Called when the button push is registered to be valid
 
-        :return: None
+        :return: The result of the callback, False if the action was refused
         """
 
         if self.on_button_held_callback:
-            self.on_button_held_callback()
+            return self.on_button_held_callback()
+        return None
 
     def on_button_released(self):
         """
@@ -72,6 +80,15 @@ class ButtonHandler:
         if self.on_button_released_callback:
             self.on_button_released_callback()
 
+    def reset(self):
+        """
+        Forget that the button is held, e.g. when the action it started was ended otherwise
+
+        :return: None
+        """
+
+        self.button_held = False
+
     def deactivate(self):
         """
         Deactivate press and release
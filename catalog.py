@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+class TrialCatalog:
+    """
+    Index of the trials on the SD card in an SQLite database next to the trials. It allocates the trial ids and keeps
+    the state, size, duration and sample count of every trial, so that nothing has to scan the data directory. The
+    catalog is rebuilt from the trial directories if it is lost or corrupt
+    """
+
+    FILE_NAME = "catalog.db"
+    PREFIX = "trial-"
+
+    # States of a trial
+    RECORDING = "recording"
+    COMPLETE = "complete"
+    COPIED = "copied"
+    PRUNED = "pruned"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS trials (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            state TEXT NOT NULL,
+            started_at REAL,
+            stopped_at REAL,
+            duration_s REAL,
+            size_bytes INTEGER NOT NULL DEFAULT 0,
+            samples INTEGER NOT NULL DEFAULT 0,
+            copied_to TEXT,
+            copied_at REAL,
+            uploaded_to TEXT,
+            uploaded_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS trials_state ON trials (state, size_bytes);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+
+    # Columns added after the first version of the schema
+    COLUMNS = {"uploaded_to": "TEXT", "uploaded_at": "REAL"}
+
+    def __init__(self, save_location="/sensor_data", path=None):
+        """
+        :param save_location: The directory of the trials
+        :param path: Path to the database, catalog.db in the directory of the trials by default
+        """
+
+        self.save_location = save_location
+        self.path = path if path is not None else os.path.join(save_location, self.FILE_NAME)
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        os.makedirs(save_location, exist_ok=True)
+        try:
+            self.connection = self.connect()
+        except sqlite3.DatabaseError as e:
+            self.logger.error(f"Trial catalog {self.path} is corrupt, rebuilding: {e}")
+            os.replace(self.path, self.path + ".corrupt")
+            self.connection = self.connect(rebuild=True)
+
+    def connect(self, rebuild=False):
+        """
+        Open the database, creating and filling it from the trial directories if it does not exist
+
+        :param rebuild: Rebuild the catalog even if the database exists
+        :return: The connection
+        """
+
+        rebuild = rebuild or not os.path.exists(self.path)
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            connection.execute("PRAGMA synchronous=NORMAL")
+            # A damaged file can still open, quick_check reports what it found instead of raising
+            result = connection.execute("PRAGMA quick_check").fetchone()[0]
+            if result != "ok":
+                raise sqlite3.DatabaseError(f"quick_check failed: {result}")
+            connection.executescript(self.SCHEMA)
+            existing = {row[1] for row in connection.execute("PRAGMA table_info(trials)")}
+            for column, kind in self.COLUMNS.items():
+                if column not in existing:
+                    connection.execute(f"ALTER TABLE trials ADD COLUMN {column} {kind}")
+        except sqlite3.DatabaseError:
+            # Closed before the file is moved away
+            connection.close()
+            raise
+        self.connection = connection
+        if rebuild:
+            self.rebuild()
+        else:
+            # Trials that were recording when the power was lost, dropped if nothing was written
+            for row in connection.execute("SELECT name FROM trials WHERE state = ?", (self.RECORDING,)).fetchall():
+                if os.path.isdir(os.path.join(self.save_location, row["name"])):
+                    self.finish_trial(row["name"])
+                else:
+                    connection.execute("DELETE FROM trials WHERE name = ?", (row["name"],))
+        return connection
+
+    def trial_id(self, name):
+        return int(name[len(self.PREFIX):])
+
+    def trial_stats(self, name):
+        """
+        Size, duration and number of samples of a trial from its files
+
+        :param name: Name of the trial directory
+        :return: A tuple of the size in bytes, the duration in seconds and the number of samples
+        """
+
+        size, duration, samples = 0, None, 0
+        trial_dir = os.path.join(self.save_location, name)
+        for root, _, files in os.walk(trial_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                size += os.path.getsize(path)
+                if file_name.endswith(".meta"):
+                    try:
+                        with open(path, "r") as fh:
+                            metadata = json.loads(fh.readline())
+                    except (OSError, ValueError):
+                        continue
+                    if metadata.get("elapsed_time") is not None:
+                        duration = max(duration or 0.0, metadata["elapsed_time"])
+                    samples += metadata.get("samples") or 0
+        return size, duration, samples
+
+    def rebuild(self):
+        """
+        Bring the catalog in line with the trial directories. Trials on the card are added or updated, trials that are
+        gone and were not copied or uploaded are removed
+
+        :return: Number of trials on the card
+        """
+
+        names = [entry.name for entry in os.scandir(self.save_location)
+                 if entry.is_dir() and entry.name.startswith(self.PREFIX) and entry.name[len(self.PREFIX):].isdigit()]
+        with self.lock:
+            known = {row["name"]: row["state"] for row in self.connection.execute("SELECT name, state FROM trials")}
+            self.connection.execute("BEGIN")
+            for name in names:
+                size, duration, samples = self.trial_stats(name)
+                state = known.get(name, self.COMPLETE)
+                if state == self.RECORDING:
+                    state = self.COMPLETE
+                self.connection.execute(
+                    "INSERT INTO trials (id, name, state, started_at, duration_s, size_bytes, samples) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (name) DO UPDATE SET state = excluded.state, "
+                    "duration_s = excluded.duration_s, size_bytes = excluded.size_bytes, samples = excluded.samples",
+                    (self.trial_id(name), name, state, os.path.getmtime(os.path.join(self.save_location, name)),
+                     duration, size, samples))
+            gone = [name for name, state in known.items()
+                    if name not in names and state not in (self.COPIED, self.PRUNED)]
+            self.connection.executemany("DELETE FROM trials WHERE name = ?", [(name,) for name in gone])
+            self.set_next_id(max([self.trial_id(name) for name in names] + [self.last_id()]) + 1)
+            self.connection.execute("COMMIT")
+        self.logger.info(f"Trial catalog rebuilt, {len(names)} trials on the card")
+        return len(names)
+
+    def last_id(self):
+        row = self.connection.execute("SELECT MAX(id) FROM trials").fetchone()
+        return row[0] or 0
+
+    def set_next_id(self, next_id):
+        self.connection.execute("INSERT INTO counters (name, value) VALUES ('next_id', ?) "
+                                "ON CONFLICT (name) DO UPDATE SET value = MAX(value, excluded.value)", (next_id,))
+
+    def next_trial_name(self):
+        """
+        Name of the directory for the next trial. The id is only taken once the trial starts
+
+        :return: The directory name
+        """
+
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM counters WHERE name = 'next_id'").fetchone()
+        return self.PREFIX + str(row[0] if row is not None else 1)
+
+    def start_trial(self, name):
+        """
+        A trial started recording
+
+        :param name: Name of the trial directory
+        :return: None
+        """
+
+        trial_id = self.trial_id(name)
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.execute("INSERT OR REPLACE INTO trials (id, name, state, started_at) VALUES (?, ?, ?, ?)",
+                                    (trial_id, name, self.RECORDING, time.time()))
+            self.set_next_id(trial_id + 1)
+            self.connection.execute("COMMIT")
+
+    def finish_trial(self, name):
+        """
+        A trial stopped recording, its stats are taken from the files of the trial
+
+        :param name: Name of the trial directory
+        :return: None
+        """
+
+        size, duration, samples = self.trial_stats(name)
+        with self.lock:
+            self.connection.execute("UPDATE trials SET state = ?, stopped_at = ?, duration_s = ?, size_bytes = ?, "
+                                    "samples = ? WHERE name = ?",
+                                    (self.COMPLETE, time.time(), duration, size, samples, name))
+
+    def mark_copied(self, name, destination):
+        """
+        A trial was copied off the card and removed from it
+
+        :param name: Name of the trial directory
+        :param destination: Where the trial was copied to
+        :return: None
+        """
+
+        with self.lock:
+            self.connection.execute("UPDATE trials SET state = ?, copied_to = ?, copied_at = ? WHERE name = ?",
+                                    (self.COPIED, destination, time.time(), name))
+
+    def mark_uploaded(self, name, url):
+        """
+        A trial was uploaded to the collection server, it stays on the card until it is pruned
+
+        :param name: Name of the trial directory
+        :param url: Where the trial was uploaded to
+        :return: None
+        """
+
+        with self.lock:
+            self.connection.execute("UPDATE trials SET uploaded_to = ?, uploaded_at = ? WHERE name = ?",
+                                    (url, time.time(), name))
+
+    def mark_pruned(self, name):
+        """
+        An uploaded trial was removed from the card
+
+        :param name: Name of the trial directory
+        :return: None
+        """
+
+        with self.lock:
+            self.connection.execute("UPDATE trials SET state = ? WHERE name = ? AND uploaded_at IS NOT NULL",
+                                    (self.PRUNED, name))
+
+    def pending_upload(self):
+        """
+        Finished trials on the card that were not uploaded yet
+
+        :return: A list of dicts, oldest first
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM trials WHERE state = ? AND uploaded_at IS NULL ORDER BY id",
+                                           (self.COMPLETE,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def pending(self, min_bytes=0):
+        """
+        Finished trials that were not copied yet
+
+        :param min_bytes: Only the trials at least this large
+        :return: A list of dicts, oldest first
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM trials WHERE state = ? AND size_bytes >= ? ORDER BY id",
+                                           (self.COMPLETE, min_bytes)).fetchall()
+        return [dict(row) for row in rows]
+
+    def trials(self):
+        """
+        All the trials in the catalog
+
+        :return: A list of dicts, oldest first
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM trials ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def summary(self):
+        """
+        Counts and sizes per state
+
+        :return: A dict of the state to a dict with the number of trials, bytes and seconds of data
+        """
+
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*), SUM(size_bytes), SUM(duration_s) FROM trials "
+                                           "GROUP BY state").fetchall()
+        return {row[0]: {"trials": row[1], "bytes": row[2] or 0, "duration_s": row[3] or 0.0} for row in rows}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
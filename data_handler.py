@@ -1,14 +1,55 @@
 import time
+import queue
 import logging
 import os
+import threading
+import contextlib
+from collections import deque
 from data_loader.usb import SensorDataCopier
-from IMU.imudevice import IMUPoller
-from GPS.gpsdevice import GPSPoller
-from button import ButtonHandler
+from power import CpuGovernor
+from catalog import TrialCatalog
+from profiles import ProfileStore
+from storage import StorageMonitor, format_remaining
+import hal
+import utils
+import metrics
 
 
 class DataHandler:
-    def __init__(self, display, gps_fix_state, save_location="/sensor_data", daq_pin=16, transfer_pin=25):
+    """
+    Runs the DAQ as a state machine. The button callbacks only queue commands, which a worker thread executes in order,
+    so that the buttons stay responsive while the sensors are armed, a trial is stopped or the data is copied
+    """
+
+    # States of the DAQ
+    IDLE = "idle"
+    ARMING = "arming"
+    RECORDING = "recording"
+    STOPPING = "stopping"
+    COPYING = "copying"
+    UPDATING = "updating"
+    STATES = (IDLE, ARMING, RECORDING, STOPPING, COPYING, UPDATING)
+
+    # The states each state may change to
+    TRANSITIONS = {
+        IDLE: (ARMING, RECORDING, COPYING, UPDATING),
+        ARMING: (IDLE, RECORDING),
+        RECORDING: (STOPPING,),
+        STOPPING: (IDLE,),
+        COPYING: (IDLE,),
+        UPDATING: (IDLE,),
+    }
+
+    # Display acknowledgement of the accepted commands
+    ACKNOWLEDGEMENTS = {"start": ("DAQ", "Starting..."), "stop": ("DAQ", "Stopping..."),
+                        "copy": ("Data Copy", "Please wait...")}
+
+    def __init__(self, display, gps_fix_state, save_location="/sensor_data", daq_pin=16, transfer_pin=25,
+                 low_power=False, daq_governor="powersave", display_idle_timeout=30, sensor_config=None,
+                 imu_stages=(), imu_process=False, imu_realtime_priority=None, imu_cpu=None, upload_url=None,
+                 upload_rate_limit=None, upload_prune=False, telemetry_port=None,
+                 profile_file=ProfileStore.PROFILE_FILE, storage_floor_mb=200, storage_warn_minutes=(30, 10, 5),
+                 max_pending_commands=8):
 
         # Display
         self.display = display
@@ -18,48 +59,426 @@ class DataHandler:
         self.daq_pin = daq_pin
         self.transfer_pin = transfer_pin
 
-        # Sensors
-        self.gps_poller = None
+        # Sensors, the GPS and IMU pollers or the sources of a sensor configuration
+        self.pollers = []
+        self.sensor_config = sensor_config
+        self.imu_stages = list(imu_stages)
+        # The IMU acquisition in a process of its own
+        self.imu_process = imu_process
+        # Real time scheduling of the IMU reads, the host is left alone when simulated
+        self.imu_realtime = {"realtime_priority": imu_realtime_priority, "cpu": imu_cpu} if not hal.SIMULATED else {}
         self.gps_fix_state = gps_fix_state
-        self.configure_gps = True
-        self.imu_poller = None
+        # State shared by the sensors, e.g. the last GPS position for the IMU pipeline
+        self.sensor_context = {"gps_fix_state": gps_fix_state, "gps_position": None}
+        # There is no receiver to configure behind the simulated gpsd. The rate and baud rate it was configured for
+        self.configure_gps = not hal.SIMULATED
+        self.gps_settings = None
+
+        # Acquisition profile, read when the sensors are prepared so that a new profile applies at the next start
+        self.profiles = ProfileStore(profile_file)
+        self.armed_profile = None
+        self.trial_profile = None
+
+        # Sensors prepared for the next trial
+        self.armed = None
+        self.arm_lock = threading.Lock()
 
         # Buttons
         self.button_daq = None
         self.button_download = None
 
-        # Status
-        self.daq_status = False
-        self.copy_status = False
+        # Power
+        self.low_power = low_power
+        self.daq_governor = daq_governor
+        self.display_idle_timeout = display_idle_timeout
+        self.cpu_governor = CpuGovernor()
+
+        # State, changed by the commands only
+        self.state = self.IDLE
+        self.state_lock = threading.Lock()
+        self.transitions = deque(maxlen=100)
         self.daq_start = None
 
-        # Data Copier
+        # Commands queued for the DAQ worker, and the names of those not done yet
+        self.commands = queue.Queue(maxsize=max_pending_commands)
+        self.pending = []
+        self.command_lock = threading.Lock()
+        self.command_log = deque(maxlen=100)
+        self.worker = None
+        self.handlers = {"start": self.start_daq, "stop": self.stop_daq, "copy": self.start_copy,
+                         "status": self.show_status, "arm": self.prepare}
+
+        # Metrics
+        self.state_gauge = metrics.REGISTRY.gauge("daq_state", "State of the DAQ, an index of DataHandler.STATES")
+        self.ack_seconds = metrics.REGISTRY.histogram("daq_command_ack_seconds",
+                                                      "Button event to the acknowledgement of the command",
+                                                      buckets=(0.0001, 0.001, 0.01, 0.1))
+        self.wait_seconds = metrics.REGISTRY.histogram("daq_command_wait_seconds",
+                                                       "Time a command waited for the DAQ worker",
+                                                       buckets=(0.001, 0.01, 0.1, 1, 10))
+        self.rejected_total = metrics.REGISTRY.counter("daq_commands_rejected_total",
+                                                       "Commands refused in the state of the DAQ")
+
+        # Trials on the card
         self.save_location = save_location
-        self.data_copier = SensorDataCopier(self.display, save_location)
+        self.catalog = TrialCatalog(save_location)
+        self.trial_name = None
 
-    def initialize(self):
+        # Free space on the card during the trials
+        self.storage = StorageMonitor(save_location, floor_mb=storage_floor_mb, warn_minutes=storage_warn_minutes,
+                                      on_warning=self.storage_warning, on_floor=self.storage_full)
+
+        # Data Copier
+        self.data_copier = SensorDataCopier(self.display, save_location, catalog=self.catalog, profiles=self.profiles)
+
+        # Upload to the collection server while idle
+        self.uploader = None
+        if upload_url:
+            from data_loader.upload import TrialUploader
+            self.uploader = TrialUploader(self.catalog, upload_url, save_location=save_location,
+                                          rate_limit=upload_rate_limit, prune=upload_prune,
+                                          can_upload=lambda: self.state in (self.IDLE, self.ARMING))
+
+        # Live stream of the sensors over UDP
+        self.telemetry = None
+        if telemetry_port is not None:
+            from telemetry import TelemetryServer
+            self.telemetry = TelemetryServer(port=telemetry_port, context=self.sensor_context)
+            self.sensor_context["telemetry"] = self.telemetry
+            if "telemetry" not in self.imu_stages:
+                self.imu_stages.append("telemetry")
+
+    def initialize(self, profiler=None):
 
         """
         Initializing the button for operation
 
+        :param profiler: Optional startup profiler to time the phases
         :return: None
         """
 
+        def phase(name):
+            return profiler.phase(name) if profiler is not None else contextlib.nullcontext()
+
+        # GPIO stack
+        with phase("gpio init"):
+            from button import ButtonHandler
+
         # Buttons
-        self.button_daq = ButtonHandler(pin=16, on_button_held_callback=self.start_daq,
-                                        on_button_released_callback=self.stop_daq, press_duration=3)
-        self.button_download = ButtonHandler(pin=12, on_button_held_callback=self.start_copy,
-                                             on_button_released_callback=None, press_duration=3, release_required=False)
-        # Display ready status
-        self.display.display_system_props()
+        with phase("button arm"):
+            self.button_daq = ButtonHandler(pin=16, on_button_held_callback=lambda: self.submit("start"),
+                                            on_button_released_callback=lambda: self.submit("stop"), press_duration=3)
+            self.button_download = ButtonHandler(pin=12, on_button_held_callback=lambda: self.submit("copy"),
+                                                 on_button_released_callback=None, press_duration=3,
+                                                 release_required=False,
+                                                 on_button_pressed_callback=lambda: self.submit("status"))
 
         # Display ready status
         self.display.display_centered_text("Ready")
 
+        # Prepare the sensors in the background
+        self.arm_async()
+
+        if self.uploader is not None:
+            self.uploader.start()
+
+        if self.telemetry is not None:
+            self.telemetry.start()
+
+    @property
+    def daq_status(self):
+        return self.state == self.RECORDING
+
+    @property
+    def copy_status(self):
+        return self.state in (self.COPYING, self.UPDATING)
+
+    def transition(self, state, command=None):
+
+        """
+        Change the state of the DAQ, if the current state allows it
+
+        :param state: The new state
+        :param command: The command causing the change, for the log
+        :return: True, if the state changed
+        """
+
+        with self.state_lock:
+            previous = self.state
+            if state not in self.TRANSITIONS[previous]:
+                self.logger.warning(f"Refused the transition {previous} -> {state} ({command})")
+                return False
+            self.state = state
+            self.transitions.append({"time": time.time(), "from": previous, "to": state, "command": command})
+        self.state_gauge.set(self.STATES.index(state))
+        self.logger.info(f"DAQ {previous} -> {state} ({command})")
+        return True
+
+    def check_command(self, command):
+
+        """
+        Check a command against the state the DAQ is in once the queued commands are done
+
+        :param command: The command
+        :return: None if the command is accepted, else the reason as the header and status to display, or None
+            for the commands that are ignored silently
+        """
+
+        if command not in self.handlers:
+            raise ValueError(f"Unknown command {command}, expected one of {', '.join(self.handlers)}")
+        recording = self.state == self.RECORDING
+        for pending in self.pending:
+            recording = {"start": True, "stop": False}.get(pending, recording)
+        busy = self.state in (self.COPYING, self.UPDATING) or "copy" in self.pending
+
+        if command == "start":
+            if busy:
+                return "DAQ", "Copying! Be Patient"
+            if recording:
+                return None, None
+        elif command == "stop" and not recording:
+            return None, None
+        elif command == "copy":
+            if recording:
+                self.logger.warning("Tried copying when the DAQ is running.")
+                return "Data Copy", "Cannot Copy. Stop DAQ"
+            if busy:
+                return None, None
+        return None
+
+    def submit(self, command, **options):
+
+        """
+        Queue a command for the DAQ worker, e.g. from a button callback. Returns right away, the command is checked
+        against the state and acknowledged on the display without waiting for the worker
+
+        :param command: One of start, stop, copy, status or arm
+        :param options: Keyword arguments of the command
+        :return: True, if the command was queued
+        """
+
+        submitted = time.monotonic()
+        with self.command_lock:
+            rejection = self.check_command(command)
+            if rejection is None:
+                try:
+                    self.commands.put_nowait((command, options, submitted))
+                    self.pending.append(command)
+                except queue.Full:
+                    rejection = ("DAQ", "Busy! Try again")
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run_commands, name="DAQWorker", daemon=True)
+                self.worker.start()
+
+        if rejection is not None:
+            self.rejected_total.inc()
+            header, status = rejection
+            if status is not None:
+                self.display.display_header_and_status(header, status)
+            self.logger.info(f"Command {command} refused in the {self.state} state")
+        elif command in self.ACKNOWLEDGEMENTS:
+            self.display.display_header_and_status(*self.ACKNOWLEDGEMENTS[command])
+        ack = time.monotonic() - submitted
+        self.ack_seconds.observe(ack)
+        self.command_log.append({"command": command, "time": time.time(), "accepted": rejection is None,
+                                 "ack_ms": ack * 1000})
+        return rejection is None
+
+    def run_commands(self):
+
+        """
+        The DAQ worker, executes the queued commands in order
+
+        :return: None
+        """
+
+        while True:
+            item = self.commands.get()
+            if item is None:
+                break
+            command, options, submitted = item
+            started = time.monotonic()
+            self.wait_seconds.observe(started - submitted)
+            try:
+                self.handlers[command](**options)
+            except Exception as e:
+                self.logger.error(f"Error executing the {command} command: {e}")
+            finally:
+                with self.command_lock:
+                    self.pending.remove(command)
+            self.command_log.append({"command": command, "time": time.time(), "wait_ms": (started - submitted) * 1000,
+                                     "run_ms": (time.monotonic() - started) * 1000})
+
+    def close(self):
+
+        """
+        Stop the DAQ worker once the queued commands are done and release the armed sensors
+
+        :return: None
+        """
+
+        with self.command_lock:
+            worker, self.worker = self.worker, None
+        if worker is not None:
+            self.commands.put(None)
+            worker.join()
+        self.disarm()
+
+    def next_trial_dir(self):
+
+        """
+        Name of the directory for the next trial
+
+        :return: The directory name
+        """
+
+        return self.catalog.next_trial_name()
+
+    def uses_sensor_config(self):
+
+        """
+        Whether the sensors are taken from a sensor configuration file instead of the acquisition profile
+
+        :return: True, if the configuration file exists
+        """
+
+        return self.sensor_config is not None and os.path.exists(self.sensor_config)
+
+    def create_pollers(self, save_dir, profile):
+
+        """
+        Create the pollers for a trial, in the order they are started
+
+        :param save_dir: Name of the trial directory
+        :param profile: The acquisition profile, not used with a sensor configuration file
+        :return: A list of pollers
+        """
+
+        # Sensor stacks are only loaded when the DAQ is first prepared
+        if self.uses_sensor_config():
+            from sensors.registry import load_config
+            from sensors.session import SensorSession
+            return [SensorSession(load_config(self.sensor_config), save_dir_time=save_dir,
+                                  save_location=self.save_location, context=self.sensor_context)]
+
+        from GPS.gpsdevice import GPSPoller
+        from IMU.lsm6dsl import LSM6DSL
+        if self.imu_process:
+            from IMU.process import IMUProcessPoller as IMUPoller
+        else:
+            from IMU.imudevice import IMUPoller
+        from IMU.pipeline import build_pipeline
+
+        # GPS, the receiver is configured again when the profile changes its settings
+        gps = profile["gps"]
+        gps_settings = (gps["rate_ms"], gps["baudrate"], gps["prune_nmea"], gps["save_to_flash"])
+        gps_poller = GPSPoller(save_dir_time=save_dir, configure_gps=self.configure_gps and
+                               gps_settings != self.gps_settings, gps_fix_indicator=self.gps_fix_state,
+                               save_location=self.save_location, context=self.sensor_context, rate_ms=gps["rate_ms"],
+                               baudrate=gps["baudrate"], record_format=gps["format"], prune_nmea=gps["prune_nmea"],
+                               save_config=gps["save_to_flash"])
+        self.gps_settings = gps_settings
+        # IMU
+        imu = profile["imu"]
+        scale = (LSM6DSL.GYRO_RANGES[imu["gyro_range_dps"]][1], LSM6DSL.ACCEL_RANGES[imu["accel_range_g"]][1])
+        pipeline = build_pipeline(self.imu_stages, imu["odr_hz"], context=self.sensor_context, scale=scale)
+        writer_buffer_size = profile["writer"]["buffer_size"]
+        if writer_buffer_size is None:
+            writer_buffer_size = 64 * 1024 if self.low_power else 4096
+        imu_poller = IMUPoller(save_dir_time=save_dir, low_power=self.low_power, writer_buffer_size=writer_buffer_size,
+                               writer_flush=profile["writer"]["flush"], save_location=self.save_location,
+                               pipeline=pipeline, odr_hz=imu["odr_hz"], accel_range_g=imu["accel_range_g"],
+                               gyro_range_dps=imu["gyro_range_dps"], fifo_threshold=imu["fifo_threshold"],
+                               **self.imu_realtime)
+
+        # IMU first, it has the tighter timing
+        return [imu_poller, gps_poller]
+
+    def arm(self):
+
+        """
+        Prepare the sensors, their connections and the trial directory name, so that the DAQ start only has to flip
+        the recording flags
+
+        :return: None
+        """
+
+        with self.arm_lock:
+            if self.armed is not None:
+                return
+
+            arm_start = time.monotonic()
+            save_dir = self.next_trial_dir()
+            profile = self.profiles.load()
+            pollers = self.create_pollers(save_dir, profile)
+            for poller in pollers:
+                poller.arm()
+
+            self.armed = (save_dir, pollers)
+            self.armed_profile = profile
+            self.logger.info(f"DAQ armed for {save_dir} with the {profile['name']} profile in "
+                             f"{time.monotonic() - arm_start:.2f} s")
+
+    def disarm(self):
+
+        """
+        Release the sensors prepared for the next trial, e.g. to prepare them again for a new profile
+
+        :return: None
+        """
+
+        with self.arm_lock:
+            if self.armed is None:
+                return
+            for poller in self.armed[1]:
+                poller.stop_polling()
+            self.armed = None
+            self.armed_profile = None
+
+    def rearm_if_changed(self):
+
+        """
+        Prepare the sensors again if the acquisition profile changed since they were armed
+
+        :return: True, if the sensors are armed again
+        """
+
+        if self.armed is None or self.armed_profile == self.profiles.load():
+            return False
+        self.logger.info("The acquisition profile changed, preparing the sensors again")
+        self.disarm()
+        self.arm_async()
+        return True
+
+    def prepare(self):
+
+        """
+        The arm command, prepares the sensors while the DAQ is idle
+
+        :return: None
+        """
+
+        if self.armed is not None or not self.transition(self.ARMING, "arm"):
+            return
+        try:
+            self.arm()
+        finally:
+            self.transition(self.IDLE, "arm")
+
+    def arm_async(self):
+
+        """
+        Prepare the sensors for the next trial on the DAQ worker
+
+        :return: None
+        """
+
+        self.submit("arm")
+
     def start_daq(self):
 
         """
-        Button callback for the start of the DAQ process. GPS and IMU Polling instances are created
+        Button callback for the start of the DAQ process. The armed GPS and IMU Polling instances start recording
 
         :return:
         """
@@ -68,62 +487,181 @@ class DataHandler:
         if self.copy_status:
             self.display.display_header_and_status("DAQ", "Copying! Be Patient")
             return
+        if self.state not in (self.IDLE, self.ARMING):
+            return
 
-        # Getting the directory to save
-        dirs = os.listdir(self.save_location)
-        existing_trial_counts = [int(x[6:]) for x in dirs if x[0:6] == "trial-"]
-        if existing_trial_counts:
-            max_trial = max(existing_trial_counts)
-        else:
-            max_trial = 0
-        save_dir = "trial-" + str(max_trial + 1)
-        self.display.display_header_and_status("DAQ", f"Starting {save_dir}")
-        time.sleep(2)
+        # Keep the space the card needs to close a trial
+        if not self.storage.can_record():
+            self.display.display_header_and_status("DAQ", "Storage full!\nCopy the data")
+            self.logger.error("Not enough free space on the card to start a trial")
+            return
+
+        request_time = time.monotonic()
+
+        # Use the armed sensors, arming now if the arming failed or the profile changed since
+        if self.armed is not None and self.armed_profile != self.profiles.load():
+            self.logger.info("The acquisition profile changed, preparing the sensors again")
+            self.disarm()
+        if self.armed is None and self.state == self.IDLE:
+            self.transition(self.ARMING, "start")
+        try:
+            self.arm()
+        except Exception:
+            self.transition(self.IDLE, "start")
+            raise
+        if not self.transition(self.RECORDING, "start"):
+            return
+        save_dir, self.pollers = self.armed
+        self.trial_profile = self.armed_profile
+        self.armed = None
+        self.trial_name = save_dir
 
         # Maintain time
-        self.daq_status = True
         self.daq_start = int(time.monotonic())
 
-        # GPS
-        self.gps_poller = GPSPoller(save_dir_time=save_dir, configure_gps=self.configure_gps,
-                                    gps_fix_indicator=self.gps_fix_state)
-        self.configure_gps = False
-        self.gps_poller.start_polling()
-        # IMU
-        self.imu_poller = IMUPoller(save_dir_time=save_dir)
-        self.imu_poller.start_polling()
+        try:
+            self.catalog.start_trial(save_dir)
+            for poller in self.pollers:
+                poller.start_polling(save_dir_time=save_dir, request_time=request_time)
+            self.storage.begin_trial()
+        except Exception as e:
+            # Close what was started, the DAQ goes back to idle
+            self.logger.error(f"Error starting {save_dir}, stopping the trial: {e}")
+            self.stop_daq(reason="error")
+            raise
+        self.logger.info(f"Recording {save_dir}, start took {(time.monotonic() - request_time) * 1000:.1f} ms")
+
+        # Let the cores idle during the DAQ
+        if self.low_power:
+            # The governor of the host is left alone when simulated
+            if not hal.SIMULATED:
+                self.cpu_governor.set(self.daq_governor)
+            self.display.set_idle_timeout(self.display_idle_timeout)
 
         self.logger.info("Data collection started")
         self.display.display_header_and_status("DAQ", "DAQ In progress...",  indicator=self.gps_fix_state[0])
 
-    def stop_daq(self):
+    def show_status(self):
+
+        """
+        Button callback to show the DAQ status on demand, or the trials left to copy when idle. Wakes the display in
+        the low power mode
+
+        :return: None
+        """
+
+        if self.daq_status:
+            self.display.display_header_and_status("DAQ", self.daq_status_text(), indicator=self.gps_fix_state[0])
+        elif not self.copy_status:
+            pending = self.catalog.summary().get(TrialCatalog.COMPLETE, {"trials": 0, "bytes": 0})
+            self.display.display_header_and_status("Data", f"To copy: {pending['trials']} trials\n"
+                                                           f"{pending['bytes'] / 1e6:.0f} MB")
+
+    def daq_status_text(self):
+
+        """
+        Status of the DAQ screen, the elapsed and the remaining recording time
+
+        :return: The status text
+        """
+
+        # The trial may be stopped at the storage floor meanwhile
+        daq_start = self.daq_start
+        elapsed = time.monotonic() - daq_start if daq_start is not None else 0
+        return f"Elapsed time: {round(elapsed/60)} min\nLeft: {format_remaining(self.storage.remaining_seconds())}"
+
+    def storage_warning(self, remaining):
+
+        """
+        Storage monitor callback when the recording time left crosses a warning threshold
+
+        :param remaining: The seconds left
+        :return: None
+        """
+
+        self.display.display_header_and_status("Storage", f"Low space!\nLeft: {format_remaining(remaining)}",
+                                               indicator=self.gps_fix_state[0])
+
+    def storage_full(self, free):
+
+        """
+        Storage monitor callback at the storage floor, the trial is closed while there is space for its metadata
+
+        :param free: The free bytes
+        :return: None
+        """
+
+        self.logger.error(f"Stopping {self.trial_name} at the storage floor, {free / 1e6:.0f} MB free")
+        if self.submit("stop", reason="storage") and self.button_daq is not None:
+            # The next hold of the DAQ button starts a trial again
+            self.button_daq.reset()
+
+    def stop_daq(self, reason=None):
 
         """
         Button callback for stopping the DAQ process
 
+        :param reason: Why the trial stopped, "storage" at the storage floor, "error" if it failed, None for the button
         :return:
         """
 
         # Check for DAQ running
-        if not self.daq_status:
+        if not self.daq_status or not self.transition(self.STOPPING, "stop"):
             return
 
         self.display.display_header_and_status("DAQ", "Stopping...")
 
-        # Stop the DAQ process
-        self.gps_poller.stop_polling()
-        self.imu_poller.stop_polling()
+        try:
+            # Stop the DAQ process, a sensor that fails to stop does not keep the others running
+            for poller in reversed(self.pollers):
+                try:
+                    poller.stop_polling()
+                except Exception as e:
+                    self.logger.error(f"Error stopping {poller.__class__.__name__}: {e}")
+
+            storage = self.storage.end_trial()
+            # The profile the trial was recorded with, not applied with a sensor configuration file
+            trial_dir = os.path.join(self.save_location, self.trial_name)
+            if os.path.isdir(trial_dir):
+                if not self.uses_sensor_config():
+                    utils.write_metadata(trial_dir, "profile", self.trial_profile)
+                if storage:
+                    utils.write_metadata(trial_dir, "storage", storage)
+            self.catalog.finish_trial(self.trial_name)
+            if self.low_power:
+                for poller in self.pollers:
+                    if "power" in poller.metadata:
+                        self.logger.info(f"DAQ power estimate: {poller.metadata['power']}")
+            self.logger.info("Data collection stopped")
+        except Exception as e:
+            # E.g. the metadata not written on a full card, the trial is left as it is
+            self.logger.error(f"Error closing {self.trial_name}: {e}")
+            reason = reason or "error"
+        finally:
+            # Always back to idle, so that the next trial can start
+            self.daq_start = None
+            if self.low_power:
+                self.cpu_governor.restore()
+                self.display.set_idle_timeout(None)
+            self.transition(self.IDLE, "stop")
 
-        self.daq_status = False
-        self.daq_start = None
-        self.logger.info("Data collection stopped")
         # Display ready status
-        self.display.display_system_props()
+        if reason == "storage":
+            self.display.display_header_and_status("DAQ", "Storage full!\nTrial saved")
+        elif reason == "error":
+            self.display.display_header_and_status("DAQ", "DAQ Error!\nTrial stopped")
+        else:
+            self.display.display_system_props()
+
+        # Prepare the next trial
+        self.arm_async()
+        if self.uploader is not None:
+            self.uploader.wake()
 
     def start_copy(self):
 
         """
-        Button callback for starting the data copy
+        Button callback for starting the data copy, or the firmware update if the USB drive holds one
 
         :return:
         """
@@ -133,17 +671,17 @@ class DataHandler:
             self.logger.warning("Tried copying when the DAQ is running.")
             return
 
-        # Deactivate the DAQ Process
-        self.button_daq.deactivate()
-        self.button_download.deactivate()
-        # Copy the data
-        self.copy_status = True
-        self.data_copier.copy_sensor_data()
-        self.copy_status = False
-
-        # Display ready status
-        time.sleep(5)
-        # Reactivate the DAQ Process
-        self.button_daq.reactivate()
-        self.button_download.reactivate()
+        # The presses of the buttons are refused until the copy is done
+        if not self.transition(self.UPDATING if self.data_copier.has_fw_update() else self.COPYING, "copy"):
+            return
+        try:
+            # Copy the data
+            self.data_copier.copy_sensor_data()
+            # A profile from the USB drive applies from the next trial
+            self.rearm_if_changed()
+
+            # Display ready status
+            time.sleep(5)
+        finally:
+            self.transition(self.IDLE, "copy")
         self.display.display_system_props()
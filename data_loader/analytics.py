@@ -0,0 +1,456 @@
+import os
+import re
+import sys
+import csv
+import json
+import math
+import time
+import hashlib
+import logging
+import argparse
+import operator
+import multiprocessing
+from datetime import datetime
+from data_loader.gps_records import load_records
+
+
+# Version of the analysis, cached results of other versions are computed again
+ANALYSIS_VERSION = 1
+
+# Bytes read at once from the data files
+CHUNK_BYTES = 1024 * 1024
+
+# Output data rate of the trials recorded before the rate was kept in imu.meta
+DEFAULT_ODR_HZ = 833
+
+# Share of the expected IMU samples that may be missing before a trial is flagged
+LOSS_TOLERANCE = 0.02
+
+# Speed above which the vehicle is moving, and the width of the bins of the speed profile, in m/s
+MOVING_SPEED = 0.5
+SPEED_BIN = 5.0
+SPEED_BINS = 8
+
+EARTH_RADIUS_M = 6371000.0
+
+# Columns of the CSV output
+COLUMNS = ["trial", "duration_s", "imu_samples", "imu_odr_hz", "imu_expected_samples", "imu_loss", "imu_fifo_overruns",
+           "imu_truncated", "accel_mean_x_g", "accel_mean_y_g", "accel_mean_z_g", "vibration_rms_x_g",
+           "vibration_rms_y_g", "vibration_rms_z_g", "vibration_rms_g", "gps_fixes", "gps_max_gap_s", "distance_m",
+           "speed_mean_mps", "speed_p50_mps", "speed_p95_mps", "speed_max_mps", "moving_fraction", "speed_profile",
+           "samples_ok", "errors"]
+
+
+def natural_key(name):
+    """
+    Sort key that orders trial-2 before trial-10
+
+    :param name: The name
+    :return: The key
+    """
+
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def discover_trials(root):
+    """
+    Find the trial directories below a collection, e.g. uw-sensor-data on a USB drive
+
+    :param root: The collection directory
+    :return: The trial directories in natural order
+    """
+
+    trials = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+        if "imu.dat" in files or "gps.dat" in files:
+            trials.append(directory)
+    return sorted(trials, key=lambda path: natural_key(os.path.relpath(path, root)))
+
+
+def data_files(trial_dir):
+    """
+    The files an analysis of a trial depends on
+
+    :param trial_dir: The trial directory
+    :return: The file names
+    """
+
+    return sorted(name for name in os.listdir(trial_dir) if name.endswith((".dat", ".meta")))
+
+
+def fingerprint(trial_dir):
+    """
+    Size and modification time of the files of a trial
+
+    :param trial_dir: The trial directory
+    :return: A dict of [size, mtime_ns] by file name
+    """
+
+    files = {}
+    for name in data_files(trial_dir):
+        st = os.stat(os.path.join(trial_dir, name))
+        files[name] = [st.st_size, st.st_mtime_ns]
+    return files
+
+
+def file_hash(path):
+    """
+    SHA-256 of a file
+
+    :param path: The file
+    :return: The hex digest
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_meta(trial_dir, name):
+    try:
+        with open(os.path.join(trial_dir, name + ".meta"), "r") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def imu_stats(path, digest):
+    """
+    Count the samples of an imu.dat and sum the accelerations, hashing the file on the way
+
+    :param path: The imu.dat
+    :param digest: The hash to update
+    :return: The number of samples, the sums and the sums of squares of the x, y and z accelerations in g
+    """
+
+    count = 0
+    sums = [0.0, 0.0, 0.0]
+    squares = [0.0, 0.0, 0.0]
+
+    def add(lines):
+        nonlocal count
+        # Whole lines only, the 6 fields of a sample end up at fixed positions
+        fields = lines.replace(b"\n", b",").split(b",")
+        rows = len(fields) // 6
+        if len(fields) != rows * 6 + 1:
+            rows_fields = [line.split(b",") for line in lines.splitlines()]
+            fields = [field for row in rows_fields if len(row) == 6 for field in row] + [b""]
+            rows = len(fields) // 6
+        for axis in range(3):
+            values = list(map(float, fields[3 + axis::6][:rows]))
+            sums[axis] += sum(values)
+            squares[axis] += sum(map(operator.mul, values, values))
+        count += rows
+
+    with open(path, "rb") as fh:
+        header = fh.readline()
+        digest.update(header)
+        rest = b""
+        for chunk in iter(lambda: fh.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+            chunk = rest + chunk
+            end = chunk.rfind(b"\n") + 1
+            rest = chunk[end:]
+            if end:
+                add(chunk[:end])
+        # A last line cut by a power loss is only counted if it is complete
+        if rest.count(b",") == 5:
+            add(rest + b"\n")
+    return count, sums, squares
+
+
+def parse_time(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Distance between two positions
+
+    :return: The distance in m
+    """
+
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def gps_stats(path):
+    """
+    Distance and speed profile of the fixes of a gps.dat
+
+    :param path: The gps.dat, pickled or JSON lines
+    :return: A dict of the GPS results
+    """
+
+    fixes = [record for record in load_records(path) if record.get("class") == "TPV" and
+             record.get("mode", 0) >= 2 and record.get("lat") is not None and record.get("lon") is not None]
+    result = {"gps_fixes": len(fixes), "gps_max_gap_s": None, "distance_m": 0.0}
+    if not fixes:
+        return result
+
+    distance = 0.0
+    for previous, fix in zip(fixes, fixes[1:]):
+        distance += haversine(previous["lat"], previous["lon"], fix["lat"], fix["lon"])
+    result["distance_m"] = round(distance, 1)
+
+    times = [t for t in (parse_time(fix.get("time")) for fix in fixes) if t is not None]
+    if len(times) > 1:
+        result["gps_max_gap_s"] = round(max(b - a for a, b in zip(times, times[1:])), 3)
+
+    speeds = sorted(fix["speed"] for fix in fixes if fix.get("speed") is not None)
+    if speeds:
+        bins = [0] * SPEED_BINS
+        for speed in speeds:
+            bins[min(int(speed / SPEED_BIN), SPEED_BINS - 1)] += 1
+        result.update({
+            "speed_mean_mps": round(sum(speeds) / len(speeds), 3), "speed_p50_mps": speeds[len(speeds) // 2],
+            "speed_p95_mps": speeds[int(len(speeds) * 0.95)], "speed_max_mps": speeds[-1],
+            "moving_fraction": round(sum(1 for speed in speeds if speed > MOVING_SPEED) / len(speeds), 4),
+            # Share of the fixes per 5 m/s, the last bin holds the faster ones
+            "speed_profile": [round(count / len(speeds), 4) for count in bins]})
+    return result
+
+
+def analyze_trial(trial_dir):
+    """
+    Summary of a trial: duration, distance, speed profile, vibration and the sample loss check
+
+    :param trial_dir: The trial directory
+    :return: A tuple of the result and the hashes of the data files
+    """
+
+    result = {"trial": os.path.basename(trial_dir), "errors": []}
+    hashes = {}
+    imu_meta = read_meta(trial_dir, "imu")
+    gps_meta = read_meta(trial_dir, "gps")
+    result["duration_s"] = imu_meta.get("elapsed_time", gps_meta.get("elapsed_time"))
+
+    imu_path = os.path.join(trial_dir, "imu.dat")
+    if os.path.exists(imu_path):
+        digest = hashlib.sha256()
+        try:
+            count, sums, squares = imu_stats(imu_path, digest)
+        except (OSError, ValueError) as e:
+            result["errors"].append(f"imu.dat: {e}")
+        else:
+            hashes["imu.dat"] = digest.hexdigest()
+            odr_hz = imu_meta.get("odr_hz", DEFAULT_ODR_HZ)
+            result.update({"imu_samples": count, "imu_odr_hz": odr_hz,
+                           "imu_fifo_overruns": imu_meta.get("fifo_overruns"),
+                           # Fewer samples in the file than recorded, e.g. a copy cut short
+                           "imu_truncated": imu_meta.get("samples") is not None and count < imu_meta["samples"]})
+            if result["duration_s"]:
+                expected = odr_hz * result["duration_s"]
+                result["imu_expected_samples"] = round(expected)
+                # Up to a FIFO watermark of samples is left in the FIFO at the stop
+                in_fifo = imu_meta.get("fifo_threshold", 1920) // 6
+                result["imu_loss"] = round(max(expected - count - in_fifo, 0) / expected, 4)
+            if count:
+                variances = []
+                for axis, name in enumerate("xyz"):
+                    mean = sums[axis] / count
+                    variances.append(max(squares[axis] / count - mean * mean, 0.0))
+                    result[f"accel_mean_{name}_g"] = round(mean, 4)
+                    result[f"vibration_rms_{name}_g"] = round(math.sqrt(variances[-1]), 4)
+                result["vibration_rms_g"] = round(math.sqrt(sum(variances)), 4)
+    else:
+        result["errors"].append("imu.dat missing")
+
+    gps_path = os.path.join(trial_dir, "gps.dat")
+    if os.path.exists(gps_path):
+        try:
+            result.update(gps_stats(gps_path))
+        except Exception as e:
+            result["errors"].append(f"gps.dat: {e}")
+        hashes["gps.dat"] = file_hash(gps_path)
+    else:
+        result["errors"].append("gps.dat missing")
+
+    for name in data_files(trial_dir):
+        if name.endswith(".meta"):
+            hashes[name] = file_hash(os.path.join(trial_dir, name))
+
+    result["samples_ok"] = ("imu_samples" in result and not result.get("imu_fifo_overruns") and
+                            not result["imu_truncated"] and result.get("imu_loss", 0) <= LOSS_TOLERANCE)
+    return result, hashes
+
+
+def process_trial(task):
+    """
+    Process a trial in a worker of the pool. A trial whose files changed their modification time but not their
+    content, e.g. copied again, takes the cached result after a hash of the files
+
+    :param task: The trial directory and its cache entry, None if not cached
+    :return: The trial directory, the new cache entry and how it was obtained, "hashed" or "processed"
+    """
+
+    trial_dir, cached = task
+    files = fingerprint(trial_dir)
+    if cached is not None and {name: size for name, (size, _) in files.items()} == \
+            {name: size for name, (size, _) in cached["files"].items()}:
+        hashes = {name: file_hash(os.path.join(trial_dir, name)) for name in cached["hashes"]}
+        if hashes == cached["hashes"]:
+            return trial_dir, dict(cached, files=files), "hashed"
+
+    start = time.perf_counter()
+    result, hashes = analyze_trial(trial_dir)
+    result["process_seconds"] = round(time.perf_counter() - start, 3)
+    return trial_dir, {"version": ANALYSIS_VERSION, "files": files, "hashes": hashes, "result": result}, "processed"
+
+
+class ResultCache:
+    """
+    The results of the trials, one JSON file per trial. An entry is valid while the sizes and modification times of
+    the files of the trial are unchanged, or their hashes
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: Directory of the cache files, None to disable the cache
+        """
+
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, trial_dir):
+        name = hashlib.sha256(os.path.abspath(trial_dir).encode()).hexdigest()[:16]
+        return os.path.join(self.directory, f"{os.path.basename(trial_dir)}-{name}.json")
+
+    def load(self, trial_dir):
+        """
+        The cache entry of a trial
+
+        :param trial_dir: The trial directory
+        :return: The entry, None if not cached or cached by another version of the analysis
+        """
+
+        if self.directory is None:
+            return None
+        try:
+            with open(self.path(trial_dir), "r") as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("version") == ANALYSIS_VERSION else None
+
+    def store(self, trial_dir, entry):
+        """
+        Store the entry of a trial, atomically
+
+        :param trial_dir: The trial directory
+        :param entry: The entry
+        :return: None
+        """
+
+        if self.directory is None:
+            return
+        path = self.path(trial_dir)
+        with open(path + ".tmp", "w") as fh:
+            json.dump(entry, fh)
+        os.replace(path + ".tmp", path)
+
+
+def analyze_collection(root, jobs=None, chunksize=None, cache_dir=None):
+    """
+    Summarize all the trials of a collection over a process pool. Only the trials not in the cache are processed
+
+    :param root: The collection directory
+    :param jobs: Number of worker processes, the number of CPUs by default
+    :param chunksize: Trials handed to a worker at once, chosen from the number of trials by default
+    :param cache_dir: Directory of the result cache, None to process every trial
+    :return: The results in the order of the trials, and the statistics of the run
+    """
+
+    logger = logging.getLogger("analytics")
+    start = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+    cache = ResultCache(cache_dir)
+    trials = discover_trials(root)
+
+    entries = {}
+    tasks = []
+    for trial_dir in trials:
+        cached = cache.load(trial_dir)
+        if cached is not None and fingerprint(trial_dir) == cached["files"]:
+            entries[trial_dir] = cached
+        else:
+            tasks.append((trial_dir, cached))
+    counts = {"cached": len(entries), "hashed": 0, "processed": 0}
+
+    if tasks:
+        # A few chunks per worker, so that a slow trial does not hold up the end of the run
+        chunksize = chunksize or max(1, len(tasks) // (jobs * 4))
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            for trial_dir, entry, how in pool.imap_unordered(process_trial, tasks, chunksize=chunksize):
+                entries[trial_dir] = entry
+                counts[how] += 1
+                cache.store(trial_dir, entry)
+                logger.info(f"{os.path.relpath(trial_dir, root)} {how}")
+
+    results = [dict(entries[trial_dir]["result"], path=trial_dir) for trial_dir in trials]
+    stats = dict(counts, trials=len(trials), jobs=jobs, seconds=round(time.perf_counter() - start, 3))
+    return results, stats
+
+
+def write_results(results, fh, output_format="csv"):
+    """
+    Write the results as CSV, one row per trial, or as JSON lines
+
+    :param results: The results
+    :param fh: The output file
+    :param output_format: "csv" or "jsonl"
+    :return: None
+    """
+
+    if output_format == "jsonl":
+        for result in results:
+            fh.write(json.dumps(result) + "\n")
+        return
+    writer = csv.DictWriter(fh, fieldnames=COLUMNS + ["path"], extrasaction="ignore")
+    writer.writeheader()
+    for result in results:
+        row = dict(result)
+        row["speed_profile"] = ";".join(str(share) for share in result.get("speed_profile", []))
+        row["errors"] = "; ".join(result.get("errors", []))
+        writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the trials of a copied collection, e.g. uw-sensor-data")
+    parser.add_argument("root", help="Directory of the trials")
+    parser.add_argument("-o", "--output", default=None, help="Output file, stdout by default")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default=None,
+                        help="Output format, from the extension of the output file, CSV by default")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes, the number of CPUs by default")
+    parser.add_argument("--chunksize", type=int, default=None, help="Trials handed to a worker at once")
+    parser.add_argument("--cache-dir", default=None, help="Result cache, .drivesense-analytics in the root by default")
+    parser.add_argument("--no-cache", action="store_true", help="Process every trial")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log the progress to stderr")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    cache_dir = None if args.no_cache else args.cache_dir or os.path.join(args.root, ".drivesense-analytics")
+    results, stats = analyze_collection(args.root, jobs=args.jobs, chunksize=args.chunksize, cache_dir=cache_dir)
+
+    output_format = args.format or ("jsonl" if args.output and args.output.endswith(".jsonl") else "csv")
+    if args.output:
+        with open(args.output, "w", newline="") as fh:
+            write_results(results, fh, output_format)
+    else:
+        write_results(results, sys.stdout, output_format)
+    print(f"{stats['trials']} trials: {stats['processed']} processed, {stats['hashed']} unchanged after a hash, "
+          f"{stats['cached']} cached, in {stats['seconds']} s with {stats['jobs']} processes", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
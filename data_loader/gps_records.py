@@ -0,0 +1,66 @@
+import json
+import pickle
+
+
+class ReplayRecord:
+    """
+    Stand-in for the gps client record class, so that gps.dat can be read without the gps package
+    """
+
+    def __init__(self, ddict=None):
+        self.__dict__ = ddict if ddict is not None else {}
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
+
+class RecordUnpickler(pickle.Unpickler):
+    """
+    Loads the records of gps.dat with the gps client classes replaced
+    """
+
+    def find_class(self, module, name):
+        if module == "gps" or module.startswith("gps."):
+            return ReplayRecord
+        return super().find_class(module, name)
+
+
+def plain(value):
+    """
+    Convert a record to plain JSON types
+
+    :param value: A record or a value in it
+    :return: The plain value
+    """
+
+    if isinstance(value, ReplayRecord):
+        value = value.__dict__
+    if hasattr(value, "keys") and not isinstance(value, dict):
+        value = {k: value[k] for k in value.keys()}
+    if isinstance(value, dict):
+        return {k: plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    return value
+
+
+def load_records(path):
+    """
+    Read the records of a recorded gps.dat
+
+    :param path: Path to gps.dat, pickled or JSON lines
+    :return: A list of record dicts
+    """
+
+    records = []
+    with open(path, "rb") as fh:
+        # Recorded as JSON lines
+        if fh.peek(1)[:1] == b"{":
+            return [json.loads(line) for line in fh if line.strip()]
+        unpickler = RecordUnpickler(fh)
+        while True:
+            try:
+                records.append(plain(unpickler.load()))
+            except EOFError:
+                break
+    return records
@@ -0,0 +1,122 @@
+import os
+import json
+from array import array
+from IMU.summary import MAGIC, MAGIC_V1, BLOCK_HEADER, BLOCK_MAGIC, BIN, BIN_V1, CHANNELS
+
+
+class SummaryReader:
+    """
+    Reads the summary.dat of a trial for plotting. Only the blocks of the level that suits the time span and the width
+    of the plot are read
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path to the summary.dat, or to the trial directory
+        """
+
+        if os.path.isdir(path):
+            path = os.path.join(path, "summary.dat")
+        self.path = path
+        with open(path, "rb") as fh:
+            magic = fh.read(len(MAGIC))
+            if magic not in (MAGIC, MAGIC_V1):
+                raise ValueError(f"{path} is not a summary file")
+            self.bin = BIN if magic == MAGIC else BIN_V1
+            self.header = json.loads(fh.readline())
+            # Offset, first bin and number of bins of the blocks per level
+            self.blocks = [[] for _ in self.header["bin_seconds"]]
+            while True:
+                block = fh.read(BLOCK_HEADER.size)
+                if len(block) < BLOCK_HEADER.size:
+                    break
+                magic, level, count, first_bin = BLOCK_HEADER.unpack(block)
+                if magic != BLOCK_MAGIC or level >= len(self.blocks):
+                    raise ValueError(f"Corrupt block in {path} at offset {fh.tell() - BLOCK_HEADER.size}")
+                self.blocks[level].append((fh.tell(), first_bin, count))
+                fh.seek(count * self.bin.size, os.SEEK_CUR)
+
+        scale = self.header["scale"]
+        self.scales = [scale["gyro_dps_per_lsb"]] * 3 + [scale["accel_g_per_lsb"]] * 3
+
+    @property
+    def bin_seconds(self):
+        return self.header["bin_seconds"]
+
+    @property
+    def duration(self):
+        """
+        Length of the trial covered by the summary in seconds
+        """
+
+        for level, blocks in enumerate(self.blocks):
+            if blocks:
+                _, first_bin, count = blocks[-1]
+                return (first_bin + count) * self.bin_seconds[level]
+        return 0.0
+
+    def level_for(self, span_s, width_px):
+        """
+        The coarsest level with at least one bin per pixel, the finest level if none has as many
+
+        :param span_s: Length of the plotted time span in seconds
+        :param width_px: Width of the plot in pixels
+        :return: Index of the level
+        """
+
+        for level in reversed(range(len(self.bin_seconds))):
+            if self.blocks[level] and span_s / self.bin_seconds[level] >= width_px:
+                return level
+        return 0
+
+    def read(self, start_s=0.0, end_s=None, width_px=1000, level=None):
+        """
+        Read the summary of a time span
+
+        :param start_s: Start of the span in seconds from the start of the trial
+        :param end_s: End of the span, the end of the trial by default
+        :param width_px: Width of the plot in pixels, to pick the level
+        :param level: Use this level instead
+        :return: A dict with the level, its bin length, the start times of the bins and per channel a dict of the min,
+        max, mean and RMS arrays, in dps for the gyroscope and g for the accelerometer
+        """
+
+        if end_s is None:
+            end_s = self.duration
+        if level is None:
+            level = self.level_for(end_s - start_s, width_px)
+        bin_seconds = self.bin_seconds[level]
+        first, last = int(start_s // bin_seconds), int(end_s // bin_seconds)
+
+        raw = array("h")
+        times = array("d")
+        with open(self.path, "rb") as fh:
+            for offset, first_bin, count in self.blocks[level]:
+                if first_bin > last or first_bin + count <= first:
+                    continue
+                fh.seek(offset)
+                for values in self.bin.iter_unpack(fh.read(count * self.bin.size)):
+                    if first <= values[0] <= last:
+                        times.append(values[0] * bin_seconds)
+                        raw.extend(values[2:])
+
+        result = {"level": level, "bin_seconds": bin_seconds, "time_s": times}
+        for c, channel in enumerate(CHANNELS):
+            scale = self.scales[c]
+            result[channel] = {stat: array("d", (v * scale for v in raw[c * 4 + s::24]))
+                               for s, stat in enumerate(("min", "max", "mean", "rms"))}
+        return result
+
+
+def load_summary(path, start_s=0.0, end_s=None, width_px=1000):
+    """
+    Read the summary of a trial for a plot
+
+    :param path: Path to the summary.dat, or to the trial directory
+    :param start_s: Start of the span in seconds
+    :param end_s: End of the span, the end of the trial by default
+    :param width_px: Width of the plot in pixels
+    :return: See SummaryReader.read
+    """
+
+    return SummaryReader(path).read(start_s, end_s, width_px)
@@ -0,0 +1,278 @@
+import os
+import time
+import random
+import shutil
+import socket
+import hashlib
+import logging
+import threading
+import http.client
+from urllib.parse import quote, urlsplit
+import metrics
+
+
+class UploadError(Exception):
+    """
+    The server refused an upload
+    """
+
+
+class UploadPaused(Exception):
+    """
+    The device is busy, the upload continues later
+    """
+
+
+class TrialUploader(threading.Thread):
+    """
+    Uploads the finished trials to the collection server in the background while the device is idle. Files are sent
+    in chunks with a checksum each over one persistent connection, an interrupted upload resumes at the offset the
+    server has. Uploaded trials are recorded in the catalog, and removed from the card if pruning is enabled
+    """
+
+    def __init__(self, catalog, url, save_location="/sensor_data", device_id=None, chunk_size=1024 * 1024,
+                 rate_limit=None, can_upload=None, prune=False, poll_interval=60, max_backoff=300, timeout=30):
+        """
+        :param catalog: The trial catalog
+        :param url: Base URL of the uploads on the collection server, e.g. http://server/uploads
+        :param save_location: The directory of the trials
+        :param device_id: Name of the device on the server, the host name by default
+        :param chunk_size: Bytes per request
+        :param rate_limit: Upload rate limit in bytes per second, None for no limit
+        :param can_upload: Callable returning False while the device is busy, e.g. recording
+        :param prune: Remove the trials from the card once uploaded
+        :param poll_interval: Seconds between the checks for trials to upload
+        :param max_backoff: Longest wait between retries in seconds
+        :param timeout: Socket timeout in seconds
+        """
+
+        threading.Thread.__init__(self, name="TrialUploader", daemon=True)
+        self.catalog = catalog
+        self.url = url.rstrip("/")
+        parts = urlsplit(self.url)
+        self.scheme, self.host, self.port, self.base_path = parts.scheme, parts.hostname, parts.port, parts.path
+        self.save_location = save_location
+        self.device_id = device_id or socket.gethostname()
+        self.chunk_size = chunk_size
+        self.rate_limit = rate_limit
+        self.can_upload = can_upload or (lambda: True)
+        self.prune = prune
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.connection = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.failures = 0
+        # Token bucket of the rate limit
+        self.allowance = 0.0
+        self.allowance_time = time.monotonic()
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # Metrics
+        self.bytes_total = metrics.REGISTRY.counter("upload_bytes_total", "Bytes uploaded to the collection server")
+        self.trials_total = metrics.REGISTRY.counter("upload_trials_total", "Trials uploaded to the collection server")
+        self.retries_total = metrics.REGISTRY.counter("upload_retries_total", "Failed upload attempts")
+
+    def connect(self):
+        if self.connection is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            self.connection = cls(self.host, self.port, timeout=self.timeout)
+        return self.connection
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        A request on the persistent connection
+
+        :param method: HTTP method
+        :param path: Path of the file below the base URL
+        :param body: Request body
+        :param headers: Request headers
+        :return: The status and the offset the server has
+        """
+
+        connection = self.connect()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.disconnect()
+            raise
+        offset = response.getheader("Upload-Offset")
+        return response.status, int(offset) if offset is not None else None
+
+    def throttle(self, size):
+        """
+        Wait until the rate limit allows another chunk
+
+        :param size: Bytes of the chunk
+        :return: None
+        """
+
+        if not self.rate_limit:
+            return
+        now = time.monotonic()
+        # At most a second of unused allowance is kept
+        self.allowance = min(self.allowance + (now - self.allowance_time) * self.rate_limit, self.rate_limit)
+        self.allowance_time = now
+        self.allowance -= size
+        if self.allowance < 0:
+            self.stopped.wait(-self.allowance / self.rate_limit)
+
+    def upload_file(self, trial, relative_path, path):
+        """
+        Upload a file, from the offset the server already has
+
+        :param trial: Name of the trial
+        :param relative_path: Path of the file in the trial directory
+        :param path: Path of the file
+        :return: Bytes sent
+        """
+
+        remote = quote(f"{self.base_path}/{self.device_id}/{trial}/{relative_path}")
+        size = os.path.getsize(path)
+        status, offset = self.request("HEAD", remote)
+        if status != 200:
+            raise UploadError(f"HEAD {remote} returned {status}")
+        if offset > size:
+            raise UploadError(f"The server has {offset} bytes of {relative_path}, the file has {size}")
+
+        if size == 0:
+            # There is no chunk to send, an empty one creates the file on the server for the POST to complete
+            status, _ = self.request("PATCH", remote, body=b"", headers={
+                "Upload-Offset": "0", "Upload-Length": "0", "Chunk-SHA256": hashlib.sha256(b"").hexdigest(),
+                "Content-Type": "application/octet-stream"})
+            if status != 204:
+                raise UploadError(f"PATCH {remote} of the empty file returned {status}")
+
+        sent = 0
+        with open(path, "rb") as fh:
+            fh.seek(offset)
+            while offset < size:
+                if self.stopped.is_set() or not self.can_upload():
+                    raise UploadPaused()
+                chunk = fh.read(self.chunk_size)
+                self.throttle(len(chunk))
+                status, server_offset = self.request("PATCH", remote, body=chunk, headers={
+                    "Upload-Offset": str(offset), "Upload-Length": str(size),
+                    "Chunk-SHA256": hashlib.sha256(chunk).hexdigest(), "Content-Type": "application/octet-stream"})
+                if status == 409:
+                    # The server is elsewhere in the file, continue from there
+                    self.logger.warning(f"Upload of {trial}/{relative_path} resumes at {server_offset}, not {offset}")
+                elif status != 204:
+                    raise UploadError(f"PATCH {remote} at {offset} returned {status}")
+                else:
+                    sent += len(chunk)
+                    self.bytes_total.inc(len(chunk))
+                if server_offset is None or server_offset > size:
+                    raise UploadError(f"PATCH {remote} returned the offset {server_offset}")
+                offset = server_offset
+                fh.seek(offset)
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(block)
+        status, _ = self.request("POST", remote, headers={"File-SHA256": digest.hexdigest()})
+        if status != 200:
+            raise UploadError(f"POST {remote} returned {status}, the file is uploaded again")
+        return sent
+
+    def upload_trial(self, name):
+        """
+        Upload the files of a trial and record the upload
+
+        :param name: Name of the trial directory
+        :return: Bytes sent
+        """
+
+        trial_dir = os.path.join(self.save_location, name)
+        start = time.monotonic()
+        sent = 0
+        for root, _, files in os.walk(trial_dir):
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                sent += self.upload_file(name, os.path.relpath(path, trial_dir).replace(os.sep, "/"), path)
+
+        self.catalog.mark_uploaded(name, f"{self.url}/{self.device_id}/{name}")
+        self.trials_total.inc()
+        elapsed = time.monotonic() - start
+        self.logger.info(f"Uploaded {name}, {sent / 1e6:.1f} MB sent in {elapsed:.1f} s")
+        if self.prune:
+            shutil.rmtree(trial_dir)
+            self.catalog.mark_pruned(name)
+        return sent
+
+    def upload_pending(self):
+        """
+        Upload the trials that are waiting, oldest first
+
+        :return: Number of trials uploaded
+        """
+
+        uploaded = 0
+        for trial in self.catalog.pending_upload():
+            if not os.path.isdir(os.path.join(self.save_location, trial["name"])):
+                continue
+            try:
+                self.upload_trial(trial["name"])
+            except UploadError as e:
+                # A trial the server refuses does not hold up the trials after it, it is tried again next time
+                self.logger.warning(f"Upload of {trial['name']} failed, continuing with the next trial: {e}")
+                self.retries_total.inc()
+                continue
+            uploaded += 1
+            self.failures = 0
+        return uploaded
+
+    def backoff(self):
+        """
+        Wait before the next attempt, doubling with every failure up to the maximum, with jitter
+
+        :return: None
+        """
+
+        self.failures += 1
+        self.retries_total.inc()
+        delay = min(self.max_backoff, 2 ** min(self.failures, 16)) * random.uniform(0.5, 1.0)
+        self.stopped.wait(delay)
+
+    def wake(self):
+        """
+        Check for trials to upload now, e.g. after a trial was recorded
+
+        :return: None
+        """
+
+        self.wakeup.set()
+
+    def run(self):
+        self.logger.info(f"Uploading trials to {self.url} as {self.device_id}")
+        while not self.stopped.is_set():
+            if self.can_upload():
+                try:
+                    self.upload_pending()
+                except UploadPaused:
+                    self.disconnect()
+                except (OSError, http.client.HTTPException, UploadError) as e:
+                    self.logger.warning(f"Upload failed, retrying: {e}")
+                    self.backoff()
+                    continue
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+        self.disconnect()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
@@ -5,19 +5,33 @@ import logging
 import tarfile
 import subprocess
 import json
+from log_manager import LogManager
+import metrics
+import hal
 
 
 class SensorDataCopier:
-    def __init__(self, status_display, sensor_data_path='/sensor_data', usb_mount_point='/mnt/data'):
+    def __init__(self, status_display, sensor_data_path='/sensor_data', usb_mount_point='/mnt/data', catalog=None,
+                 profiles=None):
         self.sensor_data_path = sensor_data_path
         self.usb_mount_point = usb_mount_point
 
+        # Acquisition profile store, for the profiles set from the system config file
+        self.profiles = profiles
+
+        # Trial catalog, the trials to copy are taken from it instead of a scan of the data directory
+        self.catalog = catalog
+
         # Status display
         self.status_display = status_display
 
         # Logging
         self.logger = logging.getLogger(self.__class__.__name__)
 
+        # Metrics
+        self.bytes_copied = metrics.REGISTRY.counter("copy_bytes_total", "Bytes copied to the USB device")
+        self.trials_copied = metrics.REGISTRY.counter("copy_trials_total", "Trials copied to the USB device")
+
     def is_usb_mounted(self):
         """
         Check if the device is mounted to the USB port
@@ -25,7 +39,17 @@ class SensorDataCopier:
         :return: None
         """
 
-        return os.path.ismount(self.usb_mount_point)
+        return hal.ismount(self.usb_mount_point)
+
+    def has_fw_update(self):
+        """
+        Check if the mounted USB device holds a firmware update
+
+        :return: True, if the firmware update file is found
+        """
+
+        return self.is_usb_mounted() and os.path.exists(os.path.join(self.usb_mount_point,
+                                                                     '__drivesense_fwupdate.tar'))
 
     def test_progress(self):
         """
@@ -38,6 +62,19 @@ class SensorDataCopier:
             self.status_display.display_progress("Data Copy", i / 100)
             time.sleep(0.5)
 
+    def copy_file(self, src, dst):
+        """
+        Copy a single file, accounting for the copied bytes
+
+        :param src: Source file
+        :param dst: Destination file
+        :return: The destination
+        """
+
+        result = shutil.copy2(src, dst)
+        self.bytes_copied.inc(os.path.getsize(src))
+        return result
+
     def copy_sensor_data(self):
         """
         Copy the sensor data to the usb mounted device.
@@ -67,14 +104,18 @@ class SensorDataCopier:
             os.makedirs(destination_path, exist_ok=True)
 
             # Check for available files
-            num_files = len(os.listdir(self.sensor_data_path))
+            if self.catalog is not None:
+                folder_names = [trial["name"] for trial in self.catalog.pending()]
+            else:
+                folder_names = [entry.name for entry in os.scandir(self.sensor_data_path) if entry.is_dir()]
+            num_files = len(folder_names)
             if num_files == 0:
                 self.status_display.display_header_and_status(header="Data Copy", status="No Data!")
                 self.logger.info("Tried copy with no data")
                 return
 
             self.status_display.display_header_and_status(header="Data Copy", status="Copy In Progress...")
-            for index, folder_name in enumerate(os.listdir(self.sensor_data_path)):
+            for index, folder_name in enumerate(folder_names):
                 folder_path = os.path.join(self.sensor_data_path, folder_name)
                 if os.path.isdir(folder_path):
 
@@ -87,9 +128,12 @@ class SensorDataCopier:
                             target_folder_path = os.path.join(destination_path, f"{base_name}_{counter}")
                             counter += 1
 
-                    shutil.copytree(folder_path, target_folder_path)
+                    shutil.copytree(folder_path, target_folder_path, copy_function=self.copy_file)
                     os.sync()   # immediate flush data to device
                     shutil.rmtree(folder_path)
+                    self.trials_copied.inc()
+                    if self.catalog is not None:
+                        self.catalog.mark_copied(folder_name, target_folder_path)
 
                 # Update progress
                 self.status_display.display_progress("Data Copy", index/num_files)
@@ -99,7 +143,7 @@ class SensorDataCopier:
                                                           status="Copy Successful!\nDevice Unmounted")
             
             # Unmount the USB drive
-            subprocess.run(["sudo", "umount", self.usb_mount_point], check=True)
+            hal.unmount(self.usb_mount_point)
             self.logger.info("USB Drive unmounted successful")
 
         except Exception as e:
@@ -197,20 +241,42 @@ class SensorDataCopier:
             return None
 
     def get_logs(self):
+        """
+        Copy the logs to the USB device. Only the logs that changed since the last export to the device are copied
+
+        :return: None
+        """
+
         try:
             log_source_dir = "/var/drivesense/logs"
             log_dest_dir = os.path.join(self.usb_mount_point, "uw-sensor-config", "logs")
-            if not os.path.exists(log_dest_dir):
-                os.makedirs(log_dest_dir)
-            else:
-                shutil.rmtree(log_dest_dir)
-
-            for log_file in os.listdir(log_source_dir):
-                full_log_path = os.path.join(log_source_dir, log_file)
-                if os.path.isfile(full_log_path):
-                    shutil.copy(full_log_path, log_dest_dir)
-
-            self.logger.info(f"Logs copied to {log_dest_dir}")
+            os.makedirs(log_dest_dir, exist_ok=True)
+
+            # Previous export state on this device
+            manifest_file = os.path.join(log_dest_dir, ".export_manifest.json")
+            try:
+                with open(manifest_file, "r") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {}
+
+            copied = 0
+            for entry in os.scandir(log_source_dir):
+                if not entry.is_file() or entry.name == LogManager.INDEX_FILE:
+                    continue
+                st = entry.stat()
+                signature = [st.st_size, st.st_mtime_ns]
+                if manifest.get(entry.name) == signature and os.path.exists(os.path.join(log_dest_dir, entry.name)):
+                    continue
+                shutil.copy2(entry.path, log_dest_dir)
+                manifest[entry.name] = signature
+                copied += 1
+
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f)
+            os.sync()
+
+            self.logger.info(f"{copied} logs copied to {log_dest_dir}")
         except Exception as e:
             self.logger.error(f"Error copying logs: {e}")
 
@@ -272,6 +338,30 @@ class SensorDataCopier:
                 output['message'] = 'Logs copied successfully'
                 self.status_display.display_header_and_status(header="System Config", status="Logs Copied")
 
+            # Set the acquisition profile, it applies from the next DAQ start
+            elif config["type"] == 'setProfile' and self.profiles is not None:
+                try:
+                    output['profile'] = self.profiles.save(config.get("profile"))
+                    output['status'] = 'success'
+                    output['message'] = 'Profile applies from the next DAQ start'
+                    self.status_display.display_header_and_status(header="System Config", status="Profile Set")
+                except ValueError as e:
+                    output['status'] = 'failed'
+                    output['message'] = f"Invalid profile - {e}"
+                    self.status_display.display_header_and_status(header="System Config", status="Invalid Profile")
+
+            # Get the acquisition profile
+            elif config["type"] == 'getProfile' and self.profiles is not None:
+                output['status'] = 'success'
+                output['profile'] = self.profiles.load()
+                self.status_display.display_header_and_status(header="System Config", status="Profile Obtained")
+
+            # Go back to the default acquisition profile
+            elif config["type"] == 'resetProfile' and self.profiles is not None:
+                output['status'] = 'success'
+                output['profile'] = self.profiles.reset()
+                self.status_display.display_header_and_status(header="System Config", status="Profile Reset")
+
             # Unknown
             elif config["type"] == 'unknown':
                 output['status'] = 'failed'
@@ -0,0 +1,152 @@
+import functools
+from PIL import Image, ImageDraw
+
+
+# SSD1306 addressing commands
+COLUMNADDR = 0x21
+PAGEADDR = 0x22
+
+
+def text_size(font, text):
+    """
+    Measure the size of the text when drawn at the origin
+
+    :param font: The font to draw with
+    :param text: String to measure, can span multiple lines
+    :return: A tuple of width and height
+    """
+
+    draw = ImageDraw.Draw(Image.new('1', (1, 1)))
+    if hasattr(draw, "multiline_textbbox"):
+        _, _, right, bottom = draw.multiline_textbbox((0, 0), text, font=font)
+        return right, bottom
+    return draw.multiline_textsize(text, font=font)
+
+
+class TextCache:
+    """
+    LRU cache of rendered text bitmaps. The text is measured and rasterized once, later draws only paste the bitmap
+    """
+
+    def __init__(self, maxsize=64):
+        self.render = functools.lru_cache(maxsize=maxsize)(self._render)
+
+    @staticmethod
+    def _render(text, font):
+        """
+        Rasterize the text into a bitmap
+
+        :param text: String to render
+        :param font: The font to render with
+        :return: A 1-bit image of the text
+        """
+
+        width, height = text_size(font, text)
+        bitmap = Image.new('1', (max(width, 1), max(height, 1)))
+        ImageDraw.Draw(bitmap).multiline_text((0, 0), text, font=font, fill=255)
+        return bitmap
+
+    def paste(self, frame, text, font, xy):
+        """
+        Draw the text on a frame
+
+        :param frame: The image to draw on
+        :param text: String to draw
+        :param font: The font to draw with
+        :param xy: Top left position of the text
+        :return: None
+        """
+
+        bitmap = self.render(text, font)
+        frame.paste(255, (xy[0], xy[1], xy[0] + bitmap.width, xy[1] + bitmap.height), mask=bitmap)
+
+    def paste_centered(self, frame, text, font, y=None):
+        """
+        Draw the text horizontally centered on a frame. Vertically centered when y is not given
+
+        :param frame: The image to draw on
+        :param text: String to draw
+        :param font: The font to draw with
+        :param y: Top position of the text
+        :return: None
+        """
+
+        bitmap = self.render(text, font)
+        x = (frame.width - bitmap.width) // 2
+        if y is None:
+            y = (frame.height - bitmap.height) // 2
+        self.paste(frame, text, font, (x, y))
+
+
+class FramePusher:
+    """
+    Sends frames to a SSD1306 device. The frame is compared page by page with the previous one and only the changed
+    pages are transferred
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.num_pages = device.height // 8
+        self.last_pages = None
+
+        # Statistics
+        self.bytes_sent = 0
+        self.frames_pushed = 0
+        self.frames_skipped = 0
+
+    def to_pages(self, image):
+        """
+        Convert an image to the SSD1306 page layout. Every byte is a column of 8 pixels, LSB on top
+
+        :param image: 1-bit image of the display size
+        :return: A list with the bytes for each page
+        """
+
+        # Columns become rows with the bottom pixel first, so each packed byte is a page column
+        raw = image.transpose(Image.FLIP_TOP_BOTTOM).transpose(Image.TRANSPOSE).tobytes()
+        stride = self.num_pages
+        return [raw[stride - 1 - page::stride] for page in range(self.num_pages)]
+
+    def push(self, image):
+        """
+        Send the changed pages of the image to the device
+
+        :param image: 1-bit image of the display size
+        :return: Number of bytes sent
+        """
+
+        pages = self.to_pages(self.device.preprocess(image))
+        if self.last_pages is None:
+            changed = list(range(self.num_pages))
+        else:
+            changed = [page for page in range(self.num_pages) if pages[page] != self.last_pages[page]]
+        self.last_pages = pages
+
+        if not changed:
+            self.frames_skipped += 1
+            return 0
+
+        # Transfer runs of consecutive pages
+        sent = 0
+        start = changed[0]
+        for index, page in enumerate(changed):
+            if index + 1 == len(changed) or changed[index + 1] != page + 1:
+                self.device.command(COLUMNADDR, 0, self.device.width - 1, PAGEADDR, start, page)
+                data = b"".join(pages[start:page + 1])
+                self.device.data(list(data))
+                sent += len(data) + 6
+                if index + 1 < len(changed):
+                    start = changed[index + 1]
+
+        self.bytes_sent += sent
+        self.frames_pushed += 1
+        return sent
+
+    def invalidate(self):
+        """
+        Force the next frame to be sent in full, e.g. after the device was written to directly
+
+        :return: None
+        """
+
+        self.last_pages = None
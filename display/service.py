@@ -0,0 +1,253 @@
+import os
+import time
+import logging
+import threading
+
+
+class DisplayService(threading.Thread):
+    """
+    Draws on the display from a single low priority thread. Callers post the desired screen and return immediately,
+    bursts of posts are coalesced so that only the latest screen is drawn, at no more than the maximum frame rate
+    """
+
+    def __init__(self, display, max_fps=5, nice=10):
+        """
+        :param display: The Display to draw on
+        :param max_fps: Maximum number of screens drawn per second
+        :param nice: Niceness of the render thread
+        """
+
+        threading.Thread.__init__(self, name="DisplayService", daemon=True)
+        self.display = display
+        self.min_interval = 1 / max_fps
+        self.nice = nice
+
+        self.condition = threading.Condition()
+        self.pending = None
+        self.drawing = False
+        self.running = False
+
+        # Power saving
+        self.idle_timeout = None
+        self.panel_on = True
+        self.last_post = time.monotonic()
+
+        # Statistics
+        self.posted = 0
+        self.drawn = 0
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def post(self, method, *args, **kwargs):
+        """
+        Request a screen. Replaces any screen that was posted but not drawn yet
+
+        :param method: Name of the Display method that draws the screen
+        :param args: Positional arguments for the method
+        :param kwargs: Keyword arguments for the method
+        :return: None
+        """
+
+        with self.condition:
+            self.pending = (method, args, kwargs)
+            self.posted += 1
+            self.last_post = time.monotonic()
+            self.condition.notify()
+
+    def set_idle_timeout(self, idle_timeout):
+        """
+        Switch the panel off when nothing was posted for a while. The next post switches it on again
+
+        :param idle_timeout: Time in seconds, None keeps the panel on
+        :return: None
+        """
+
+        with self.condition:
+            self.idle_timeout = idle_timeout
+            self.last_post = time.monotonic()
+            if idle_timeout is None and not self.panel_on:
+                # Wake the panel from the render thread
+                self.pending = self.pending or ("set_power", (True,), {})
+            self.condition.notify()
+
+    def run(self):
+        """
+        Render loop. Draws the latest posted screen
+
+        :return: None
+        """
+
+        # Lower the priority of this thread only
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.nice)
+        except (AttributeError, OSError) as e:
+            self.logger.warning(f"Could not lower display thread priority: {e}")
+
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    if self.idle_timeout is None or not self.panel_on:
+                        self.condition.wait()
+                        continue
+                    remaining = self.last_post + self.idle_timeout - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if not self.running and self.pending is None:
+                    break
+                if self.pending is None:
+                    method, args, kwargs = "set_power", (False,), {}
+                else:
+                    method, args, kwargs = self.pending
+                    self.pending = None
+                self.drawing = True
+
+            draw_start = time.monotonic()
+            try:
+                # Panel power follows the posted screens
+                panel_on = method != "set_power" or args[0]
+                if panel_on and not self.panel_on and method != "set_power":
+                    self.display.set_power(True)
+                getattr(self.display, method)(*args, **kwargs)
+                self.panel_on = panel_on
+                self.drawn += 1
+            except Exception as e:
+                self.logger.error(f"Error drawing {method}: {e}")
+            finally:
+                with self.condition:
+                    self.drawing = False
+                    self.condition.notify_all()
+
+            # Limit the frame rate, posts in the meantime are coalesced
+            elapsed = time.monotonic() - draw_start
+            if elapsed < self.min_interval:
+                time.sleep(self.min_interval - elapsed)
+
+    def start(self):
+        """
+        Start the render thread
+
+        :return: None
+        """
+
+        if not self.running:
+            self.running = True
+            threading.Thread.start(self)
+
+    def stop(self):
+        """
+        Draw the pending screen and stop the render thread
+
+        :return: None
+        """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.is_alive():
+            self.join()
+
+    def wait_idle(self, timeout=None):
+        """
+        Wait until the latest posted screen is on the display
+
+        :param timeout: Maximum time to wait in seconds
+        :return: True, if the display is idle
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending is None and not self.drawing, timeout=timeout)
+
+    # Same interface as Display, drawn asynchronously
+    def display_system_props(self):
+        """
+        Display the system properties on the OLED screen
+
+        :return: None
+        """
+
+        self.post("display_system_props")
+
+    def display_image(self, image_location):
+        """
+        Display an image in the center of the screen, resized to the screen dimensions
+
+        :param image_location: Location of the image file to display
+        :return: None
+        """
+
+        self.post("display_image", image_location)
+
+    def display_default_image(self):
+        """
+        Display the preset logo in the center of the screen
+
+        :return: None
+        """
+
+        self.post("display_default_image")
+
+    def display_centered_text(self, text):
+        """
+        Display a text in the center of the screen
+
+        :param text: A string to display
+        :return: None
+        """
+
+        self.post("display_centered_text", text)
+
+    def display_header_and_status(self, header, status, indicator=-1):
+        """
+        Display a header on top of the screen, a string in the center and an icon on the bottom right
+
+        :param header: The heading to be displayed on top of the screen
+        :param status: The text to display in the screen center
+        :param indicator: Ranging from 0 to 3
+        :return: None
+        """
+
+        self.post("display_header_and_status", header, status, indicator=indicator)
+
+    def display_progress(self, header, progress):
+        """
+        Display a progress bar in the center of the screen along with a header on top
+
+        :param header: Header for the screen
+        :param progress: Progress bar to display
+        :return: None
+        """
+
+        self.post("display_progress", header, progress)
+
+    def display_diagnostics(self, header, lines):
+        """
+        Display a header on top of the screen followed by up to four lines of text
+
+        :param header: Header for the screen
+        :param lines: A list of strings to display
+        :return: None
+        """
+
+        self.post("display_diagnostics", header, lines)
+
+    def add_text(self, text, pos):
+        """
+        Add text to a specific position on the screen
+
+        :param text: String to be displayed
+        :param pos: Position to display the string
+        :return: None
+        """
+
+        self.post("add_text", text, pos)
+
+    def get_system_properties(self):
+        """
+        Get the system properties, queried directly from the display
+
+        :return: A tuple of queried system properties
+        """
+
+        return self.display.get_system_properties()
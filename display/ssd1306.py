@@ -1,24 +1,30 @@
-import os
-import psutil
-import subprocess
-from luma.core.interface.serial import i2c
 from luma.core.render import canvas
-from luma.oled.device import ssd1306
 from PIL import Image, ImageDraw, ImageFont
+from display.render import TextCache, FramePusher
+from sysinfo import SystemSampler
+import hal
 
 
 class Display:
 
-    def __init__(self, i2c_port=0, address=0x3C, logo_loc=None):
+    def __init__(self, i2c_port=0, address=0x3C, logo_loc=None, sampler=None):
 
         # Create device
-        serial = i2c(port=i2c_port, address=address)
-        self.device = ssd1306(serial)
+        self.device = hal.oled_device(i2c_port=i2c_port, address=address)
         self.font = ImageFont.truetype('DejaVuSans.ttf', 11)
         self.font_large = ImageFont.truetype('DejaVuSans-Bold.ttf', 14)
+        self.font_default = ImageFont.load_default()
 
         # Default items
         self.logo_location = logo_loc
+        self.sampler = sampler if sampler is not None else SystemSampler()
+
+        # Render caches
+        self.text_cache = TextCache()
+        self.image_cache = {}
+        self.indicator_cache = {}
+        self.system_props_base = None
+        self.pusher = FramePusher(self.device)
 
     def get_canvas(self):
 
@@ -28,35 +34,34 @@ class Display:
         :return: luma canvas
         """
 
+        # The canvas writes the full frame directly
+        self.pusher.invalidate()
         return canvas(self.device)
 
-    def get_system_properties(self):
+    def set_power(self, on):
 
         """
-        Get the system properties. Temperature, SD Card memory, RAM, and CPU Frequency
+        Switch the display panel on or off. The display memory is retained while off
 
-        :return: A tuple of queried system properties
+        :param on: True to switch the panel on
+        :return: None
         """
 
-        # Get SD card remaining memory
-        st = os.statvfs('/')
-        free_memory = (st.f_bavail * st.f_frsize) / 1024 / 1024 / 1000  # Convert to GB
+        if on:
+            self.device.show()
+        else:
+            self.device.hide()
 
-        # Get RAM usage
-        ram = psutil.virtual_memory()
-        ram_free = ram.available / 1024 / 1024 / 1000  # Convert to GB
+    def get_system_properties(self):
 
-        # Get CPU clock frequency
-        clock_freq = subprocess.check_output(
-            "vcgencmd measure_clock arm", shell=True).decode('utf-8')
-        clock_freq = int(clock_freq.split('=')[1].strip()) / 1e9  # Convert to GHz
+        """
+        Get the system properties. Temperature, SD Card memory, RAM, and CPU Frequency
 
-        # Get CPU temperature
-        cpu_temp = subprocess.check_output(
-            "vcgencmd measure_temp", shell=True).decode('utf-8')
-        cpu_temp = float(cpu_temp.split('=')[1].split("'")[0])  # Extract temperature
+        :return: A tuple of queried system properties
+        """
 
-        return free_memory, ram_free, clock_freq, cpu_temp
+        properties = self.sampler.get()
+        return properties.free_memory, properties.ram_free, properties.clock_freq, properties.cpu_temp
 
     def display_default_image(self):
 
@@ -69,59 +74,101 @@ class Display:
         if self.logo_location is not None:
             self.display_image(self.logo_location)
 
-    def display_system_props(self):
+    def new_frame(self):
 
         """
-        Display the system properties on the OLED screen
+        Create a blank frame of the display size
+
+        :return: 1-bit image
+        """
+
+        return Image.new('1', (self.device.width, self.device.height))
 
+    def show(self, frame):
+
+        """
+        Send a frame to the display. Only the parts that changed since the last frame are transferred
+
+        :param frame: 1-bit image of the display size
         :return: None
         """
 
-        # Get the logo
-        logo = Image.open(self.logo_location).convert('RGBA')
+        self.pusher.push(frame)
 
-        # Resize the image, ensuring the aspect ratio
-        # Original dimensions
-        orig_width, orig_height = logo.size
-        # Desired dimensions
-        max_width, max_height = self.device.width // 2, self.device.height
-        # Aspect ratio
-        aspect_ratio = orig_width / orig_height
+    def fit_image(self, image_location, max_width, max_height):
 
-        # Determine new dimensions
-        if (max_width / aspect_ratio) <= max_height:
-            new_width = max_width
-            new_height = int(max_width / aspect_ratio)
-        else:
-            new_height = max_height
-            new_width = int(max_height * aspect_ratio)
+        """
+        Load an image and resize it to fit the given box, ensuring the aspect ratio
 
-        # Resize image maintaining aspect ratio
-        logo = logo.resize((new_width, new_height))
+        :param image_location: Location of the image file
+        :param max_width: Maximum width of the resized image
+        :param max_height: Maximum height of the resized image
+        :return: The resized image
+        """
 
-        # Create a new blank image with the display size
-        final_image = Image.new('1', (self.device.width, self.device.height))
-        # Paste the resized image onto the blank image
-        x_offset = 0
-        y_offset = (self.device.height - new_height) // 2
-        final_image.paste(logo, (x_offset, y_offset))
+        key = (image_location, max_width, max_height)
+        if key not in self.image_cache:
+            image = Image.open(image_location).convert('RGBA')
+
+            # Original dimensions
+            orig_width, orig_height = image.size
+            # Aspect ratio
+            aspect_ratio = orig_width / orig_height
+
+            # Determine new dimensions
+            if (max_width / aspect_ratio) <= max_height:
+                new_width = max_width
+                new_height = int(max_width / aspect_ratio)
+            else:
+                new_height = max_height
+                new_width = int(max_height * aspect_ratio)
+
+            self.image_cache[key] = image.resize((new_width, new_height))
+        return self.image_cache[key]
+
+    def system_props_layout(self):
+
+        """
+        Static part of the system properties screen. The logo on the left and the ready status, rendered once
+
+        :return: 1-bit image
+        """
+
+        if self.system_props_base is None:
+            final_image = self.new_frame()
+            if self.logo_location is not None:
+                logo = self.fit_image(self.logo_location, self.device.width // 2, self.device.height)
+                # Paste the resized image onto the blank image
+                y_offset = (self.device.height - logo.height) // 2
+                final_image.paste(logo, (0, y_offset))
+            self.text_cache.paste(final_image, "Ready!", self.font, (self.device.width // 2, 50))
+            self.system_props_base = final_image
+        return self.system_props_base
+
+    def display_system_props(self):
+
+        """
+        Display the system properties on the OLED screen
+
+        :return: None
+        """
+
+        final_image = self.system_props_layout().copy()
 
         # Get system properties
         free_memory, ram_free, clock_freq, cpu_temp = self.get_system_properties()
 
         # Draw system properties on the right side
-        draw = ImageDraw.Draw(final_image)
         text_x = self.device.width // 2
         text_y = 0
 
-        draw.text((text_x, text_y), f"SD   : {free_memory:.0f}", font=self.font, fill=255)
-        draw.text((text_x, text_y + 10), f"RAM : {ram_free:.1f}", font=self.font, fill=255)
-        draw.text((text_x, text_y + 20), f"Freq : {clock_freq:.0f}", font=self.font, fill=255)
-        draw.text((text_x, text_y + 30), f"Temp: {cpu_temp:.0f}C", font=self.font, fill=255)
-        draw.text((text_x, text_y + 50), "Ready!", font=self.font, fill=255)
+        self.text_cache.paste(final_image, f"SD   : {free_memory:.0f}", self.font, (text_x, text_y))
+        self.text_cache.paste(final_image, f"RAM : {ram_free:.1f}", self.font, (text_x, text_y + 10))
+        self.text_cache.paste(final_image, f"Freq : {clock_freq:.0f}", self.font, (text_x, text_y + 20))
+        self.text_cache.paste(final_image, f"Temp: {cpu_temp:.0f}C", self.font, (text_x, text_y + 30))
 
         # Display the final image
-        self.device.display(final_image)
+        self.show(final_image)
 
     def display_image(self, image_location):
 
@@ -133,36 +180,16 @@ class Display:
         :return: None
         """
 
-        # Get the logo
-        logo = Image.open(image_location).convert('RGBA')
-
-        # Resize the image, ensuring the aspect ratio
-        # Original dimensions
-        orig_width, orig_height = logo.size
-        # Desired dimensions
         max_width, max_height = self.device.width, self.device.height
-        # Aspect ratio
-        aspect_ratio = orig_width / orig_height
+        logo = self.fit_image(image_location, max_width, max_height)
 
-        # Determine new dimensions
-        if (max_width / aspect_ratio) <= max_height:
-            new_width = max_width
-            new_height = int(max_width / aspect_ratio)
-        else:
-            new_height = max_height
-            new_width = int(max_height * aspect_ratio)
-
-        # Resize image maintaining aspect ratio
-        logo = logo.resize((new_width, new_height))
-
-        # Create a new blank image with the display size
-        final_image = Image.new('1', (max_width, max_height))
         # Paste the resized image onto the blank image
-        x_offset = (max_width - new_width) // 2
-        y_offset = (max_height - new_height) // 2
+        final_image = self.new_frame()
+        x_offset = (max_width - logo.width) // 2
+        y_offset = (max_height - logo.height) // 2
         final_image.paste(logo, (x_offset, y_offset))
 
-        self.device.display(final_image)
+        self.show(final_image)
 
     def display_centered_text(self, text):
 
@@ -173,17 +200,36 @@ class Display:
         :return:
         """
 
-        # Load a TTF font (use a truetype font from your system)
-        font = ImageFont.load_default()
+        final_image = self.new_frame()
+        self.text_cache.paste_centered(final_image, text, self.font_default)
+        self.show(final_image)
+
+    def indicator_icon(self, indicator):
 
-        with self.get_canvas() as draw:
-            # Calculate text size and position
-            text_width, text_height = draw.textsize(text, font=font)
-            text_x = (self.device.width - text_width) // 2
-            text_y = (self.device.height - text_height) // 2
+        """
+        Bitmap of the GPS fix indicator, rendered once per indicator value
+
+        :param indicator: Ranging from 0 to 3
+        :return: 1-bit image, or None if there is no icon for the indicator
+        """
 
-            # Draw the text
-            draw.text((text_x, text_y), text, font=font, fill=255)
+        if indicator not in self.indicator_cache:
+            indicator_size = 10
+            icon = Image.new('1', (indicator_size + 1, indicator_size + 1))
+            draw = ImageDraw.Draw(icon)
+            if indicator == 0:
+                draw.text((0, 0), "?", font=self.font, fill=255)
+            elif indicator == 1:
+                draw.line((0, 0, indicator_size, indicator_size), fill=255)
+                draw.line((indicator_size, 0, 0, indicator_size), fill=255)
+            elif indicator == 2:
+                draw.ellipse((0, 0, indicator_size, indicator_size), outline=255, fill=0)
+            elif indicator == 3:
+                draw.ellipse((0, 0, indicator_size, indicator_size), outline=255, fill=255)
+            else:
+                icon = None
+            self.indicator_cache[indicator] = icon
+        return self.indicator_cache[indicator]
 
     def display_header_and_status(self, header, status, indicator=-1):
 
@@ -197,40 +243,21 @@ class Display:
         :return: None
         """
 
-        final_image = Image.new('1', (self.device.width, self.device.height))
-        draw = ImageDraw.Draw(final_image)
-
-        # Draw header
-        header_width, header_height = draw.textsize(header, font=self.font_large)
-        header_x = (self.device.width - header_width) // 2
-        header_y = 0
-        draw.text((header_x, header_y), header, font=self.font_large, fill=255)
+        final_image = self.new_frame()
 
-        # Draw status
-        status_width, status_height = draw.textsize(status, font=self.font)
-        status_x = (self.device.width - status_width) // 2
-        status_y = (self.device.height - status_height) // 2
-        draw.text((status_x, status_y), status, font=self.font, fill=255)
+        # Draw header and status
+        self.text_cache.paste_centered(final_image, header, self.font_large, y=0)
+        self.text_cache.paste_centered(final_image, status, self.font)
 
         # Draw GPS Fix indicator
-        indicator_size = 10
-        indicator_x = self.device.width - indicator_size - 5
-        indicator_y = self.device.height - indicator_size - 5
-        if indicator == 0:
-            draw.text((indicator_x, indicator_y), "?", font=self.font, fill=255)
-        elif indicator == 1:
-            draw.line((indicator_x, indicator_y, indicator_x + indicator_size, indicator_y + indicator_size), fill=255)
-            draw.line((indicator_x + indicator_size, indicator_y, indicator_x, indicator_y + indicator_size), fill=255)
-        elif indicator == 2:
-            draw.ellipse((indicator_x, indicator_y, indicator_x + indicator_size, indicator_y + indicator_size),
-                         outline=255, fill=0)
-        elif indicator == 3:
-            draw.ellipse((indicator_x, indicator_y, indicator_x + indicator_size, indicator_y + indicator_size),
-                         outline=255, fill=255)
-        else:
-            pass
+        icon = self.indicator_icon(indicator)
+        if icon is not None:
+            indicator_size = 10
+            indicator_x = self.device.width - indicator_size - 5
+            indicator_y = self.device.height - indicator_size - 5
+            final_image.paste(icon, (indicator_x, indicator_y))
 
-        self.device.display(final_image)
+        self.show(final_image)
 
     def display_progress(self, header, progress):
 
@@ -242,14 +269,11 @@ class Display:
         :return: None
         """
 
-        final_image = Image.new('1', (self.device.width, self.device.height))
+        final_image = self.new_frame()
         draw = ImageDraw.Draw(final_image)
 
         # Draw header
-        header_width, header_height = draw.textsize(header, font=self.font_large)
-        header_x = (self.device.width - header_width) // 2
-        header_y = 0
-        draw.text((header_x, header_y), header, font=self.font_large, fill=255)
+        self.text_cache.paste_centered(final_image, header, self.font_large, y=0)
 
         # Draw progress bar
         bar_width = int(self.device.width * 0.8)
@@ -263,7 +287,23 @@ class Display:
         fill_width = int(bar_width * progress)
         draw.rectangle((bar_x, bar_y, bar_x + fill_width, bar_y + bar_height), outline=255, fill=255)
 
-        self.device.display(final_image)
+        self.show(final_image)
+
+    def display_diagnostics(self, header, lines):
+
+        """
+        Display a header on top of the screen followed by up to four lines of text
+
+        :param header: Header for the screen
+        :param lines: A list of strings to display
+        :return: None
+        """
+
+        final_image = self.new_frame()
+        self.text_cache.paste_centered(final_image, header, self.font_large, y=0)
+        for index, line in enumerate(lines[:4]):
+            self.text_cache.paste(final_image, line, self.font, (0, 15 + index * 12))
+        self.show(final_image)
 
     def add_text(self, text, pos):
 
@@ -275,7 +315,8 @@ class Display:
         :return: None
         """
 
-        with self.get_canvas() as draw:
-            draw.text(pos, text, font=self.font, fill=255)
+        final_image = self.new_frame()
+        self.text_cache.paste(final_image, text, self.font, pos)
+        self.show(final_image)
 
 
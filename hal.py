@@ -0,0 +1,150 @@
+import os
+import subprocess
+
+
+# Backend selection, "hardware" on the Pi or "sim" for the simulated devices
+SIMULATED = os.environ.get("DRIVESENSE_HAL", "hardware") == "sim"
+
+# Shared simulated devices, created on first use
+_simulation = None
+
+
+def enable_simulation(**kwargs):
+    """
+    Switch to the simulated backends. Has to be called before the device modules are imported
+
+    :param kwargs: Options for the simulation, see simulator.simulation.Simulation
+    :return: The simulation
+    """
+
+    global SIMULATED, _simulation
+    from simulator.simulation import Simulation
+
+    SIMULATED = True
+    if _simulation is None:
+        _simulation = Simulation(**kwargs)
+    return _simulation
+
+
+def simulation():
+    """
+    The shared simulated devices, configured from the environment if not enabled explicitly
+
+    :return: The simulation
+    """
+
+    if _simulation is None:
+        enable_simulation(odr_hz=float(os.environ.get("DRIVESENSE_SIM_ODR", 0)) or None)
+    return _simulation
+
+
+def gpio():
+    """
+    The GPIO module
+
+    :return: RPi.GPIO, or the simulated GPIO
+    """
+
+    if SIMULATED:
+        return simulation().gpio
+    import RPi.GPIO as GPIO
+    return GPIO
+
+
+def spi_device():
+    """
+    A new SPI device handle
+
+    :return: A spidev.SpiDev, or a handle to the simulated IMU
+    """
+
+    if SIMULATED:
+        return simulation().spi_device()
+    import spidev
+    return spidev.SpiDev()
+
+
+def gps_client(host="127.0.0.1", port=2947):
+    """
+    A gpsd client in watch mode
+
+    :param host: gpsd host
+    :param port: gpsd port
+    :return: A gps.gps client, or a plain JSON client for the simulated gpsd
+    """
+
+    if SIMULATED:
+        from simulator.gpsd_sim import GpsdClient
+        gpsd = simulation().start_gpsd(replay=os.environ.get("DRIVESENSE_SIM_GPS_REPLAY"))
+        return GpsdClient(host=host, port=gpsd.port)
+    import gps
+    return gps.gps(host=host, port=str(port), mode=gps.WATCH_ENABLE)
+
+
+def statvfs(path):
+    """
+    File system statistics of the storage
+
+    :param path: A path on the file system
+    :return: An os.statvfs_result, of the simulated card if one is inserted
+    """
+
+    if SIMULATED:
+        return simulation().statvfs(path)
+    return os.statvfs(path)
+
+
+def ismount(path):
+    """
+    Whether a drive is mounted at a path
+
+    :param path: The mount point
+    :return: True, if a drive is mounted, or the simulated USB drive is inserted there
+    """
+
+    if SIMULATED:
+        return simulation().ismount(path)
+    return os.path.ismount(path)
+
+
+def unmount(path):
+    """
+    Unmount a drive
+
+    :param path: The mount point
+    :return: None
+    """
+
+    if SIMULATED:
+        return simulation().unmount(path)
+    subprocess.run(["sudo", "umount", path], check=True)
+
+
+def oled_device(i2c_port=0, address=0x3C):
+    """
+    The OLED device
+
+    :param i2c_port: I2C bus
+    :param address: I2C address
+    :return: A luma ssd1306 device, or the simulated SSD1306
+    """
+
+    if SIMULATED:
+        return simulation().oled
+    from luma.core.interface.serial import i2c
+    from luma.oled.device import ssd1306
+    return ssd1306(i2c(port=i2c_port, address=address))
+
+
+def button_pin_factory():
+    """
+    Use mock pins for the gpiozero buttons when simulated
+
+    :return: None
+    """
+
+    if SIMULATED:
+        from gpiozero import Device
+        from gpiozero.pins.mock import MockFactory
+        if not isinstance(Device.pin_factory, MockFactory):
+            Device.pin_factory = MockFactory()
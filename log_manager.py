@@ -0,0 +1,165 @@
+import os
+import gzip
+import queue
+import shutil
+import atexit
+import logging
+import threading
+import logging.handlers
+
+
+class LogManager:
+    """
+    Responsible for the application log files. Every boot gets a new log id, the live log is rotated on size, closed
+    logs are compressed and only a bounded number of logs are kept. Records are handed to a queue so that the logging
+    calls never block on the SD card.
+    """
+
+    INDEX_FILE = "log.index"
+
+    def __init__(self, log_directory="/var/drivesense/logs", max_bytes=1024 * 1024, backup_count=3, max_logs=50,
+                 log_format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO):
+        self.log_directory = log_directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.max_logs = max_logs
+        self.log_format = log_format
+        self.level = level
+
+        self.log_id = None
+        self.log_file = None
+        self.listener = None
+        self.log_queue = queue.SimpleQueue()
+
+    def next_log_id(self):
+        """
+        Allocate the id for the current boot from the index file. Falls back to a directory scan if the index is
+        missing or corrupt
+
+        :return: The allocated log id
+        """
+
+        index_path = os.path.join(self.log_directory, self.INDEX_FILE)
+        try:
+            with open(index_path, "r") as fh:
+                log_id = int(fh.read().strip())
+        except (OSError, ValueError):
+            log_id = max(self.existing_log_ids(), default=0) + 1
+
+        # Persist the next id atomically
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(str(log_id + 1))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, index_path)
+
+        return log_id
+
+    def existing_log_ids(self):
+        """
+        Scan the log directory for the ids of the stored logs
+
+        :return: A set of log ids
+        """
+
+        log_ids = set()
+        for file_name in os.listdir(self.log_directory):
+            prefix = file_name.split(".")[0]
+            if ".log" in file_name and prefix.isdigit():
+                log_ids.add(int(prefix))
+        return log_ids
+
+    @staticmethod
+    def gzip_namer(name):
+        """
+        Name of the rotated log file
+
+        :param name: Default name given by the rotating handler
+        :return: The name with the gzip extension
+        """
+
+        return name + ".gz"
+
+    @staticmethod
+    def gzip_rotator(source, dest):
+        """
+        Compress the rotated log file
+
+        :param source: The closed log file
+        :param dest: Path to the compressed file
+        :return: None
+        """
+
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def compress_and_prune(self):
+        """
+        Compress the logs closed in previous boots and remove the oldest logs beyond the count limit
+
+        :return: None
+        """
+
+        logger = logging.getLogger(self.__class__.__name__)
+        try:
+            for file_name in os.listdir(self.log_directory):
+                prefix = file_name.split(".")[0]
+                if file_name.endswith(".log") and prefix.isdigit() and int(prefix) != self.log_id:
+                    full_path = os.path.join(self.log_directory, file_name)
+                    self.gzip_rotator(full_path, full_path + ".gz")
+
+            # Keep the newest logs, including the current one
+            old_ids = sorted(self.existing_log_ids() - {self.log_id})
+            stale_ids = set(old_ids[:max(0, len(old_ids) - self.max_logs + 1)])
+            for file_name in os.listdir(self.log_directory):
+                prefix = file_name.split(".")[0]
+                if prefix.isdigit() and int(prefix) in stale_ids:
+                    os.remove(os.path.join(self.log_directory, file_name))
+        except Exception as e:
+            logger.error(f"Error compressing old logs: {e}")
+
+    def start(self):
+        """
+        Create the log file for this boot and attach the queue based handlers to the root logger
+
+        :return: Path to the current log file
+        """
+
+        os.makedirs(self.log_directory, exist_ok=True)
+        self.log_id = self.next_log_id()
+        self.log_file = os.path.join(self.log_directory, f"{self.log_id}.log")
+
+        formatter = logging.Formatter(self.log_format)
+        file_handler = logging.handlers.RotatingFileHandler(self.log_file, maxBytes=self.max_bytes,
+                                                            backupCount=self.backup_count)
+        file_handler.namer = self.gzip_namer
+        file_handler.rotator = self.gzip_rotator
+        file_handler.setFormatter(formatter)
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+
+        # Writes to the handlers happen on the listener thread
+        self.listener = logging.handlers.QueueListener(self.log_queue, file_handler, stream_handler)
+        self.listener.start()
+        root_logger = logging.getLogger()
+        root_logger.setLevel(self.level)
+        root_logger.addHandler(logging.handlers.QueueHandler(self.log_queue))
+        atexit.register(self.stop)
+
+        # Housekeeping off the startup path
+        threading.Thread(target=self.compress_and_prune, daemon=True).start()
+
+        return self.log_file
+
+    def stop(self):
+        """
+        Flush the pending records and stop the listener thread
+
+        :return: None
+        """
+
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
@@ -1,43 +1,67 @@
-import os
 import time
-import logging
-import os
-from display.ssd1306 import Display
-from data_handler import DataHandler
-from datetime import datetime
+from profiler import StartupProfiler
+
+# Startup timing
+startup_profiler = StartupProfiler()
+
+with startup_profiler.phase("imports"):
+    import os
+    import logging
+    from log_manager import LogManager
+    from display.ssd1306 import Display
+    from display.service import DisplayService
+    from sysinfo import SystemSampler
+    from metrics import REGISTRY, MetricsServer, DiagnosticsPage
+    from data_handler import DataHandler
+    import realtime
 
 # Initialize logging
-log_directory = "/var/drivesense/logs"
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-# Create log file
-log_files = os.listdir(log_directory)
-log_file_ids = [int(x.split(".")[0]) for x in log_files if x.split(".")[-1] == "log"]
-if log_file_ids:
-    log_file_id = str(max(log_file_ids) + 1)
-else:
-    log_file_id = "1"
-log_file = os.path.join(log_directory, log_file_id + ".log")
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
+with startup_profiler.phase("logging"):
+    log_manager = LogManager(log_directory="/var/drivesense/logs")
+    log_manager.start()
 logger = logging.getLogger(__name__)
 
 # GPS Info
 gps_fix_state = [0]
 
-# Initialize Display
+# Display
 script_dir = os.path.dirname(os.path.abspath(__file__))
 image_path = os.path.join(script_dir, 'images', 'uw-logo.png')
-oled_display = Display(logo_loc=image_path)
-# Data Handler
-data_handler = DataHandler(display=oled_display, gps_fix_state=gps_fix_state)
+
+# Diagnostics screen during the DAQ
+show_diagnostics = True
+
+# Low power acquisition, the display only wakes on demand during the DAQ
+low_power = False
+
+# Sensors to record, the GPS and IMU pollers are used if the file does not exist
+sensor_config = "/var/drivesense/sensors.json"
+
+# Processing of the IMU samples during the DAQ, e.g. ["orientation", "events", "summary"]
+imu_stages = ["summary"]
+
+# Read the IMU in a process of its own, so that the rest of the application cannot delay the FIFO reads
+imu_process = False
+
+# Real time reads of the IMU, the SCHED_FIFO priority and the CPU reserved for the reads. None for normal scheduling
+imu_realtime_priority = 50
+imu_cpu = 3
+
+# Upload of the trials to the collection server while idle, e.g. "http://collector.local:8080/uploads". None to
+# disable. The rate limit is in bytes per second, pruning removes the uploaded trials from the card
+upload_url = None
+upload_rate_limit = 1_000_000
+upload_prune = False
+
+# Acquisition profile of the IMU, GPS and writer settings, set from the USB drive with a setProfile system config
+profile_file = "/var/drivesense/profile.json"
+
+# Live stream of the decimated IMU samples, the GPS fixes and health over UDP, e.g. 9106. None to disable
+telemetry_port = None
+
+# Free space in MB at which a trial is stopped, and the recording times left in minutes to warn at
+storage_floor_mb = 200
+storage_warn_minutes = (30, 10, 5)
 
 
 # Version
@@ -47,26 +71,73 @@ def get_version():
         return vf.read().strip()
 
 
-if __name__ == '__main__':
+def main():
 
     # Log the application version
     version = get_version()
     logger.info(f'Starting application. Version - {version}')
 
-    # Initialize the system
-    oled_display.display_header_and_status("System Check", f"Initializing v{version}...")
-    time.sleep(2)
+    # Keep the application off the CPU of the IMU reads. The IMU process locks its own memory
+    with startup_profiler.phase("realtime"):
+        if realtime.reserve_cpu(imu_cpu) and not imu_process:
+            realtime.lock_memory()
+
+    # Initialize Display
+    with startup_profiler.phase("display init"):
+        system_sampler = SystemSampler()
+        system_sampler.start(interval=10)
+        oled_display = DisplayService(Display(logo_loc=image_path, sampler=system_sampler))
+        oled_display.start()
+        # Splash until the buttons are armed
+        oled_display.display_header_and_status("System Check", f"Initializing v{version}...")
+
+    # Metrics
+    def collect_system_metrics(registry):
+        properties = system_sampler.get()
+        registry.gauge("cpu_temperature_celsius", "CPU temperature").set(properties.cpu_temp)
+        registry.gauge("cpu_frequency_ghz", "CPU clock frequency").set(properties.clock_freq)
+        registry.gauge("cpu_throttled", "Firmware throttled state").set(properties.throttled)
+        registry.gauge("cpu_load", "One minute load average").set(os.getloadavg()[0])
+        registry.gauge("storage_free_gb", "Free storage").set(properties.free_memory)
+
+    REGISTRY.register_collector(collect_system_metrics)
+    diagnostics_page = DiagnosticsPage(REGISTRY)
+
     # Data handler
-    data_handler.initialize()
+    data_handler = DataHandler(display=oled_display, gps_fix_state=gps_fix_state, low_power=low_power,
+                               sensor_config=sensor_config, imu_stages=imu_stages, imu_process=imu_process,
+                               imu_realtime_priority=imu_realtime_priority, imu_cpu=imu_cpu, upload_url=upload_url,
+                               upload_rate_limit=upload_rate_limit, upload_prune=upload_prune,
+                               telemetry_port=telemetry_port, profile_file=profile_file,
+                               storage_floor_mb=storage_floor_mb, storage_warn_minutes=storage_warn_minutes)
+    data_handler.initialize(profiler=startup_profiler)
+    startup_profiler.report()
+
+    # Live metrics
+    metrics_server = MetricsServer(REGISTRY, address=("127.0.0.1", 9105))
+    metrics_server.start()
 
     # Wait indefinitely
+    page = 0
     while True:
-        if data_handler.daq_status:
-            current_time = time.monotonic()
-            elapsed = current_time - data_handler.daq_start
-            oled_display.display_header_and_status("DAQ", f"Elapsed time: {round(elapsed/60)} min", indicator=gps_fix_state[0])
+        interval = 60
+        if data_handler.daq_status and low_power:
+            pass
+        elif data_handler.daq_status:
+            if show_diagnostics and page % 2:
+                oled_display.display_diagnostics("Diagnostics", diagnostics_page.lines())
+            else:
+                oled_display.display_header_and_status("DAQ", data_handler.daq_status_text(), indicator=gps_fix_state[0])
+            # Rotate between the DAQ and diagnostics screens
+            if show_diagnostics:
+                page += 1
+                interval = 5
         elif data_handler.copy_status:
             pass
         else:
             oled_display.display_system_props()
-        time.sleep(60)
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+import os
+import time
+import bisect
+import logging
+import threading
+import socketserver
+
+
+class Counter:
+    """
+    Monotonically increasing value. Updates take no lock, every instrument is expected to have a single writer thread
+    """
+
+    __slots__ = ("name", "help", "labels", "value")
+    kind = "counter"
+
+    def __init__(self, name, help_text="", labels=""):
+        """
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: The labels of the metric, formatted
+        """
+
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        Increase the value
+
+        :param amount: Amount to add
+        :return: None
+        """
+
+        self.value += amount
+
+
+class Gauge:
+    """
+    Value that can go up and down
+    """
+
+    __slots__ = ("name", "help", "labels", "value")
+    kind = "gauge"
+
+    def __init__(self, name, help_text="", labels=""):
+        """
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: The labels of the metric, formatted
+        """
+
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value):
+        """
+        Set the value
+
+        :param value: The new value
+        :return: None
+        """
+
+        self.value = value
+
+    def inc(self, amount=1):
+        """
+        Increase the value
+
+        :param amount: Amount to add
+        :return: None
+        """
+
+        self.value += amount
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets
+    """
+
+    __slots__ = ("name", "help", "labels", "buckets", "counts", "sum", "count")
+    kind = "histogram"
+
+    def __init__(self, name, help_text="", labels="", buckets=(0.001, 0.01, 0.1, 1, 10)):
+        """
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: The labels of the metric, formatted
+        :param buckets: Upper bounds of the buckets
+        """
+
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Count a value in its bucket
+
+        :param value: The observed value
+        :return: None
+        """
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Holds the instruments of the application. Instruments are created once and then updated directly from the hot paths
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.instruments = {}
+        self.collectors = []
+
+    def get_or_create(self, cls, name, help_text, labels, **kwargs):
+        """
+        Get an instrument, creating it on first use
+
+        :param cls: The instrument class
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: A dict of labels for the metric
+        :return: The instrument
+        """
+
+        label_string = ",".join(f'{key}="{value}"' for key, value in sorted((labels or {}).items()))
+        key = (name, label_string)
+        with self.lock:
+            instrument = self.instruments.get(key)
+            if instrument is None:
+                instrument = cls(name, help_text, label_string, **kwargs)
+                self.instruments[key] = instrument
+            elif not isinstance(instrument, cls):
+                raise ValueError(f"Metric {name} already registered as a {instrument.kind}")
+        return instrument
+
+    def counter(self, name, help_text="", labels=None):
+        """
+        Get a counter, creating it on first use
+
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: A dict of labels for the metric
+        :return: The Counter
+        """
+
+        return self.get_or_create(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", labels=None):
+        """
+        Get a gauge, creating it on first use
+
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: A dict of labels for the metric
+        :return: The Gauge
+        """
+
+        return self.get_or_create(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", labels=None, buckets=(0.001, 0.01, 0.1, 1, 10)):
+        """
+        Get a histogram, creating it on first use
+
+        :param name: Name of the metric
+        :param help_text: Description of the metric
+        :param labels: A dict of labels for the metric
+        :param buckets: Upper bounds of the buckets
+        :return: The Histogram
+        """
+
+        return self.get_or_create(Histogram, name, help_text, labels, buckets=buckets)
+
+    def value(self, name, labels=None, default=0):
+        """
+        Current value of a counter or gauge
+
+        :param name: Name of the metric
+        :param labels: A dict of labels for the metric
+        :param default: Returned if the metric does not exist
+        :return: The value
+        """
+
+        label_string = ",".join(f'{key}="{value}"' for key, value in sorted((labels or {}).items()))
+        instrument = self.instruments.get((name, label_string))
+        if instrument is None:
+            return default
+        return instrument.value
+
+    def total(self, name):
+        """
+        Sum of a counter or gauge over all of its labels
+
+        :param name: Name of the metric
+        :return: The summed value
+        """
+
+        with self.lock:
+            instruments = [x for x in self.instruments.values() if x.name == name]
+        return sum(x.value for x in instruments if not isinstance(x, Histogram))
+
+    def register_collector(self, collector):
+        """
+        Register a callback that refreshes gauges right before the metrics are exported
+
+        :param collector: A callable taking the registry as argument
+        :return: None
+        """
+
+        self.collectors.append(collector)
+
+    def collect(self):
+        """
+        Run the registered collectors
+
+        :return: None
+        """
+
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logging.getLogger(self.__class__.__name__).error(f"Error in metrics collector: {e}")
+
+    def render(self):
+        """
+        Export the metrics in the Prometheus text format
+
+        :return: The exported string
+        """
+
+        self.collect()
+        with self.lock:
+            instruments = sorted(self.instruments.values(), key=lambda x: (x.name, x.labels))
+
+        lines = []
+        described = set()
+        for instrument in instruments:
+            if instrument.name not in described:
+                described.add(instrument.name)
+                if instrument.help:
+                    lines.append(f"# HELP {instrument.name} {instrument.help}")
+                lines.append(f"# TYPE {instrument.name} {instrument.kind}")
+
+            if isinstance(instrument, Histogram):
+                prefix = instrument.labels + "," if instrument.labels else ""
+                cumulative = 0
+                counts = list(instrument.counts)
+                for bound, count in zip(instrument.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f'{instrument.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+                suffix = "{" + instrument.labels + "}" if instrument.labels else ""
+                lines.append(f"{instrument.name}_sum{suffix} {instrument.sum}")
+                lines.append(f"{instrument.name}_count{suffix} {instrument.count}")
+            else:
+                suffix = "{" + instrument.labels + "}" if instrument.labels else ""
+                lines.append(f"{instrument.name}{suffix} {instrument.value}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Registry shared by the application
+REGISTRY = MetricsRegistry()
+
+
+class DiagnosticsPage:
+    """
+    Formats the live metrics for the diagnostics screen. Rates are computed between consecutive calls
+    """
+
+    def __init__(self, registry=REGISTRY):
+        """
+        :param registry: The registry of the metrics
+        """
+
+        self.registry = registry
+        self.previous = None
+
+    def lines(self):
+        """
+        Lines for the diagnostics screen
+
+        :return: A list of strings
+        """
+
+        self.registry.collect()
+        now = time.monotonic()
+        current = (now, self.registry.total("imu_samples_total"), self.registry.total("writer_bytes_total"))
+        if self.previous is None or now <= self.previous[0]:
+            sample_rate, write_rate = 0, 0
+        else:
+            interval = now - self.previous[0]
+            sample_rate = (current[1] - self.previous[1]) / interval
+            write_rate = (current[2] - self.previous[2]) / interval / 1024
+        self.previous = current
+
+        return [
+            f"IMU {sample_rate:.0f}S/s Q {self.registry.value('imu_queue_depth'):.0f}",
+            f"Disk {write_rate:.0f}KB/s",
+            f"GPS sat {self.registry.value('gps_satellites_used'):.0f} fix {self.registry.value('gps_fix_mode'):.0f}",
+            f"CPU {self.registry.value('cpu_load'):.2f} {self.registry.value('cpu_temperature_celsius'):.0f}C",
+        ]
+
+
+class MetricsRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Responds with the exported metrics. HTTP requests get a HTTP response, anything else gets the plain text once the
+    client sent a line or stayed silent for the timeout
+    """
+
+    timeout = 1
+
+    def handle(self):
+        """
+        Write the metrics to the client
+
+        :return: None
+        """
+
+        try:
+            request_line = self.rfile.readline(1024)
+        except OSError:
+            request_line = b""
+        body = self.server.registry.render().encode()
+        if request_line.startswith(b"GET"):
+            # Drain the request headers
+            while self.rfile.readline(1024) not in (b"\r\n", b"\n", b""):
+                pass
+            self.wfile.write(b"HTTP/1.0 200 OK\r\n"
+                             b"Content-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n")
+        self.wfile.write(body)
+
+
+class MetricsTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MetricsUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the metrics on a local socket. A string address is a UNIX socket path, a tuple is a TCP host and port
+    """
+
+    def __init__(self, registry=REGISTRY, address=("127.0.0.1", 9105)):
+        """
+        :param registry: The registry of the metrics
+        :param address: UNIX socket path or TCP host and port
+        """
+
+        threading.Thread.__init__(self, name="MetricsServer", daemon=True)
+        self.registry = registry
+        self.address = address
+        self.server = None
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def run(self):
+        """
+        Start serving the metrics
+
+        :return: None
+        """
+
+        try:
+            if isinstance(self.address, str):
+                if os.path.exists(self.address):
+                    os.remove(self.address)
+                self.server = MetricsUnixServer(self.address, MetricsRequestHandler)
+            else:
+                self.server = MetricsTCPServer(self.address, MetricsRequestHandler)
+        except OSError as e:
+            self.logger.error(f"Could not start metrics server on {self.address}: {e}")
+            return
+
+        self.server.registry = self.registry
+        self.logger.info(f"Serving metrics on {self.address}")
+        self.server.serve_forever()
+
+    def stop(self):
+        """
+        Stop serving the metrics
+
+        :return: None
+        """
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
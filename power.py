@@ -0,0 +1,116 @@
+import os
+import glob
+import time
+import logging
+
+
+class CpuGovernor:
+    """
+    Switches the cpufreq governor of all the CPU policies and restores the previous governors afterwards
+    """
+
+    def __init__(self, cpufreq_path="/sys/devices/system/cpu/cpufreq"):
+        self.cpufreq_path = cpufreq_path
+        self.previous = {}
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def policies(self):
+        """
+        Paths of the governor files of the CPU policies
+
+        :return: A list of paths
+        """
+
+        return sorted(glob.glob(os.path.join(self.cpufreq_path, "policy*", "scaling_governor")))
+
+    def set(self, governor):
+        """
+        Switch to a governor if it is available
+
+        :param governor: Name of the governor, e.g. ondemand or powersave
+        :return: True, if the governor was applied
+        """
+
+        applied = False
+        for path in self.policies():
+            try:
+                available = os.path.join(os.path.dirname(path), "scaling_available_governors")
+                with open(available, "r") as fh:
+                    if governor not in fh.read().split():
+                        continue
+                with open(path, "r") as fh:
+                    self.previous.setdefault(path, fh.read().strip())
+                with open(path, "w") as fh:
+                    fh.write(governor)
+                applied = True
+            except OSError as e:
+                self.logger.warning(f"Could not set governor {governor} on {path}: {e}")
+
+        if applied:
+            self.logger.info(f"CPU governor set to {governor}")
+        return applied
+
+    def restore(self):
+        """
+        Restore the governors that were active before the switch
+
+        :return: None
+        """
+
+        for path, governor in self.previous.items():
+            try:
+                with open(path, "w") as fh:
+                    fh.write(governor)
+            except OSError as e:
+                self.logger.warning(f"Could not restore governor on {path}: {e}")
+        self.previous = {}
+
+
+class PowerMonitor:
+    """
+    Estimates the energy spent by the acquisition from the process CPU time and the number of wakeups. The defaults are
+    rough figures for the Raspberry Pi Zero 2 W
+    """
+
+    def __init__(self, idle_power_w=0.6, core_active_power_w=0.35, wakeup_energy_uj=40):
+        self.idle_power_w = idle_power_w
+        self.core_active_power_w = core_active_power_w
+        self.wakeup_energy_uj = wakeup_energy_uj
+
+        self.start_time = None
+        self.start_cpu = None
+
+    def start(self):
+        """
+        Start a measurement
+
+        :return: None
+        """
+
+        self.start_time = time.monotonic()
+        self.start_cpu = time.process_time()
+
+    def report(self, samples, wakeups):
+        """
+        Summarize the measurement
+
+        :param samples: Number of samples acquired
+        :param wakeups: Number of times the acquisition thread woke up from a sleep, not the polls of a busy loop
+        :return: A dict with the estimates
+        """
+
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        cpu_seconds = time.process_time() - self.start_cpu
+        energy_j = (self.idle_power_w * elapsed + self.core_active_power_w * cpu_seconds +
+                    self.wakeup_energy_uj * 1e-6 * wakeups)
+
+        return {
+            "elapsed_time": elapsed,
+            "cpu_seconds": cpu_seconds,
+            "cpu_utilization": cpu_seconds / elapsed,
+            "wakeups_per_second": wakeups / elapsed,
+            "estimated_energy_j": energy_j,
+            "estimated_energy_per_sample_mj": energy_j * 1e3 / samples if samples else None,
+        }
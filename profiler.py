@@ -0,0 +1,82 @@
+import os
+import time
+import logging
+import contextlib
+
+
+class StartupProfiler:
+    """
+    Records the duration of the startup phases and the time from power-on to ready
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a startup phase
+
+        :param name: Name of the phase
+        :return: None
+        """
+
+        phase_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - phase_start))
+
+    @staticmethod
+    def uptime():
+        """
+        Time since the kernel booted
+
+        :return: Seconds since boot, None if not available
+        """
+
+        try:
+            with open("/proc/uptime", "r") as fh:
+                return float(fh.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @staticmethod
+    def process_age():
+        """
+        Time since the process was started, including the time spent by the loader before the interpreter ran
+
+        :return: Seconds since the process start, None if not available
+        """
+
+        try:
+            with open("/proc/self/stat", "r") as fh:
+                # The fields after the command name, which is in brackets and can contain spaces
+                fields = fh.read().rsplit(")", 1)[1].split()
+            start_ticks = int(fields[19])
+            return StartupProfiler.uptime() - start_ticks / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError, TypeError):
+            return None
+
+    def report(self):
+        """
+        Log the phase timings
+
+        :return: A dict with the timings in seconds
+        """
+
+        timings = {name: duration for name, duration in self.phases}
+        timings["interpreter"] = time.perf_counter() - self.start
+        timings["process"] = self.process_age()
+        timings["boot_to_ready"] = self.uptime()
+
+        phases = ", ".join(f"{name} {duration * 1000:.0f} ms" for name, duration in self.phases)
+        self.logger.info(f"Startup phases: {phases}")
+        self.logger.info(f"Ready after {timings['interpreter']:.2f} s in the interpreter, "
+                         f"{timings['process'] or float('nan'):.2f} s since process start, "
+                         f"{timings['boot_to_ready'] or float('nan'):.2f} s since power-on")
+        return timings
@@ -0,0 +1,188 @@
+import os
+import copy
+import json
+import logging
+
+
+# Acquisition profile of the device until another one is set
+DEFAULT_PROFILE = {
+    "name": "default",
+    "imu": {"odr_hz": 833, "accel_range_g": 16, "gyro_range_dps": 2000, "fifo_threshold": 1920},
+    "gps": {"rate_ms": 100, "baudrate": 115200, "format": "pickle", "prune_nmea": True, "save_to_flash": False},
+    # A buffer size of None leaves the size to the acquisition mode, 4 kB or 64 kB in low power
+    "writer": {"buffer_size": None, "flush": "buffered"},
+}
+
+# Allowed values of the settings, a set of choices, a boolean or an integer range
+SCHEMA = {
+    "imu": {
+        "odr_hz": {"choices": (12.5, 26, 52, 104, 208, 416, 833, 1666, 3332, 6664)},
+        "accel_range_g": {"choices": (2, 4, 8, 16)},
+        "gyro_range_dps": {"choices": (125, 250, 500, 1000, 2000)},
+        # Whole samples of 6 words, below the 2048 words of the FIFO
+        "fifo_threshold": {"min": 6, "max": 2046, "multiple": 6},
+    },
+    "gps": {
+        # Down to 25 Hz, the fastest rate of the receiver
+        "rate_ms": {"min": 40, "max": 10000},
+        "baudrate": {"choices": (9600, 19200, 38400, 57600, 115200)},
+        "format": {"choices": ("pickle", "jsonl")},
+        "prune_nmea": {"type": bool},
+        "save_to_flash": {"type": bool},
+    },
+    "writer": {
+        "buffer_size": {"min": 0, "max": 16 * 1024 * 1024, "nullable": True},
+        "flush": {"choices": ("buffered", "fsync")},
+    },
+}
+
+# Approximate bytes the receiver sends per measurement with the default NMEA output and with the output pruned to
+# what gpsd needs, to check the rate against the baud rate
+GPS_BYTES_PER_FIX = 520
+GPS_BYTES_PER_FIX_PRUNED = 240
+
+# Share of the UART the receiver output may take
+GPS_UART_HEADROOM = 0.8
+
+
+def check_value(value, rule):
+    """
+    Check a setting against its rule
+
+    :param value: The value
+    :param rule: The rule of the schema
+    :return: An error message, None if the value is valid
+    """
+
+    if value is None:
+        return None if rule.get("nullable") else "must be set"
+    if rule.get("type") is bool:
+        return None if isinstance(value, bool) else "must be true or false"
+    if "choices" in rule:
+        if isinstance(value, bool) or value not in rule["choices"]:
+            return f"must be one of {', '.join(str(choice) for choice in rule['choices'])}"
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        return "must be an integer"
+    if not rule["min"] <= value <= rule["max"]:
+        return f"must be between {rule['min']} and {rule['max']}"
+    if value % rule.get("multiple", 1):
+        return f"must be a multiple of {rule['multiple']}"
+    return None
+
+
+def validate_profile(profile):
+    """
+    Validate an acquisition profile. Settings left out take the default
+
+    :param profile: The profile, a dict of sections
+    :return: The complete profile
+    :raises ValueError: With all the errors of the profile
+    """
+
+    if not isinstance(profile, dict):
+        raise ValueError("The profile must be a JSON object")
+
+    errors = []
+    result = copy.deepcopy(DEFAULT_PROFILE)
+    name = profile.get("name", "custom")
+    if not isinstance(name, str) or not name:
+        errors.append("name: must be a non empty string")
+    result["name"] = name
+
+    for section in profile:
+        if section != "name" and section not in SCHEMA:
+            errors.append(f"{section}: unknown section, expected one of {', '.join(SCHEMA)}")
+    for section, rules in SCHEMA.items():
+        settings = profile.get(section, {})
+        if not isinstance(settings, dict):
+            errors.append(f"{section}: must be a JSON object")
+            continue
+        for key, value in settings.items():
+            if key not in rules:
+                errors.append(f"{section}.{key}: unknown setting")
+                continue
+            error = check_value(value, rules[key])
+            if error is not None:
+                errors.append(f"{section}.{key}: {error}")
+            else:
+                result[section][key] = value
+
+    gps = result["gps"]
+    fix_bytes = GPS_BYTES_PER_FIX_PRUNED if gps["prune_nmea"] else GPS_BYTES_PER_FIX
+    if not errors and gps["baudrate"] / 10 * GPS_UART_HEADROOM < fix_bytes * 1000 / gps["rate_ms"]:
+        errors.append(f"gps.rate_ms: {gps['rate_ms']} ms is too fast for {gps['baudrate']} baud"
+                      f"{'' if gps['prune_nmea'] else ' without prune_nmea'}")
+
+    if errors:
+        raise ValueError("; ".join(errors))
+    return result
+
+
+class ProfileStore:
+    """
+    The acquisition profile persisted on the device. It is read when the sensors are prepared for a trial, so that
+    a new profile applies from the next DAQ start
+    """
+
+    # Kept across boots and firmware updates
+    PROFILE_FILE = "/var/drivesense/profile.json"
+
+    def __init__(self, path=PROFILE_FILE):
+        """
+        :param path: Path of the profile
+        """
+
+        self.path = path
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def load(self):
+        """
+        Load the profile, the default if none is stored or the stored one is not valid
+
+        :return: The complete profile
+        """
+
+        try:
+            with open(self.path, "r") as fh:
+                return validate_profile(json.load(fh))
+        except FileNotFoundError:
+            return copy.deepcopy(DEFAULT_PROFILE)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Invalid acquisition profile {self.path}, using the default: {e}")
+            return copy.deepcopy(DEFAULT_PROFILE)
+
+    def save(self, profile):
+        """
+        Validate and store a profile. The file is replaced atomically, a power cut leaves the old or the new profile
+
+        :param profile: The profile
+        :return: The complete profile
+        :raises ValueError: If the profile is not valid
+        """
+
+        profile = validate_profile(profile)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as fh:
+            json.dump(profile, fh, indent=2)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temporary, self.path)
+        self.logger.info(f"Acquisition profile {profile['name']} stored, it applies from the next DAQ start")
+        return profile
+
+    def reset(self):
+        """
+        Go back to the default profile
+
+        :return: The default profile
+        """
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        return copy.deepcopy(DEFAULT_PROFILE)
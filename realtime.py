@@ -0,0 +1,142 @@
+import os
+import ctypes
+import ctypes.util
+import logging
+import threading
+from array import array
+
+
+logger = logging.getLogger("realtime")
+
+# mlockall flags
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+def lock_memory(thread_stack_size=1024 * 1024):
+    """
+    Lock the memory of the process, current and future, so that the IMU path never stalls on a page fault. The stack
+    size of new threads is reduced first, as every thread stack is locked in full
+
+    :param thread_stack_size: Stack size of the threads started from here on
+    :return: True, if the memory is locked
+    """
+
+    threading.stack_size(thread_stack_size)
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not lock the memory: {e}")
+        return False
+    logger.info("Memory locked")
+    return True
+
+
+def reserve_cpu(cpu):
+    """
+    Keep the threads of the process off a CPU that is reserved for the IMU, the running ones and the ones started
+    from here on. To be called before the IMU thread is pinned to the CPU
+
+    :param cpu: The reserved CPU, None for no reservation
+    :return: True, if the CPU is reserved
+    """
+
+    if cpu is None:
+        return False
+    others = os.sched_getaffinity(0) - {cpu}
+    if cpu not in os.sched_getaffinity(0) or not others:
+        logger.warning(f"CPU {cpu} cannot be reserved, the CPUs are {sorted(os.sched_getaffinity(0))}")
+        return False
+    # The affinity is per thread, threads started earlier, e.g. the log listener, keep theirs
+    try:
+        tasks = [int(task) for task in os.listdir("/proc/self/task")]
+    except OSError:
+        tasks = []
+    for task in tasks:
+        try:
+            os.sched_setaffinity(task, others)
+        except OSError:
+            # The thread exited
+            pass
+    os.sched_setaffinity(0, others)
+    return True
+
+
+def set_realtime(priority, cpu):
+    """
+    Run the calling thread with the SCHED_FIFO policy on a CPU of its own. Without a CPU to pin to the policy is not
+    applied, as a real time thread that polls would starve the rest of the application
+
+    :param priority: SCHED_FIFO priority, 1 to 99
+    :param cpu: The CPU to pin the thread to
+    :return: True, if the thread runs in real time
+    """
+
+    if priority is None or cpu is None:
+        return False
+    try:
+        os.sched_setaffinity(0, {cpu})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not run {threading.current_thread().name} in real time: {e}")
+        return False
+    logger.info(f"{threading.current_thread().name} runs with SCHED_FIFO priority {priority} on CPU {cpu}")
+    return True
+
+
+class JitterTracer:
+    """
+    Latency histogram of the IMU reads, from the FIFO watermark to the samples read. Recording is O(1) into memory
+    allocated up front: a ring of the latest latencies for the percentiles and log spaced buckets and the maximum over
+    the whole trial
+    """
+
+    # Upper bounds of the buckets in ms, the last bucket takes the rest
+    BUCKETS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+    def __init__(self, size=4096):
+        """
+        :param size: Number of the latest latencies kept for the percentiles
+        """
+
+        self.latencies = array("f", bytes(4 * size))
+        self.size = size
+        self.counts = array("L", bytes(array("L").itemsize * (len(self.BUCKETS_MS) + 1)))
+        self.count = 0
+        self.maximum = 0.0
+
+    def record(self, latency):
+        """
+        Record a latency
+
+        :param latency: The latency in seconds
+        :return: None
+        """
+
+        latency_ms = latency * 1000
+        self.latencies[self.count % self.size] = latency_ms
+        self.count += 1
+        if latency_ms > self.maximum:
+            self.maximum = latency_ms
+        bucket = 0
+        while bucket < len(self.BUCKETS_MS) and latency_ms > self.BUCKETS_MS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+
+    def report(self):
+        """
+        Summary of the latencies
+
+        :return: A dict with the number of reads, the median and 99th percentile of the latest reads, the maximum and
+        the histogram, in ms. None without reads
+        """
+
+        if not self.count:
+            return None
+        latest = sorted(self.latencies[:min(self.count, self.size)])
+        labels = [f"<={bound}" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}"]
+        return {"count": self.count, "p50": latest[len(latest) // 2],
+                "p99": latest[min(len(latest) - 1, len(latest) * 99 // 100)], "max": self.maximum,
+                "histogram": {label: count for label, count in zip(labels, self.counts) if count}}
@@ -0,0 +1,60 @@
+import json
+from sensors.sources import LSM6DSLSource, GpsdSource, ThermalSource
+
+
+# Source types that can be named in the sensor configuration
+SENSOR_TYPES = {
+    "lsm6dsl": LSM6DSLSource,
+    "gpsd": GpsdSource,
+    "thermal": ThermalSource,
+}
+
+
+def register(kind):
+    """
+    Class decorator to make a source type available to the sensor configuration
+
+    :param kind: Name of the type in the configuration
+    :return: The decorator
+    """
+
+    def decorator(cls):
+        SENSOR_TYPES[kind] = cls
+        return cls
+    return decorator
+
+
+def load_config(path):
+    """
+    Read a sensor configuration file
+
+    :param path: Path to the JSON file
+    :return: The configuration
+    """
+
+    with open(path, "r") as fh:
+        config = json.load(fh)
+    if not isinstance(config.get("sensors"), list) or not config["sensors"]:
+        raise ValueError(f"{path}: 'sensors' must be a non empty list")
+    return config
+
+
+def build_sources(config, context=None):
+    """
+    Create the sources of a configuration
+
+    :param config: The configuration
+    :param context: Shared state of the DAQ handed to the sources
+    :return: A list of sources
+    """
+
+    sources = []
+    for entry in config["sensors"]:
+        kind = entry.get("type")
+        if kind not in SENSOR_TYPES:
+            raise ValueError(f"Unknown sensor type {kind}, expected one of {', '.join(sorted(SENSOR_TYPES))}")
+        name = entry.get("name", kind)
+        if any(source.name == name for source in sources):
+            raise ValueError(f"Duplicate sensor name {name}")
+        sources.append(SENSOR_TYPES[kind](name, context=context, **entry.get("options", {})))
+    return sources
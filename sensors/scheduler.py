@@ -0,0 +1,120 @@
+import time
+import heapq
+import logging
+import threading
+import metrics
+
+
+class SensorScheduler:
+    """
+    Polls any number of sources with a bounded number of threads. The sources are kept in a queue ordered by their
+    next poll, a source is polled by one thread at a time and the thread CPU time of every poll is accounted to it
+    """
+
+    def __init__(self, sources, handler, threads=1):
+        """
+        :param sources: The sources to poll
+        :param handler: Called with the source and the batch for every batch read
+        :param threads: Number of polling threads
+        """
+
+        self.sources = list(sources)
+        self.handler = handler
+        self.thread_count = max(1, min(threads, len(self.sources) or 1))
+        self.threads = []
+        self.running = False
+        self.condition = threading.Condition()
+        self.due = []
+
+        # Metrics
+        self.cpu_seconds = {s.name: metrics.REGISTRY.counter("sensor_cpu_seconds_total", "CPU time of the polls",
+                                                             {"sensor": s.name}) for s in self.sources}
+        self.lateness = metrics.REGISTRY.histogram("sensor_poll_lateness_seconds", "Delay of the polls",
+                                                   buckets=(0.001, 0.005, 0.02, 0.1, 0.5))
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        """
+        Start the polling threads, every source is due at once
+
+        :return: None
+        """
+
+        now = time.monotonic()
+        self.due = [(now, index) for index in range(len(self.sources))]
+        heapq.heapify(self.due)
+        self.running = True
+        for index in range(self.thread_count):
+            thread = threading.Thread(target=self.run, name=f"SensorPoll-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the polling threads, a poll in progress is finished
+
+        :return: None
+        """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def poll(self, source):
+        """
+        Poll a source once
+
+        :param source: The source
+        :return: None
+        """
+
+        cpu_start = time.thread_time()
+        try:
+            batch = source.read_batch()
+            if batch:
+                source.batches += 1
+                self.handler(source, batch)
+        except Exception as e:
+            self.logger.error(f"Error polling {source.name}: {e}")
+        cpu = time.thread_time() - cpu_start
+        source.polls += 1
+        source.cpu_seconds += cpu
+        self.cpu_seconds[source.name].inc(cpu)
+
+    def run(self):
+        """
+        Polling thread, polls the source that is due next
+
+        :return: None
+        """
+
+        while True:
+            with self.condition:
+                while self.running and (not self.due or self.due[0][0] > time.monotonic()):
+                    self.condition.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                if not self.running:
+                    return
+                due, index = heapq.heappop(self.due)
+
+            source = self.sources[index]
+            self.lateness.observe(time.monotonic() - due)
+            self.poll(source)
+
+            # Keep the cadence, unless the poll fell behind
+            with self.condition:
+                heapq.heappush(self.due, (max(due + source.poll_interval, time.monotonic()), index))
+                self.condition.notify()
+
+    def report(self):
+        """
+        CPU use of the sources
+
+        :return: A dict of the CPU seconds per source
+        """
+
+        return {s.name: s.cpu_seconds for s in self.sources}
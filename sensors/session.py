@@ -0,0 +1,149 @@
+import os
+import time
+import logging
+import threading
+import utils
+from sensors.registry import build_sources
+from sensors.scheduler import SensorScheduler
+from sensors.writer_pool import WriterPool
+
+
+class SensorSession:
+    """
+    The sources of a sensor configuration for one trial, with the same arm, start and stop interface as the pollers.
+    The sources are polled while armed and their batches stored once the recording starts
+    """
+
+    def __init__(self, config, save_dir_time=None, save_location="/sensor_data", context=None):
+        """
+        :param config: The sensor configuration
+        :param save_dir_time: Name of the trial directory
+        :param save_location: The directory of the trials
+        :param context: Shared state of the DAQ
+        """
+
+        self.config = config
+        self.save_dir_time = save_dir_time
+        self.save_location = save_location
+        self.sources = build_sources(config, context=context)
+        self.active = []
+
+        # Shared writers and polling threads
+        self.writer_pool = WriterPool(**config.get("writer", {}))
+        self.scheduler = None
+
+        # State
+        self.armed = False
+        self.recording = threading.Event()
+        self.current_save_dir = None
+        self.start_time = None
+        self.metadata = {}
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def path(self, source):
+        """
+        Path of the data file of a source in the trial directory
+
+        :param source: The source
+        :return: The path
+        """
+
+        return os.path.join(self.current_save_dir, source.file_name)
+
+    def store(self, source, batch):
+        """
+        Write a batch to the data file of its source, while recording
+
+        :param source: The source
+        :param batch: The encoded records
+        :return: None
+        """
+
+        if self.recording.is_set():
+            self.writer_pool.write(self.path(source), batch)
+
+    def arm(self):
+        """
+        Open the sources and start polling them
+
+        :return: True, if any source is available
+        """
+
+        if not self.armed:
+            self.active = []
+            for source in self.sources:
+                try:
+                    if source.open():
+                        self.active.append(source)
+                    else:
+                        self.logger.error(f"Sensor {source.name} not available")
+                except Exception as e:
+                    self.logger.error(f"Error opening sensor {source.name}: {e}")
+            if not self.active:
+                return False
+
+            self.writer_pool.start()
+            self.scheduler = SensorScheduler(self.active, self.store, **self.config.get("scheduler", {}))
+            self.scheduler.start()
+            self.armed = True
+            self.logger.info(f"Sensors armed: {', '.join(s.name for s in self.active)}")
+        return True
+
+    def start_polling(self, save_dir_time=None, request_time=None):
+        """
+        Start recording
+
+        :param save_dir_time: Name of the trial directory
+        :param request_time: Monotonic time of the start request, to measure the start latency
+        :return: True, if the recording started
+        """
+
+        if save_dir_time is not None:
+            self.save_dir_time = save_dir_time
+        if self.recording.is_set():
+            return True
+        if not self.arm():
+            return False
+
+        self.current_save_dir = os.path.join(self.save_location, self.save_dir_time)
+        os.makedirs(self.current_save_dir, exist_ok=True)
+        for source in self.active:
+            self.writer_pool.open(self.path(source), source.header())
+        # Stored from the first batch of a started source on, the sources are polled while they start
+        self.recording.set()
+        for source in self.active:
+            source.start(self.current_save_dir)
+        self.start_time = time.monotonic()
+        if request_time is not None:
+            self.metadata["start_latency_ms"] = (self.start_time - request_time) * 1000
+        return True
+
+    def stop_polling(self):
+        """
+        Stop recording and close the sources
+
+        :return: None
+        """
+
+        if not self.armed:
+            return
+        self.scheduler.stop()
+
+        if self.recording.is_set():
+            for source in self.active:
+                batch = source.stop()
+                if batch:
+                    self.writer_pool.write(self.path(source), batch)
+                self.writer_pool.close(self.path(source))
+        self.writer_pool.stop()
+
+        for source in self.active:
+            if self.recording.is_set():
+                metadata = dict(self.metadata, **source.metadata())
+                utils.write_metadata(self.current_save_dir, source.name, metadata)
+            source.close()
+        self.metadata["cpu_seconds"] = self.scheduler.report()
+        self.logger.info(f"Sensor CPU time: {self.metadata['cpu_seconds']}")
+        self.armed = False
@@ -0,0 +1,125 @@
+import abc
+import time
+import logging
+
+
+class SensorSource(abc.ABC):
+    """
+    A sensor of the DAQ. Sources do not own a thread, the scheduler polls them at their interval and the batches they
+    return are written through the shared writer pool to <name>.dat in the trial directory
+
+    Lifecycle: open() when armed, start() when the recording starts, poll with read_batch() while armed and
+    recording, stop() at the end of the recording and close() when disarmed
+    """
+
+    # Schema of the data file, the CSV columns or the name of a binary encoding
+    columns = ()
+    encoding = "csv"
+
+    def __init__(self, name, poll_interval=0.1, context=None):
+        """
+        :param name: Name of the source, also the name of its files
+        :param poll_interval: Time between polls in seconds
+        :param context: Shared state of the DAQ, e.g. the GPS fix state
+        """
+
+        self.name = name
+        self.poll_interval = poll_interval
+        self.context = context if context is not None else {}
+
+        # Statistics
+        self.start_time = None
+        self.stop_time = None
+        self.polls = 0
+        self.cpu_seconds = 0.0
+        self.batches = 0
+
+        # Logging
+        self.logger = logging.getLogger(f"{self.__class__.__name__}.{name}")
+
+    @property
+    def file_name(self):
+        """
+        Name of the data file
+
+        :return: <name>.dat
+        """
+
+        return self.name + ".dat"
+
+    def header(self):
+        """
+        Header of the data file
+
+        :return: The header bytes
+        """
+
+        if self.encoding == "csv" and self.columns:
+            return (",".join(self.columns) + "\n").encode()
+        return b""
+
+    def schema(self):
+        """
+        Description of the data file
+
+        :return: A dict with the file, encoding and columns
+        """
+
+        return {"file": self.file_name, "encoding": self.encoding, "columns": list(self.columns)}
+
+    def open(self):
+        """
+        Connect to the sensor
+
+        :return: True, if the sensor is available
+        """
+
+        return True
+
+    def start(self, save_dir):
+        """
+        The recording starts, batches are stored from here on
+
+        :param save_dir: The trial directory, for outputs besides the data file
+        :return: None
+        """
+
+        self.start_time = time.monotonic()
+
+    @abc.abstractmethod
+    def read_batch(self):
+        """
+        Read what the sensor collected since the last poll
+
+        :return: The encoded records, None if there are none
+        """
+
+    def stop(self):
+        """
+        The recording stopped
+
+        :return: The final encoded records, None if there are none
+        """
+
+        self.stop_time = time.monotonic()
+        return None
+
+    def close(self):
+        """
+        Disconnect from the sensor
+
+        :return: None
+        """
+
+    def metadata(self):
+        """
+        Metadata of the recording
+
+        :return: A JSON serializable dict
+        """
+
+        elapsed = None
+        if self.start_time is not None and self.stop_time is not None:
+            elapsed = self.stop_time - self.start_time
+        return {"elapsed_time": elapsed, "schema": self.schema(), "polls": self.polls, "batches": self.batches,
+                "cpu_seconds": self.cpu_seconds}
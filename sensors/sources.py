@@ -0,0 +1,272 @@
+import time
+import pickle
+import hal
+from IMU.pipeline import build_pipeline
+from sensors.source import SensorSource
+from telemetry import gps_fix
+
+
+class LSM6DSLSource(SensorSource):
+    """
+    LSM6DSL on SPI. The FIFO is read at an interval that keeps it at most half full, instead of waiting for the data
+    ready pin in a busy loop
+    """
+
+    columns = ("gx", "gy", "gz", "ax_g", "ay_g", "az_g")
+
+    # Words of a gyroscope and accelerometer sample, and the FIFO size in words
+    SAMPLE_WORDS = 6
+    FIFO_WORDS = 2048
+
+    def __init__(self, name, spi_bus=0, spi_dev=0, speed=10000000, drdy_pin=24, poll_interval=None, stages=(),
+                 context=None):
+        """
+        :param name: Name of the source
+        :param spi_bus: SPI bus of the sensor
+        :param spi_dev: Chip select of the sensor
+        :param speed: SPI clock in Hz
+        :param drdy_pin: GPIO pin of the data ready signal
+        :param poll_interval: Time between polls in seconds, by default the time to fill half the FIFO
+        :param stages: Processing stages of the samples, see IMU.pipeline.build_pipeline
+        :param context: Shared state of the DAQ
+        """
+
+        from IMU import lsm6dsl
+
+        odr = lsm6dsl.LSM6DSL.ODR_HZ
+        if poll_interval is None:
+            poll_interval = self.FIFO_WORDS / self.SAMPLE_WORDS / odr / 2
+        super().__init__(name, poll_interval=poll_interval, context=context)
+        self.device = lsm6dsl.LSM6DSL(spi_bus=spi_bus, spi_dev=spi_dev, speed=speed, drdy_pin=drdy_pin)
+        self.recording = False
+        self.samples = 0
+        self.overruns = 0
+        self.stages = stages
+        self.pipeline = None
+        self.pipeline_metadata = None
+
+    def open(self):
+        """
+        Detect and configure the sensor, with the FIFO held in bypass mode
+
+        :return: True, if the sensor is detected
+        """
+
+        self.device.open()
+        time.sleep(0.1)
+        if not self.device.detect_device():
+            self.logger.error("IMU device not detected")
+            return False
+        self.device.configure_sensor(start_fifo=False)
+        return True
+
+    def start(self, save_dir):
+        """
+        Open the processing stages and start the FIFO
+
+        :param save_dir: The trial directory, for the outputs of the stages
+        :return: None
+        """
+
+        super().start(save_dir)
+        self.pipeline = build_pipeline(self.stages, self.device.ODR_HZ, context=self.context, prefix=self.name + "_")
+        if self.pipeline is not None:
+            self.pipeline.open(save_dir)
+        self.device.start_fifo()
+        self.recording = True
+
+    def read_batch(self):
+        """
+        Read the whole samples in the FIFO and hand them to the processing stages
+
+        :return: The samples as CSV rows, None if there are none
+        """
+
+        if not self.recording:
+            return None
+        from IMU.imudevice import IMUPoller
+
+        num_words, status2 = self.device.fifo_level()
+        if status2 & self.device.FIFO_OVER_RUN:
+            self.overruns += 1
+            self.logger.warning("FIFO overrun, samples were lost")
+        # Whole samples only, so that the reads stay aligned to the FIFO pattern
+        num_words -= num_words % self.SAMPLE_WORDS
+        if not num_words:
+            return None
+        data = self.device.read_fifo_data(num_words)
+        self.samples += num_words // self.SAMPLE_WORDS
+        if self.pipeline is not None:
+            self.pipeline.submit(data)
+        return IMUPoller.decode(data)
+
+    def stop(self):
+        """
+        Read what is left in the FIFO and close the processing stages
+
+        :return: The final samples as CSV rows, None if there are none
+        """
+
+        batch = self.read_batch()
+        self.recording = False
+        if self.pipeline is not None:
+            self.pipeline_metadata = self.pipeline.close()
+        super().stop()
+        return batch
+
+    def close(self):
+        """
+        Close the SPI device
+
+        :return: None
+        """
+
+        self.device.close()
+
+    def metadata(self):
+        """
+        Metadata of the recording, with the samples, the FIFO overruns and the stages
+
+        :return: A JSON serializable dict
+        """
+
+        metadata = super().metadata()
+        metadata.update({"samples": self.samples, "fifo_overruns": self.overruns, "odr_hz": self.device.ODR_HZ})
+        if self.pipeline is not None:
+            metadata["pipeline"] = self.pipeline_metadata
+        return metadata
+
+
+class GpsdSource(SensorSource):
+    """
+    gpsd reports in the gps.dat format. The reports are read without blocking, while armed they only update the GPS
+    fix state
+    """
+
+    encoding = "pickle"
+
+    # The receiver is configured once per boot
+    receiver_configured = False
+
+    def __init__(self, name, poll_interval=0.05, rate_ms=100, baudrate=115200, prune_nmea=True, save_config=False,
+                 context=None):
+        """
+        :param name: Name of the source
+        :param poll_interval: Time between polls in seconds
+        :param rate_ms: Measurement rate of the receiver in milliseconds
+        :param baudrate: Baud rate of the receiver UART
+        :param prune_nmea: Limit the NMEA output to what gpsd needs
+        :param save_config: Save the receiver configuration to its flash
+        :param context: Shared state of the DAQ, the GPS fix state and position are updated in it
+        """
+
+        super().__init__(name, poll_interval=poll_interval, context=context)
+        self.rate_ms = rate_ms
+        self.baudrate = baudrate
+        self.prune_nmea = prune_nmea
+        self.save_config = save_config
+        self.gpsd = None
+        self.records = 0
+
+    def open(self):
+        """
+        Configure the receiver once per boot and connect to gpsd
+
+        :return: True
+        """
+
+        # There is no receiver to configure behind the simulated gpsd
+        if not GpsdSource.receiver_configured and not hal.SIMULATED:
+            from GPS.gpsdevice import GPSCommandSender
+            sender = GPSCommandSender(baudrate=9600)
+            sender.configure(rate_ms=self.rate_ms, baudrate=self.baudrate, save=self.save_config,
+                             messages=GPSCommandSender.daq_messages(self.rate_ms) if self.prune_nmea else None)
+            sender.close()
+        GpsdSource.receiver_configured = True
+        self.gpsd = hal.gps_client()
+        return True
+
+    def read_batch(self):
+        """
+        Read the reports gpsd has, without blocking, and update the GPS fix in the context
+
+        :return: The pickled reports, None if there are none
+        """
+
+        batch = []
+        fix_state = self.context.get("gps_fix_state")
+        while self.gpsd.waiting(0):
+            record = self.gpsd.next()
+            if record.get("class") == "TPV":
+                if fix_state is not None:
+                    fix_state[0] = record.get("mode", 0)
+                if record.get("mode", 0) >= 2:
+                    self.context["gps_position"] = (record.get("lat"), record.get("lon"))
+                    self.context["gps_fix"] = gps_fix(record)
+            batch.append(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL))
+        self.records += len(batch)
+        return b"".join(batch) or None
+
+    def stop(self):
+        """
+        Read the reports since the last poll
+
+        :return: The final pickled reports, None if there are none
+        """
+
+        # The reports since the last poll
+        batch = self.read_batch()
+        super().stop()
+        return batch
+
+    def close(self):
+        """
+        Disconnect from gpsd
+
+        :return: None
+        """
+
+        if self.gpsd is not None:
+            self.gpsd.close()
+
+    def metadata(self):
+        """
+        Metadata of the recording, with the number of reports
+
+        :return: A JSON serializable dict
+        """
+
+        metadata = super().metadata()
+        metadata["records"] = self.records
+        return metadata
+
+
+class ThermalSource(SensorSource):
+    """
+    CPU temperature and throttling state from sysfs, an example of a slow environmental sensor
+    """
+
+    columns = ("time", "cpu_temp_c", "clock_freq_ghz", "throttled")
+
+    def __init__(self, name, poll_interval=1.0, context=None):
+        """
+        :param name: Name of the source
+        :param poll_interval: Time between polls in seconds
+        :param context: Shared state of the DAQ
+        """
+
+        super().__init__(name, poll_interval=poll_interval, context=context)
+        from sysinfo import SystemSampler
+        self.sampler = SystemSampler()
+
+    def read_batch(self):
+        """
+        Read the temperature, clock frequency and throttling state
+
+        :return: A CSV row, None before the recording starts
+        """
+
+        if self.start_time is None:
+            return None
+        return (f"{time.monotonic() - self.start_time:.3f},{self.sampler.read_temperature()},"
+                f"{self.sampler.read_clock_frequency()},{self.sampler.read_throttled()}\n").encode()
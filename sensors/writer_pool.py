@@ -0,0 +1,160 @@
+import os
+import zlib
+import queue
+import logging
+import threading
+import metrics
+
+
+class WriterPool:
+    """
+    Writes the data files of all the sensors with a fixed number of threads. Every file is handled by one thread so
+    that its writes stay in order, and the data is buffered per file to write back in large blocks
+    """
+
+    def __init__(self, threads=1, buffer_size=64 * 1024):
+        """
+        :param threads: Number of writer threads
+        :param buffer_size: Bytes buffered per file before a write
+        """
+
+        self.buffer_size = buffer_size
+        self.queues = [queue.Queue() for _ in range(max(1, threads))]
+        self.threads = []
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        """
+        Start the writer threads
+
+        :return: None
+        """
+
+        for index, work in enumerate(self.queues):
+            thread = threading.Thread(target=self.run, args=(work,), name=f"Writer-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def queue_for(self, path):
+        """
+        Work queue of the thread that handles a file
+
+        :param path: Path to the file
+        :return: The queue
+        """
+
+        return self.queues[zlib.crc32(path.encode()) % len(self.queues)]
+
+    def open(self, path, header=b""):
+        """
+        Create a data file
+
+        :param path: Path to the file
+        :param header: Bytes to start the file with
+        :return: None
+        """
+
+        self.queue_for(path).put(("open", path, header))
+
+    def write(self, path, data):
+        """
+        Append to a data file
+
+        :param path: Path to the file
+        :param data: The bytes
+        :return: None
+        """
+
+        self.queue_for(path).put(("write", path, data))
+
+    def close(self, path):
+        """
+        Flush and close a data file
+
+        :param path: Path to the file
+        :return: An event that is set once the file is closed
+        """
+
+        done = threading.Event()
+        self.queue_for(path).put(("close", path, done))
+        return done
+
+    def pending(self):
+        """
+        Number of queued file operations
+
+        :return: The operations not done yet
+        """
+
+        return sum(q.qsize() for q in self.queues)
+
+    def stop(self):
+        """
+        Close all files and stop the threads
+
+        :return: None
+        """
+
+        for work in self.queues:
+            work.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self, work):
+        """
+        Writer thread, handles the operations of its files in order
+
+        :param work: The queue of the thread
+        :return: None
+        """
+
+        files = {}
+
+        def flush(path):
+            """
+            Write the buffer of a file
+
+            :param path: Path to the file
+            :return: None
+            """
+
+            fh, buffer, bytes_total = files[path]
+            if buffer:
+                fh.write(buffer)
+                fh.flush()
+                bytes_total.inc(len(buffer))
+                buffer.clear()
+
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            action, path, value = item
+            try:
+                if action == "open":
+                    fh = open(path, "wb")
+                    fh.write(value)
+                    labels = {"file": os.path.basename(path)}
+                    files[path] = (fh, bytearray(), metrics.REGISTRY.counter(
+                        "writer_bytes_total", "Bytes written to the data files", labels))
+                elif action == "write":
+                    buffer = files[path][1]
+                    buffer.extend(value)
+                    if len(buffer) > self.buffer_size:
+                        flush(path)
+                elif action == "close":
+                    if path in files:
+                        flush(path)
+                        files.pop(path)[0].close()
+                    value.set()
+            except Exception as e:
+                self.logger.error(f"Error writing to {path}: {e}")
+                if action == "close":
+                    value.set()
+
+        for path in list(files):
+            flush(path)
+            files.pop(path)[0].close()
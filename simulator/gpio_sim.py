@@ -0,0 +1,97 @@
+import time
+import threading
+
+
+class FakeGPIO:
+    """
+    RPi.GPIO like module with simulated pin levels. A pin is driven by a level function, optionally with a function
+    that predicts the time to its next rising edge so that waiting for edges sleeps instead of polling
+    """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, poll_interval=0.001):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.mode = None
+        self.pins = {}
+        self.levels = {}
+        self.edge_timers = {}
+
+    def attach(self, pin, level, time_to_rising=None):
+        """
+        Drive a pin
+
+        :param pin: The pin number
+        :param level: Function returning True while the pin is high
+        :param time_to_rising: Function returning the seconds to the next rising edge, None if unknown
+        :return: None
+        """
+
+        self.levels[pin] = level
+        self.edge_timers[pin] = time_to_rising
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=LOW):
+        if self.mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode")
+        self.pins[pin] = direction
+
+    def input(self, pin):
+        if pin not in self.pins:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        level = self.levels.get(pin)
+        return self.HIGH if level is not None and level() else self.LOW
+
+    def output(self, pin, value):
+        self.levels[pin] = lambda: bool(value)
+
+    def wait_for_edge(self, pin, edge, timeout=None):
+        """
+        Block until an edge, only rising edges are predicted
+
+        :param pin: The pin number
+        :param edge: RISING, FALLING or BOTH
+        :param timeout: Timeout in milliseconds
+        :return: The pin on an edge, None on timeout
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        previous = self.input(pin)
+        while True:
+            current = self.input(pin)
+            if current != previous and (edge == self.BOTH or (edge == self.RISING) == (current == self.HIGH)):
+                return pin
+            previous = current
+
+            wait = self.poll_interval
+            timer = self.edge_timers.get(pin)
+            if timer is not None and edge != self.FALLING and current == self.LOW:
+                predicted = timer()
+                if predicted is not None:
+                    wait = max(predicted, self.poll_interval / 10)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.pins.clear()
+        else:
+            self.pins.pop(pin, None)
@@ -0,0 +1,218 @@
+import json
+import math
+import time
+import select
+import socket
+import logging
+import threading
+import socketserver
+from data_loader.gps_records import load_records
+
+
+def synthetic_records(seconds=60, rate_hz=10, lat=43.0731, lon=-89.4012, speed=13.0):
+    """
+    Generate a drive around a circle with a 3D fix
+
+    :param seconds: Length of the drive
+    :param rate_hz: Fix rate
+    :param lat: Latitude of the centre
+    :param lon: Longitude of the centre
+    :param speed: Speed in m/s
+    :return: A list of record dicts
+    """
+
+    records = []
+    radius = 200.0
+    start = time.time()
+    for n in range(int(seconds * rate_hz)):
+        t = n / rate_hz
+        angle = speed * t / radius
+        fix_time = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(start + t)) + f".{int(t * 1000) % 1000:03d}Z"
+        records.append({
+            "class": "TPV", "device": "/dev/serial0", "mode": 3, "time": fix_time,
+            "lat": lat + radius * math.sin(angle) / 111320,
+            "lon": lon + radius * math.cos(angle) / (111320 * math.cos(math.radians(lat))),
+            "altHAE": 260.0, "speed": speed, "track": math.degrees(angle + math.pi / 2) % 360,
+            "eph": 2.5, "epv": 4.0})
+        if n % rate_hz == 0:
+            records.append({
+                "class": "SKY", "device": "/dev/serial0", "hdop": 0.9,
+                "satellites": [{"PRN": prn, "el": 30 + prn, "az": prn * 30, "ss": 40, "used": prn < 9}
+                               for prn in range(1, 12)]})
+    return records
+
+
+class GpsdHandler(socketserver.StreamRequestHandler):
+    """
+    One gpsd client. Answers the ?DEVICES and ?WATCH commands and streams the records once watching
+    """
+
+    def handle(self):
+        server = self.server
+        self.wfile.write(self.report({"class": "VERSION", "release": "3.22", "rev": "simulated",
+                                      "proto_major": 3, "proto_minor": 14}))
+        watching = False
+        index = 0
+        start = None
+        buffer = b""
+        while not server.stopped.is_set():
+            try:
+                readable, _, _ = select.select([self.request], [], [], 0.02)
+                if readable:
+                    chunk = self.request.recv(4096)
+                    if not chunk:
+                        return
+                    buffer += chunk
+
+                # Commands are terminated with a semicolon or newline
+                while True:
+                    end = min([i for i in (buffer.find(b";"), buffer.find(b"\n")) if i >= 0], default=-1)
+                    if end < 0:
+                        break
+                    command, buffer = buffer[:end].strip(), buffer[end + 1:]
+                    if command.startswith(b"?DEVICES"):
+                        self.wfile.write(self.report({"class": "DEVICES", "devices": [
+                            {"class": "DEVICE", "path": "/dev/serial0", "driver": "u-blox", "bps": server.bps}]}))
+                    elif command.startswith(b"?WATCH"):
+                        watching = b'"enable":false' not in command.replace(b" ", b"")
+                        self.wfile.write(self.report({"class": "WATCH", "enable": watching, "json": True}))
+                        start = time.monotonic()
+
+                if not watching:
+                    continue
+
+                # Records in real time scaled by the replay speed, or as fast as the client reads them
+                if server.speed > 0:
+                    due = int((time.monotonic() - start) * server.speed / server.interval) + 1 - index
+                else:
+                    due = 100
+                for _ in range(due):
+                    self.wfile.write(self.report(server.records[index % len(server.records)]))
+                    index += 1
+                    if not server.loop and index >= len(server.records):
+                        watching = False
+                        break
+            except OSError:
+                return
+
+    @staticmethod
+    def report(record):
+        return (json.dumps(record) + "\r\n").encode()
+
+
+class FakeGpsdServer(socketserver.ThreadingTCPServer):
+    """
+    gpsd speaking TCP server that replays records. The records are spaced by the fix interval, divided by the
+    replay speed, a speed of 0 sends them as fast as the client reads them
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, records=None, address=("127.0.0.1", 0), rate_hz=10, speed=1.0, loop=True, bps=115200):
+        super().__init__(address, GpsdHandler)
+        self.records = records or synthetic_records(rate_hz=rate_hz)
+        # Records per fix, so that the fixes are spaced by the fix interval
+        fixes = sum(1 for r in self.records if r.get("class") == "TPV") or len(self.records)
+        self.interval = fixes / max(len(self.records), 1) / rate_hz
+        self.speed = speed
+        self.loop = loop
+        self.bps = bps
+        self.stopped = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        Replay a recorded gps.dat
+
+        :param path: Path to gps.dat
+        :param kwargs: Options of the server
+        :return: The server
+        """
+
+        return cls(records=load_records(path), **kwargs)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="FakeGpsd", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Simulated gpsd on port {self.port} with {len(self.records)} records")
+
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+
+class GpsdRecord(dict):
+    """
+    A report with attribute access, like the records of the gps client
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __reduce__(self):
+        return GpsdRecord, (dict(self),)
+
+
+class GpsdClient:
+    """
+    Minimal gpsd JSON client in watch mode, with the next() and waiting() interface of gps.gps
+    """
+
+    def __init__(self, host="127.0.0.1", port=2947, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.buffer = bytearray()
+        self.sock.sendall(b'?WATCH={"enable":true,"json":true};\n')
+
+    def receive(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise StopIteration
+        self.buffer += chunk
+
+    def waiting(self, timeout=0):
+        """
+        Check for a report without blocking longer than the timeout
+
+        :param timeout: Time to wait in seconds
+        :return: True, if a report can be read
+        """
+
+        if b"\n" in self.buffer:
+            return True
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if readable:
+            self.receive()
+        return b"\n" in self.buffer
+
+    def next(self):
+        """
+        Wait for the next report
+
+        :return: The report
+        """
+
+        while b"\n" not in self.buffer:
+            self.receive()
+        end = self.buffer.index(b"\n")
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+        return json.loads(line, object_hook=GpsdRecord)
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.sock.close()
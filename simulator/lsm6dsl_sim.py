@@ -0,0 +1,357 @@
+import math
+import random
+import struct
+import threading
+import time
+
+
+class FakeLSM6DSL:
+    """
+    Register map and FIFO of the LSM6DSL. Samples enter the FIFO at the output data rate of the FIFO configuration,
+    computed from the elapsed time whenever the device is accessed, so no thread is needed to feed it
+    """
+
+    WHO_AM_I_VALUE = 0x6A
+
+    # Registers used by the driver
+    FIFO_CTRL1 = 0x06
+    FIFO_CTRL2 = 0x07
+    FIFO_CTRL5 = 0x0A
+    INT2_CTRL = 0x0E
+    WHO_AM_I = 0x0F
+    CTRL3_C = 0x12
+    OUTX_L_G = 0x22
+    FIFO_STATUS1 = 0x3A
+    FIFO_STATUS2 = 0x3B
+    FIFO_STATUS3 = 0x3C
+    FIFO_STATUS4 = 0x3D
+    FIFO_DATA_OUT_L = 0x3E
+
+    # FIFO_STATUS2 flags
+    WATERMARK = 0x80
+    OVER_RUN = 0x40
+    FIFO_EMPTY = 0x10
+
+    # FIFO ODR of FIFO_CTRL5[6:3] in Hz
+    FIFO_ODR = {1: 12.5, 2: 26, 3: 52, 4: 104, 5: 208, 6: 416, 7: 833, 8: 1660, 9: 3330, 10: 6660}
+
+    # 4 kB FIFO in 16 bit words, one sample is 3 gyroscope and 3 accelerometer words
+    FIFO_WORDS = 2048
+    SAMPLE_BYTES = 12
+
+    def __init__(self, odr_hz=None, seed=0, signal_seconds=10.0):
+        """
+        :param odr_hz: Output data rate override in Hz, the rate from FIFO_CTRL5 is used if None
+        :param seed: Seed of the signal noise
+        :param signal_seconds: Length of the signal that is repeated, at 833 Hz
+        """
+
+        self.odr_override = odr_hz
+        self.lock = threading.Lock()
+        self.registers = bytearray(128)
+        self.registers[self.WHO_AM_I] = self.WHO_AM_I_VALUE
+
+        # FIFO
+        self.fifo = bytearray()
+        self.overrun = False
+        self.fifo_start = None
+        self.produced = 0
+
+        # Statistics
+        self.samples_generated = 0
+        self.samples_dropped = 0
+        self.bytes_read = 0
+
+        # Recorded like signal, repeated while the FIFO runs
+        self.signal = self.make_signal(int(833 * signal_seconds), 833, random.Random(seed))
+        self.signal_samples = len(self.signal) // self.SAMPLE_BYTES
+
+    @staticmethod
+    def make_signal(samples, rate_hz, rng):
+        """
+        Generate a drive like signal. Gravity with the sensor slightly tilted, engine vibration, accelerating and
+        braking, turns and occasional road bumps
+
+        :param samples: Number of samples
+        :param rate_hz: Sample rate of the signal
+        :param rng: Random generator for the noise
+        :return: The samples in the FIFO layout
+        """
+
+        lsb_per_g = 1 / 0.000488            # +/- 16 g
+        lsb_per_dps = 1 / 0.07              # 2000 dps
+        data = bytearray()
+        bump_at = set(rng.randrange(samples) for _ in range(max(1, samples // (rate_hz * 4))))
+        bump = 0
+        for n in range(samples):
+            t = n / rate_hz
+            if n in bump_at:
+                bump = int(rate_hz * 0.03)
+            bump_g = 0.0
+            if bump:
+                bump_g = 0.8 * math.sin(math.pi * bump / (rate_hz * 0.03))
+                bump -= 1
+
+            ax = 0.15 * math.sin(2 * math.pi * t / 10) + rng.gauss(0, 0.01)
+            ay = 0.1 * math.sin(2 * math.pi * t / 7) + rng.gauss(0, 0.01)
+            az = 0.99 + 0.03 * math.sin(2 * math.pi * 28 * t) + bump_g + rng.gauss(0, 0.015)
+            gx = 0.5 * math.sin(2 * math.pi * 28 * t) + rng.gauss(0, 0.3)
+            gy = 0.5 * math.cos(2 * math.pi * 28 * t) + rng.gauss(0, 0.3)
+            gz = 8 * math.sin(2 * math.pi * t / 7) + rng.gauss(0, 0.3)
+
+            data += struct.pack("<hhhhhh", *(int(round(v)) for v in (
+                gx * lsb_per_dps, gy * lsb_per_dps, gz * lsb_per_dps,
+                ax * lsb_per_g, ay * lsb_per_g, az * lsb_per_g)))
+        return bytes(data)
+
+    @property
+    def odr_hz(self):
+        """
+        Output data rate of the FIFO
+
+        :return: Rate in Hz, 0 if the FIFO is not running
+        """
+
+        if self.registers[self.FIFO_CTRL5] & 0x07 == 0:
+            return 0
+        if self.odr_override:
+            return self.odr_override
+        return self.FIFO_ODR.get((self.registers[self.FIFO_CTRL5] >> 3) & 0x0F, 0)
+
+    @property
+    def threshold(self):
+        """
+        FIFO watermark in words
+
+        :return: The watermark
+        """
+
+        return (self.registers[self.FIFO_CTRL2] & 0x07) << 8 | self.registers[self.FIFO_CTRL1]
+
+    def fill(self, now=None):
+        """
+        Move the samples due since the last access into the FIFO, dropping the oldest on overflow as in continuous
+        mode
+
+        :param now: Monotonic time
+        :return: None
+        """
+
+        if self.fifo_start is None:
+            return
+        now = time.monotonic() if now is None else now
+        due = int((now - self.fifo_start) * self.odr_hz) - self.produced
+        if due <= 0:
+            return
+
+        capacity = self.FIFO_WORDS * 2 // self.SAMPLE_BYTES
+        if due > capacity:
+            # Only the newest samples survive
+            self.samples_dropped += due - capacity
+            self.produced += due - capacity
+            self.samples_generated += due - capacity
+            due = capacity
+            self.overrun = True
+
+        start = self.produced % self.signal_samples
+        while due:
+            count = min(due, self.signal_samples - start)
+            self.fifo += self.signal[start * self.SAMPLE_BYTES:(start + count) * self.SAMPLE_BYTES]
+            self.produced += count
+            self.samples_generated += count
+            due -= count
+            start = 0
+
+        excess = len(self.fifo) - capacity * self.SAMPLE_BYTES
+        if excess > 0:
+            del self.fifo[:excess]
+            self.samples_dropped += excess // self.SAMPLE_BYTES
+            self.overrun = True
+
+    def reset_counters(self):
+        """
+        Reset the statistics
+
+        :return: None
+        """
+
+        with self.lock:
+            self.samples_generated = 0
+            self.samples_dropped = 0
+            self.bytes_read = 0
+
+    def fifo_words(self):
+        """
+        Words in the FIFO
+
+        :return: The number of words
+        """
+
+        return len(self.fifo) // 2
+
+    def watermark(self):
+        """
+        State of the INT2 pin, high while the FIFO is filled to the watermark
+
+        :return: True, if the pin is high
+        """
+
+        with self.lock:
+            self.fill()
+            return bool(self.registers[self.INT2_CTRL] & 0x08) and self.threshold > 0 \
+                and self.fifo_words() >= self.threshold
+
+    def time_to_watermark(self):
+        """
+        Time until the FIFO reaches the watermark
+
+        :return: Seconds, None if the FIFO is not running
+        """
+
+        with self.lock:
+            self.fill()
+            rate = self.odr_hz
+            if not rate or self.fifo_start is None or not self.threshold:
+                return None
+            missing = math.ceil((self.threshold - self.fifo_words()) * 2 / self.SAMPLE_BYTES)
+            return max(0.0, missing / rate)
+
+    def inject_overrun(self):
+        """
+        Fill the FIFO past its capacity at once, as if the reader was stalled
+
+        :return: None
+        """
+
+        with self.lock:
+            self.fill()
+            if self.fifo_start is not None:
+                self.fifo_start -= (self.FIFO_WORDS * 2 // self.SAMPLE_BYTES + 1) / self.odr_hz
+                self.fill()
+
+    def status(self, register):
+        """
+        Value of a FIFO status register
+
+        :param register: The register address
+        :return: The register value
+        """
+
+        words = self.fifo_words()
+        if register == self.FIFO_STATUS1:
+            return words & 0xFF
+        if register == self.FIFO_STATUS2:
+            value = (words >> 8) & 0x07
+            if self.threshold and words >= self.threshold:
+                value |= self.WATERMARK
+            if self.overrun:
+                value |= self.OVER_RUN
+            if not words:
+                value |= self.FIFO_EMPTY
+            return value
+        return 0
+
+    def write(self, register, value):
+        """
+        Write a register
+
+        :param register: The register address
+        :param value: The byte value
+        :return: None
+        """
+
+        if register == self.CTRL3_C and value & 0x01:
+            # Software reset
+            self.registers[:] = bytes(128)
+            self.registers[self.WHO_AM_I] = self.WHO_AM_I_VALUE
+            self.reset_fifo()
+            return
+
+        self.registers[register] = value
+        if register == self.FIFO_CTRL5:
+            if value & 0x07 == 0:
+                # Bypass mode empties the FIFO
+                self.reset_fifo()
+            elif self.fifo_start is None:
+                self.fifo_start = time.monotonic()
+                self.produced = 0
+
+    def reset_fifo(self):
+        """
+        Empty and stop the FIFO
+
+        :return: None
+        """
+
+        self.fifo.clear()
+        self.fifo_start = None
+        self.produced = 0
+        self.overrun = False
+
+    def read(self, register, count):
+        """
+        Read registers with address auto increment. Reads from the FIFO output drain the FIFO
+
+        :param register: The first register address
+        :param count: Number of bytes
+        :return: The bytes
+        """
+
+        if register == self.FIFO_DATA_OUT_L:
+            data = bytes(self.fifo[:count])
+            del self.fifo[:count]
+            self.overrun = False
+            self.bytes_read += len(data)
+            return data + bytes(count - len(data))
+        if register in (self.FIFO_STATUS1, self.FIFO_STATUS2, self.FIFO_STATUS3, self.FIFO_STATUS4):
+            return bytes(self.status(register + i) for i in range(count))
+        if register == self.OUTX_L_G:
+            index = max(self.produced - 1, 0) % self.signal_samples
+            return self.signal[index * self.SAMPLE_BYTES:(index + 1) * self.SAMPLE_BYTES][:count].ljust(count, b"\0")
+        return bytes(self.registers[register:register + count]).ljust(count, b"\0")
+
+    def xfer(self, tx):
+        """
+        One SPI transaction, the first byte is the address with the read bit
+
+        :param tx: Bytes sent
+        :return: Bytes received
+        """
+
+        address = tx[0]
+        with self.lock:
+            self.fill()
+            if address & 0x80:
+                return [0] + list(self.read(address & 0x7F, len(tx) - 1))
+            for offset, value in enumerate(tx[1:]):
+                self.write((address & 0x7F) + offset, value)
+            return [0] * len(tx)
+
+
+class FakeSpiDev:
+    """
+    spidev.SpiDev like handle to the simulated LSM6DSL on a bus and chip select
+    """
+
+    def __init__(self, sensors):
+        """
+        :param sensors: Function returning the sensor on a bus and chip select
+        """
+
+        self.sensors = sensors
+        self.sensor = None
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.is_open = False
+
+    def open(self, bus, device):
+        self.sensor = self.sensors(bus, device)
+        self.is_open = True
+
+    def xfer2(self, tx):
+        if not self.is_open:
+            raise IOError("SPI device is not open")
+        return self.sensor.xfer(tx)
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hal
+
+
+def count_records(path):
+    """
+    Number of records in a data file, without the header
+
+    :param path: Path to the file
+    :return: The number of records
+    """
+
+    with open(path, "rb") as fh:
+        return max(sum(chunk.count(b"\n") for chunk in iter(lambda: fh.read(1 << 20), b"")) - 1, 0)
+
+
+def run(duration=10.0, odr_hz=None, low_power=False, data_dir=None, gps_replay=None, gps_speed=1.0,
+        overrun_at=None, sensor_config=None, imu_stages=(), imu_process=False, telemetry_port=None, profile_file=None,
+        card_mb=None, storage_floor_mb=200):
+    """
+    Run a trial end to end through the DataHandler with the simulated devices
+
+    :param duration: Length of the trial in seconds
+    :param odr_hz: IMU output data rate override in Hz
+    :param low_power: Use the low power acquisition mode
+    :param data_dir: Directory for the trials, a temporary directory if None
+    :param gps_replay: Path to a recorded gps.dat to replay
+    :param gps_speed: GPS replay speed
+    :param overrun_at: Seconds into the trial to inject an IMU FIFO overrun
+    :param sensor_config: Sensor configuration file, the GPS and IMU pollers are used if None
+    :param imu_stages: Processing stages of the IMU samples
+    :param imu_process: Read the IMU in a child process, which simulates its own IMU
+    :param telemetry_port: UDP port of the live telemetry stream, None to disable
+    :param profile_file: Acquisition profile, the default profile if None
+    :param card_mb: Capacity of a simulated card in MB for the trials, the free space of the host is used if None
+    :param storage_floor_mb: Free space in MB at which the trial is stopped
+    :return: A dict with the trial summary
+    """
+
+    simulation = hal.enable_simulation(odr_hz=odr_hz)
+    simulation.imu.odr_override = odr_hz
+    simulation.reset_counters()
+    simulation.start_gpsd(replay=gps_replay, speed=gps_speed)
+
+    from display.ssd1306 import Display
+    from display.service import DisplayService
+    from data_handler import DataHandler
+
+    data_dir = data_dir or tempfile.mkdtemp(prefix="drivesense-sim-")
+    if card_mb is not None:
+        simulation.insert_card(data_dir, int(card_mb * 1000 * 1000))
+    display = DisplayService(Display())
+    display.start()
+    handler = DataHandler(display=display, gps_fix_state=[0], save_location=data_dir, low_power=low_power,
+                          sensor_config=sensor_config, imu_stages=imu_stages, imu_process=imu_process,
+                          telemetry_port=telemetry_port,
+                          profile_file=profile_file or os.path.join(data_dir, "profile.json"),
+                          storage_floor_mb=storage_floor_mb)
+    telemetry = None
+    if handler.telemetry is not None:
+        handler.telemetry.start()
+
+    try:
+        handler.arm()
+        handler.start_daq()
+        save_dir = handler.pollers[0].save_dir_time
+        if overrun_at is not None and overrun_at < duration:
+            time.sleep(overrun_at)
+            simulation.imu.inject_overrun()
+            time.sleep(duration - overrun_at)
+        else:
+            time.sleep(duration)
+        handler.stop_daq()
+    finally:
+        # Disarm the sensors prepared for the next trial
+        handler.close()
+        if handler.telemetry is not None:
+            telemetry = handler.telemetry.stats()
+            handler.telemetry.stop()
+        display.stop()
+        simulation.stop()
+
+    trial_dir = os.path.join(data_dir, save_dir)
+    with open(os.path.join(trial_dir, "imu.meta"), "r") as fh:
+        imu_meta = json.load(fh)
+    samples = count_records(os.path.join(trial_dir, "imu.dat"))
+    storage = None
+    if os.path.exists(os.path.join(trial_dir, "storage.meta")):
+        with open(os.path.join(trial_dir, "storage.meta"), "r") as fh:
+            storage = json.load(fh)
+    stats = simulation.stats()
+    # The IMU of a child process reports its counters in the metadata
+    stats["imu"] = imu_meta.get("simulation", stats["imu"])
+    return {
+        "trial_dir": trial_dir,
+        "elapsed_time": imu_meta["elapsed_time"],
+        "imu_samples": samples,
+        "imu_samples_generated": stats["imu"]["samples_generated"],
+        "imu_samples_dropped": stats["imu"]["samples_dropped"],
+        "imu_fifo_overruns": imu_meta.get("fifo_overruns"),
+        "start_latency_ms": imu_meta.get("start_latency_ms"),
+        "power": imu_meta.get("power"),
+        "pipeline": imu_meta.get("pipeline"),
+        "read_lag_ms": imu_meta.get("read_lag_ms"),
+        "gps_bytes": os.path.getsize(os.path.join(trial_dir, "gps.dat")),
+        "oled": stats["oled"],
+        "telemetry": telemetry,
+        "storage": storage,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a trial with the simulated IMU, GPS and display")
+    parser.add_argument("--duration", type=float, default=10.0, help="Trial length in seconds")
+    parser.add_argument("--odr", type=float, default=None, help="IMU output data rate in Hz")
+    parser.add_argument("--low-power", action="store_true", help="Use the low power acquisition mode")
+    parser.add_argument("--data-dir", default=None, help="Directory for the trials")
+    parser.add_argument("--gps-replay", default=None, help="Recorded gps.dat to replay")
+    parser.add_argument("--gps-speed", type=float, default=1.0, help="GPS replay speed, 0 for as fast as possible")
+    parser.add_argument("--overrun-at", type=float, default=None, help="Inject an IMU FIFO overrun after seconds")
+    parser.add_argument("--sensor-config", default=None, help="Sensor configuration file")
+    parser.add_argument("--imu-stage", action="append", default=[], help="IMU processing stage, e.g. orientation")
+    parser.add_argument("--imu-process", action="store_true", help="Read the IMU in a child process")
+    parser.add_argument("--telemetry-port", type=int, default=None, help="Stream the trial live on a UDP port")
+    parser.add_argument("--profile", default=None, help="Acquisition profile file")
+    parser.add_argument("--card-mb", type=float, default=None, help="Record to a simulated card of a capacity in MB")
+    parser.add_argument("--storage-floor-mb", type=float, default=200, help="Free space in MB to stop the trial at")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log to stderr")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    summary = run(duration=args.duration, odr_hz=args.odr, low_power=args.low_power, data_dir=args.data_dir,
+                  gps_replay=args.gps_replay, gps_speed=args.gps_speed, overrun_at=args.overrun_at,
+                  sensor_config=args.sensor_config, imu_stages=args.imu_stage,
+                  imu_process=args.imu_process, telemetry_port=args.telemetry_port, profile_file=args.profile,
+                  card_mb=args.card_mb, storage_floor_mb=args.storage_floor_mb)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import os
+import threading
+
+
+class FakeCard:
+    """
+    An SD card of a set capacity mounted at a directory. The directory lives on the host file system, the card reports
+    what is left of its capacity after the files below the directory, as os.statvfs would
+    """
+
+    BLOCK_SIZE = 4096
+
+    def __init__(self, root, capacity_bytes):
+        """
+        :param root: The directory the card is mounted at
+        :param capacity_bytes: Capacity of the card
+        """
+
+        self.root = root
+        self.capacity_bytes = capacity_bytes
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.queries = 0
+
+    def used_bytes(self):
+        """
+        Bytes of the files on the card, in whole blocks
+
+        :return: The used bytes
+        """
+
+        used = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                try:
+                    size = os.path.getsize(os.path.join(directory, name))
+                except OSError:
+                    continue
+                used += -(-size // self.BLOCK_SIZE) * self.BLOCK_SIZE
+        return used
+
+    def statvfs(self, path):
+        """
+        File system statistics of the card
+
+        :param path: A path on the card
+        :return: An os.statvfs_result
+        """
+
+        with self.lock:
+            self.queries += 1
+        blocks = self.capacity_bytes // self.BLOCK_SIZE
+        free = max(blocks - self.used_bytes() // self.BLOCK_SIZE, 0)
+        host = os.statvfs(path)
+        return os.statvfs_result((self.BLOCK_SIZE, self.BLOCK_SIZE, blocks, free, free, host.f_files, host.f_ffree,
+                                  host.f_favail, host.f_flag, host.f_namemax))
@@ -0,0 +1,130 @@
+import os
+import logging
+from simulator.lsm6dsl_sim import FakeLSM6DSL, FakeSpiDev
+from simulator.gpio_sim import FakeGPIO
+from simulator.gpsd_sim import FakeGpsdServer
+from simulator.ssd1306_sim import FakeSSD1306
+from simulator.sdcard_sim import FakeCard
+
+
+class Simulation:
+    """
+    The simulated devices of the BerryGPS-IMU v4 and the OLED, wired as on the Pi. The INT2 pin of the IMU drives the
+    data ready pin
+    """
+
+    def __init__(self, odr_hz=None, drdy_pin=24, seed=0):
+        """
+        :param odr_hz: IMU output data rate override in Hz, the configured rate is used if None
+        :param drdy_pin: GPIO pin the INT2 pin is wired to
+        :param seed: Seed of the IMU signal noise
+        """
+
+        self.imu = FakeLSM6DSL(odr_hz=odr_hz, seed=seed)
+        self.imus = {(0, 0): self.imu}
+        self.gpio = FakeGPIO()
+        self.gpio.attach(drdy_pin, self.imu.watermark, self.imu.time_to_watermark)
+        self.oled = FakeSSD1306()
+        self.gpsd = None
+        self.card = None
+        self.usb = None
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def gpsd_port(self):
+        return self.gpsd.port if self.gpsd is not None else None
+
+    def sensor(self, bus, device):
+        """
+        The IMU on a bus and chip select, further IMUs are created on first use
+
+        :param bus: SPI bus
+        :param device: Chip select
+        :return: The simulated IMU
+        """
+
+        if (bus, device) not in self.imus:
+            self.imus[(bus, device)] = FakeLSM6DSL(odr_hz=self.imu.odr_override, seed=len(self.imus))
+        return self.imus[(bus, device)]
+
+    def spi_device(self):
+        return FakeSpiDev(self.sensor)
+
+    def insert_card(self, root, capacity_bytes):
+        """
+        Mount a card of a set capacity at a directory, the file system of the host is used if no card is inserted
+
+        :param root: The directory
+        :param capacity_bytes: Capacity of the card
+        :return: The card
+        """
+
+        self.card = FakeCard(root, capacity_bytes)
+        return self.card
+
+    def statvfs(self, path):
+        if self.card is not None and os.path.abspath(path).startswith(os.path.abspath(self.card.root)):
+            return self.card.statvfs(path)
+        return os.statvfs(path)
+
+    def insert_usb(self, root):
+        """
+        Plug in a USB drive mounted at a directory
+
+        :param root: The directory
+        :return: None
+        """
+
+        self.usb = os.path.abspath(root)
+
+    def ismount(self, path):
+        if self.usb is not None and os.path.abspath(path) == self.usb:
+            return True
+        return os.path.ismount(path)
+
+    def unmount(self, path):
+        if self.usb is None or os.path.abspath(path) != self.usb:
+            raise OSError(f"No simulated drive is mounted at {path}")
+        self.usb = None
+
+    def start_gpsd(self, replay=None, speed=1.0, rate_hz=10):
+        """
+        Start the simulated gpsd
+
+        :param replay: Path to a recorded gps.dat, a synthetic drive is used if None
+        :param speed: Replay speed, 0 for as fast as possible
+        :param rate_hz: Fix rate
+        :return: The server
+        """
+
+        if self.gpsd is None:
+            if replay:
+                self.gpsd = FakeGpsdServer.from_file(replay, speed=speed, rate_hz=rate_hz)
+            else:
+                self.gpsd = FakeGpsdServer(speed=speed, rate_hz=rate_hz)
+            self.gpsd.start()
+        return self.gpsd
+
+    def stop(self):
+        if self.gpsd is not None:
+            self.gpsd.stop()
+            self.gpsd = None
+
+    def reset_counters(self):
+        self.imu.reset_counters()
+        self.oled.reset_counters()
+
+    def stats(self):
+        """
+        Counters of the simulated devices
+
+        :return: A dict with the counters
+        """
+
+        return {
+            "imu": {"odr_hz": self.imu.odr_hz, "samples_generated": self.imu.samples_generated,
+                    "samples_dropped": self.imu.samples_dropped, "bytes_read": self.imu.bytes_read},
+            "oled": self.oled.stats(),
+            "card": {"queries": self.card.queries} if self.card is not None else None,
+        }
@@ -0,0 +1,121 @@
+import threading
+
+
+class FakeSSD1306:
+    """
+    luma ssd1306 like device that keeps the display memory and counts the I2C traffic. Full frames are written the
+    way luma writes them, the window commands used by the page diffing are honoured
+    """
+
+    COLUMNADDR = 0x21
+    PAGEADDR = 0x22
+    DISPLAYOFF = 0xAE
+    DISPLAYON = 0xAF
+
+    def __init__(self, width=128, height=64):
+        self.width = width
+        self.height = height
+        self.mode = "1"
+        self.size = (width, height)
+        self.bounding_box = (0, 0, width - 1, height - 1)
+        self.lock = threading.Lock()
+
+        # Display memory, a byte per column of each 8 row page
+        self.gddram = bytearray(width * height // 8)
+        self.powered = True
+        self.window = (0, width - 1, 0, height // 8 - 1)
+        self.cursor = 0
+
+        # Traffic
+        self.command_bytes = 0
+        self.data_bytes = 0
+        self.frames = 0
+
+    @property
+    def bytes_sent(self):
+        return self.command_bytes + self.data_bytes
+
+    def preprocess(self, image):
+        return image
+
+    def command(self, *cmd):
+        with self.lock:
+            self.command_bytes += len(cmd)
+            cmd = list(cmd)
+            while cmd:
+                code = cmd.pop(0)
+                if code == self.COLUMNADDR and len(cmd) >= 2:
+                    start, end = cmd.pop(0), cmd.pop(0)
+                    self.window = (start, end) + self.window[2:]
+                    self.cursor = 0
+                elif code == self.PAGEADDR and len(cmd) >= 2:
+                    start, end = cmd.pop(0), cmd.pop(0)
+                    self.window = self.window[:2] + (start, end)
+                    self.cursor = 0
+                elif code == self.DISPLAYOFF:
+                    self.powered = False
+                elif code == self.DISPLAYON:
+                    self.powered = True
+
+    def data(self, data):
+        with self.lock:
+            self.data_bytes += len(data)
+            col_start, col_end, page_start, page_end = self.window
+            columns = col_end - col_start + 1
+            size = columns * (page_end - page_start + 1)
+            for value in data:
+                page = page_start + self.cursor // columns
+                column = col_start + self.cursor % columns
+                self.gddram[page * self.width + column] = value
+                self.cursor = (self.cursor + 1) % size
+
+    def display(self, image):
+        """
+        Write a full frame, as luma does
+
+        :param image: The frame
+        :return: None
+        """
+
+        image = self.preprocess(image).convert("1")
+        pixels = image.load()
+        buffer = bytearray(self.width * self.height // 8)
+        for page in range(self.height // 8):
+            for x in range(self.width):
+                byte = 0
+                for bit in range(8):
+                    if pixels[x, page * 8 + bit]:
+                        byte |= 1 << bit
+                buffer[page * self.width + x] = byte
+        self.command(self.COLUMNADDR, 0, self.width - 1, self.PAGEADDR, 0, self.height // 8 - 1)
+        self.data(list(buffer))
+        with self.lock:
+            self.frames += 1
+
+    def show(self):
+        self.command(self.DISPLAYON)
+
+    def hide(self):
+        self.command(self.DISPLAYOFF)
+
+    def clear(self):
+        self.command(self.COLUMNADDR, 0, self.width - 1, self.PAGEADDR, 0, self.height // 8 - 1)
+        self.data([0] * len(self.gddram))
+
+    def cleanup(self):
+        pass
+
+    def reset_counters(self):
+        with self.lock:
+            self.command_bytes = 0
+            self.data_bytes = 0
+            self.frames = 0
+
+    def stats(self):
+        """
+        Traffic counters
+
+        :return: A dict with the counters
+        """
+
+        return {"frames": self.frames, "command_bytes": self.command_bytes, "data_bytes": self.data_bytes}
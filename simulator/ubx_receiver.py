@@ -0,0 +1,296 @@
+import os
+import pty
+import tty
+import time
+import struct
+import select
+import termios
+import logging
+import threading
+from GPS import ubx
+
+
+# Speeds of the termios settings a client puts on the pty
+TERMIOS_SPEEDS = {getattr(termios, f"B{rate}"): rate for rate in (4800, 9600, 19200, 38400, 57600, 115200, 230400)}
+
+# Payload lengths of the UBX navigation messages, NAV-SAT with 12 satellites
+UBX_LENGTHS = {"NAV-POSLLH": 28, "NAV-STATUS": 16, "NAV-DOP": 18, "NAV-PVT": 92, "NAV-VELNED": 36,
+               "NAV-TIMEGPS": 16, "NAV-SAT": 8 + 12 * 12}
+
+
+def nmea(body):
+    """
+    Frame an NMEA sentence
+
+    :param body: The sentence between $ and *
+    :return: The sentence bytes
+    """
+
+    cs = 0
+    for char in body.encode():
+        cs ^= char
+    return f"${body}*{cs:02X}\r\n".encode()
+
+
+class FakeReceiver(threading.Thread):
+    """
+    A u-blox M8 receiver behind a pseudo terminal, for the GPSCommandSender. It talks UBX and NMEA on UART1 with the
+    factory defaults: 9600 baud, 1 Hz and the GGA, GLL, GSA, GSV, RMC and VTG sentences. The UART is modelled with its
+    baud rate: bytes are only understood if the client set the same speed on the terminal, and the output is limited to
+    the bytes the baud rate carries. Output beyond the transmit buffer is dropped, as on the receiver
+    """
+
+    # Defaults of the receiver
+    DEFAULT_MESSAGES = {"GGA": 1, "GLL": 1, "GSA": 1, "GSV": 1, "RMC": 1, "VTG": 1}
+
+    def __init__(self, baudrate=9600, rate_ms=1000, tx_buffer=4096):
+        """
+        :param baudrate: Baud rate of UART1 at power up
+        :param rate_ms: Measurement rate at power up
+        :param tx_buffer: Bytes of the transmit buffer
+        """
+
+        threading.Thread.__init__(self, name="FakeReceiver", daemon=True)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        # Nobody may be reading, the line does not wait for a listener
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.tx_buffer = tx_buffer
+
+        # Configuration, the current and the one saved to the non-volatile memory
+        self.config = {"baudrate": baudrate, "rate_ms": rate_ms, "in_proto": 0x07, "out_proto": 0x03,
+                       "messages": {name: [0, rate, 0, 0, 0, 0] for name, rate in self.DEFAULT_MESSAGES.items()}}
+        self.saved = None
+        self.defaults = self.copy_config()
+
+        self.tx = bytearray()
+        self.pending_baudrate = None
+        self.pending_bytes = 0
+        self.epoch = 0
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.bytes_sent = 0
+        self.bytes_dropped = 0
+        self.epochs = 0
+        self.commands = []
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def copy_config(self):
+        config = dict(self.config)
+        config["messages"] = {name: list(rates) for name, rates in self.config["messages"].items()}
+        return config
+
+    def client_baudrate(self):
+        """
+        Speed the client set on the terminal
+
+        :return: The baud rate
+        """
+
+        return TERMIOS_SPEEDS.get(termios.tcgetattr(self.slave)[5])
+
+    def queue(self, data):
+        """
+        Queue output, dropping what does not fit the transmit buffer
+
+        :param data: The bytes
+        :return: None
+        """
+
+        room = self.tx_buffer - len(self.tx)
+        if len(data) > room:
+            self.bytes_dropped += len(data)
+            return
+        self.tx.extend(data)
+
+    def reply(self, msg_class, msg_id, payload=b""):
+        # Responses are never dropped, they wait behind the output already queued
+        self.tx.extend(ubx.build(msg_class, msg_id, payload))
+
+    def ack(self, msg_id, accepted=True):
+        self.reply(ubx.CLS_ACK, ubx.ACK_ACK if accepted else ubx.ACK_NAK, bytes((ubx.CLS_CFG, msg_id)))
+
+    def handle(self, msg_class, msg_id, payload):
+        """
+        Answer a UBX message
+
+        :param msg_class: The message class
+        :param msg_id: The message id
+        :param payload: The message payload
+        :return: None
+        """
+
+        if msg_class != ubx.CLS_CFG:
+            return
+        self.commands.append((msg_id, bytes(payload)))
+        config = self.config
+        if msg_id == ubx.CFG_RATE:
+            if not payload:
+                self.reply(ubx.CLS_CFG, ubx.CFG_RATE, struct.pack("<HHH", config["rate_ms"], 1, 1))
+                return
+            rate_ms = struct.unpack_from("<H", payload)[0]
+            accepted = rate_ms >= ubx.MIN_MEAS_RATE_MS
+            if accepted:
+                config["rate_ms"] = rate_ms
+            self.ack(msg_id, accepted)
+        elif msg_id == ubx.CFG_PRT:
+            if len(payload) == 1:
+                self.reply(ubx.CLS_CFG, ubx.CFG_PRT, struct.pack(
+                    "<BBHIIHHHH", ubx.PORT_UART1, 0, 0, 0x08D0, config["baudrate"], config["in_proto"],
+                    config["out_proto"], 0, 0))
+                return
+            port = ubx.parse_prt(payload)
+            config["in_proto"], config["out_proto"] = port["in_proto"], port["out_proto"]
+            self.ack(msg_id)
+            # The new baud rate applies once the acknowledgement is out
+            self.pending_baudrate = port["baudrate"]
+            self.pending_bytes = len(self.tx)
+        elif msg_id == ubx.CFG_MSG:
+            names = {value: name for name, value in ubx.MESSAGES.items()}
+            name = names.get(tuple(payload[:2]))
+            if name is None:
+                self.ack(msg_id, False)
+            elif len(payload) == 2:
+                rates = config["messages"].get(name, [0] * ubx.PORTS)
+                self.reply(ubx.CLS_CFG, ubx.CFG_MSG, bytes(payload[:2]) + bytes(rates))
+            else:
+                rates = list(payload[2:2 + ubx.PORTS])
+                if len(payload) < 8:
+                    # The short form sets the rate of the port it was received on, UART1
+                    rates = list(config["messages"].get(name, [0] * ubx.PORTS))
+                    rates[ubx.PORT_UART1] = payload[2]
+                config["messages"][name] = rates
+                self.ack(msg_id)
+        elif msg_id == ubx.CFG_CFG:
+            clear, save, load, _ = struct.unpack_from("<IIIB", payload)
+            if clear:
+                self.saved = None
+            if save:
+                self.saved = self.copy_config()
+            if load:
+                self.restore(self.saved or self.defaults)
+            self.ack(msg_id)
+        elif msg_id == ubx.CFG_PWR:
+            self.ack(msg_id)
+
+    def power_cycle(self):
+        """
+        Restart the receiver, it comes up with the saved configuration or the defaults
+
+        :return: None
+        """
+
+        with self.lock:
+            self.restore(self.saved or self.defaults)
+            self.tx.clear()
+            self.pending_baudrate = None
+
+    def restore(self, source):
+        self.config = dict(source, messages={name: list(rates) for name, rates in source["messages"].items()})
+
+    def output(self):
+        """
+        Queue the messages of one navigation solution
+
+        :return: None
+        """
+
+        self.epoch += 1
+        self.epochs += 1
+        now = time.gmtime()
+        stamp = time.strftime("%H%M%S", now) + f".{self.epoch % 100:02d}"
+        date = time.strftime("%d%m%y", now)
+        for name, rates in self.config["messages"].items():
+            rate = rates[ubx.PORT_UART1]
+            if not rate or self.epoch % rate:
+                continue
+            if name in UBX_LENGTHS:
+                if self.config["out_proto"] & ubx.PROTO_UBX:
+                    self.queue(ubx.build(*ubx.MESSAGES[name], bytes(UBX_LENGTHS[name])))
+                continue
+            if not self.config["out_proto"] & ubx.PROTO_NMEA:
+                continue
+            if name == "GGA":
+                self.queue(nmea(f"GNGGA,{stamp},4304.39000,N,08924.07200,W,1,12,0.90,260.0,M,-33.9,M,,"))
+            elif name == "GLL":
+                self.queue(nmea(f"GNGLL,4304.39000,N,08924.07200,W,{stamp},A,A"))
+            elif name == "GSA":
+                self.queue(nmea("GNGSA,A,3,01,02,03,04,05,06,07,08,09,10,11,12,1.60,0.90,1.30"))
+            elif name == "GSV":
+                for part in range(1, 4):
+                    sats = ",".join(f"{prn:02d},{30 + prn:02d},{prn * 30:03d},40" for prn in
+                                    range(part * 4 - 3, part * 4 + 1))
+                    self.queue(nmea(f"GPGSV,3,{part},12,{sats}"))
+            elif name == "RMC":
+                self.queue(nmea(f"GNRMC,{stamp},A,4304.39000,N,08924.07200,W,25.270,93.72,{date},,,A"))
+            elif name == "VTG":
+                self.queue(nmea("GNVTG,93.72,T,,M,25.270,N,46.800,K,A"))
+            else:
+                self.queue(nmea(f"GN{name},{stamp}"))
+
+    def run(self):
+        tick = 0.002
+        next_epoch = time.monotonic()
+        last = time.monotonic()
+        allowance = 0.0
+        reader = ubx.UBXReader(None)
+        while not self.stopped.is_set():
+            readable, _, _ = select.select([self.master], [], [], tick)
+            with self.lock:
+                now = time.monotonic()
+                in_sync = self.client_baudrate() == self.config["baudrate"]
+                if readable:
+                    try:
+                        data = os.read(self.master, 4096)
+                    except OSError:
+                        data = b""
+                    # Bytes at another baud rate are noise to the receiver
+                    if in_sync:
+                        reader.buffer.extend(data)
+                        while True:
+                            frame = reader.next_frame()
+                            if frame is None:
+                                break
+                            self.handle(*frame)
+
+                interval = self.config["rate_ms"] / 1000
+                # A faster rate applies right away
+                if next_epoch - now > interval:
+                    next_epoch = now
+                if now >= next_epoch:
+                    self.output()
+                    next_epoch = max(next_epoch + interval, now)
+
+                # The UART carries a tenth of the baud rate in bytes per second
+                allowance = min(allowance + (now - last) * self.config["baudrate"] / 10, 256)
+                last = now
+                count = min(int(allowance), len(self.tx))
+                if count:
+                    data = bytes(self.tx[:count])
+                    del self.tx[:count]
+                    allowance -= count
+                    self.bytes_sent += count
+                    # At another baud rate the client only sees garbage
+                    try:
+                        os.write(self.master, data if in_sync else bytes(b ^ 0x5A for b in data))
+                    except BlockingIOError:
+                        pass
+                    self.pending_bytes -= count
+                if self.pending_baudrate is not None and self.pending_bytes <= 0:
+                    self.config["baudrate"], self.pending_baudrate = self.pending_baudrate, None
+
+    def start(self):
+        super().start()
+        self.logger.info(f"Simulated receiver on {self.port}")
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self.slave)
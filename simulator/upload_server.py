@@ -0,0 +1,137 @@
+import os
+import hashlib
+import logging
+import threading
+import http.server
+from urllib.parse import unquote, urlsplit
+
+
+class UploadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    The upload protocol of the collection server. A file is uploaded to /uploads/<device>/<trial>/<path>:
+
+    - HEAD returns the bytes received so far in Upload-Offset, and Upload-Complete if the file is complete
+    - PATCH appends a chunk at Upload-Offset, checked against Chunk-SHA256. A wrong offset is answered with 409 and
+      the current offset, a wrong checksum with 422
+    - POST completes the file if the SHA-256 of the whole file matches File-SHA256, otherwise the file is discarded
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+    def paths(self):
+        relative = unquote(urlsplit(self.path).path)
+        if not relative.startswith("/uploads/") or ".." in relative.split("/"):
+            return None, None
+        path = os.path.join(self.server.directory, relative[len("/uploads/"):])
+        return path, path + ".part"
+
+    def reply(self, status, offset=None, complete=False):
+        self.send_response(status)
+        if offset is not None:
+            self.send_header("Upload-Offset", str(offset))
+        if complete:
+            self.send_header("Upload-Complete", "1")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        path, part = self.paths()
+        if path is None:
+            return self.reply(404)
+        if os.path.exists(path):
+            return self.reply(200, os.path.getsize(path), complete=True)
+        return self.reply(200, os.path.getsize(part) if os.path.exists(part) else 0)
+
+    def do_PATCH(self):
+        path, part = self.paths()
+        length = int(self.headers.get("Content-Length", 0))
+        offset = int(self.headers.get("Upload-Offset", -1))
+        server = self.server
+
+        # A link drop in the middle of the chunk
+        with server.lock:
+            server.received += length
+            drop = server.drop_every and server.received >= server.next_drop
+            if drop:
+                server.next_drop += server.drop_every
+                server.drops += 1
+        if drop:
+            self.rfile.read(length // 2)
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+
+        body = self.rfile.read(length)
+        if path is None:
+            return self.reply(404)
+        current = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset != current:
+            return self.reply(409, current)
+        if hashlib.sha256(body).hexdigest() != self.headers.get("Chunk-SHA256"):
+            return self.reply(422, current)
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        with open(part, "ab") as fh:
+            fh.write(body)
+        self.reply(204, current + len(body))
+
+    def do_POST(self):
+        path, part = self.paths()
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path is None:
+            return self.reply(404)
+        if not os.path.exists(path):
+            if not os.path.exists(part):
+                return self.reply(404, 0)
+            os.replace(part, path)
+        digest = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                digest.update(block)
+        if digest.hexdigest() != self.headers.get("File-SHA256"):
+            os.remove(path)
+            return self.reply(422, 0)
+        self.reply(200, os.path.getsize(path), complete=True)
+
+
+class FakeUploadServer(http.server.ThreadingHTTPServer):
+    """
+    Stand-in for the collection server, stores the uploads in a directory. Can drop the connection in the middle of
+    a chunk every so many bytes, to exercise the resume of the uploader
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, directory, address=("127.0.0.1", 0), drop_every=None):
+        """
+        :param directory: Directory for the uploaded files
+        :param address: Address to listen on, a free port by default
+        :param drop_every: Drop the connection after about this many bytes, never if None
+        """
+
+        super().__init__(address, UploadHandler)
+        self.directory = directory
+        self.drop_every = drop_every
+        self.next_drop = drop_every or 0
+        self.received = 0
+        self.drops = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/uploads"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="FakeUploadServer", daemon=True)
+        self.thread.start()
+        self.logger.info(f"Simulated collection server at {self.url}")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
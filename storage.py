@@ -0,0 +1,225 @@
+import time
+import logging
+import threading
+import metrics
+import hal
+
+
+def format_remaining(seconds):
+    """
+    Remaining recording time for the display
+
+    :param seconds: The remaining time, None if not known yet
+    :return: e.g. "3 h 20 min", "12 min" or "--"
+    """
+
+    if seconds is None:
+        return "--"
+    minutes = int(seconds // 60)
+    if minutes >= 60:
+        return f"{minutes // 60} h {minutes % 60} min"
+    return f"{minutes} min"
+
+
+class StorageMonitor:
+    """
+    Watches the free space of the card during a trial. The space is sampled with statvfs at a bounded rate, never per
+    write, and the write rate of all the streams together is estimated from the space consumed between the samples.
+    The remaining recording time counts down to the hard floor, the trial is stopped at the floor so that it is closed
+    with its metadata before the card runs full
+    """
+
+    def __init__(self, path="/sensor_data", floor_mb=200, warn_minutes=(30, 10, 5), interval=5.0, min_interval=0.5,
+                 smoothing=0.3, on_warning=None, on_floor=None):
+        """
+        :param path: A path on the card
+        :param floor_mb: Free space in MB at which the trial is stopped
+        :param warn_minutes: Remaining recording times in minutes to warn at
+        :param interval: Longest time between the samples in seconds
+        :param min_interval: Shortest time between the samples in seconds, the samples get closer near the floor
+        :param smoothing: Weight of the newest rate in the moving average of the write rate
+        :param on_warning: Called with the remaining seconds when a warning threshold is crossed
+        :param on_floor: Called with the free bytes when the floor is reached, from the monitor thread
+        """
+
+        self.path = path
+        self.floor_bytes = floor_mb * 1000 * 1000
+        self.warn_minutes = sorted(warn_minutes, reverse=True)
+        self.interval = interval
+        self.min_interval = min_interval
+        self.smoothing = smoothing
+        self.on_warning = on_warning
+        self.on_floor = on_floor
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.monitor_thread = None
+
+        # State of the trial
+        self.active = False
+        self.trial_start = None
+        self.free_start = None
+        self.free = None
+        self.last_sample = None
+        self.rate = None
+        self.rates = 0
+        self.samples = 0
+        self.warned = []
+        self.floor_reached = False
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # Metrics
+        self.free_bytes = metrics.REGISTRY.gauge("storage_free_bytes", "Free space on the card")
+        self.write_rate = metrics.REGISTRY.gauge("storage_write_rate_bytes", "Bytes per second written in the trial")
+        self.remaining = metrics.REGISTRY.gauge("storage_remaining_seconds", "Recording time left until the floor")
+        self.floor_total = metrics.REGISTRY.counter("storage_floor_stops_total", "Trials stopped at the storage floor")
+
+    def free_space(self):
+        """
+        Free space on the card
+
+        :return: The bytes available
+        """
+
+        st = hal.statvfs(self.path)
+        self.samples += 1
+        return st.f_bavail * st.f_frsize
+
+    def can_record(self):
+        """
+        Whether there is space for a trial
+
+        :return: True, if the free space is above the floor
+        """
+
+        try:
+            free = self.free_space()
+        except OSError as e:
+            # Not knowing the space does not keep the device from recording
+            self.logger.error(f"Error reading the free space: {e}")
+            return True
+        self.free_bytes.set(free)
+        return free > self.floor_bytes
+
+    def remaining_seconds(self):
+        """
+        Recording time left until the floor at the current write rate
+
+        :return: The seconds, None if the rate is not known yet
+        """
+
+        with self.lock:
+            if not self.rates or not self.rate or self.free is None:
+                return None
+            return max(self.free - self.floor_bytes, 0) / self.rate
+
+    def begin_trial(self):
+        """
+        Start watching the space of a trial
+
+        :return: None
+        """
+
+        try:
+            free = self.free_space()
+        except OSError as e:
+            self.logger.error(f"Error reading the free space, the trial is not watched: {e}")
+            return
+        with self.lock:
+            self.active = True
+            self.trial_start = time.monotonic()
+            self.free_start = self.free = free
+            self.last_sample = self.trial_start
+            self.rate = None
+            self.rates = 0
+            self.warned = []
+            self.floor_reached = False
+        self.free_bytes.set(self.free_start)
+
+        if self.monitor_thread is None:
+            self.monitor_thread = threading.Thread(target=self.run, name="StorageMonitor", daemon=True)
+            self.monitor_thread.start()
+        self.wakeup.set()
+
+    def end_trial(self):
+        """
+        Stop watching, may be called from the on_floor callback
+
+        :return: A dict with the storage metadata of the trial
+        """
+
+        with self.lock:
+            if not self.active:
+                return {}
+            self.active = False
+            self.wakeup.set()
+            try:
+                free = self.free_space()
+            except OSError:
+                free = self.free
+            elapsed = time.monotonic() - self.trial_start
+            return {"floor_mb": self.floor_bytes / 1e6, "free_start_bytes": self.free_start, "free_end_bytes": free,
+                    "write_rate_bytes": round(max(self.free_start - free, 0) / elapsed, 1) if elapsed else None,
+                    "warnings_min": list(self.warned), "stopped_at_floor": self.floor_reached}
+
+    def update(self):
+        """
+        Sample the free space and update the write rate
+
+        :return: The time to wait before the next sample
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            free = self.free_space()
+            elapsed = now - self.last_sample
+            if elapsed > 0:
+                # Space freed during a trial, e.g. by a pruned upload, is not negative writing
+                rate = max(self.free - free, 0) / elapsed
+                self.rate = rate if self.rate is None else self.rate + self.smoothing * (rate - self.rate)
+                self.rates += 1
+            self.free, self.last_sample = free, now
+        self.free_bytes.set(free)
+        self.write_rate.set(self.rate or 0)
+        remaining = self.remaining_seconds()
+        self.remaining.set(remaining if remaining is not None else -1)
+
+        if free <= self.floor_bytes:
+            if self.floor_reached:
+                # The trial is being stopped already
+                return self.interval
+            self.floor_reached = True
+            self.floor_total.inc()
+            self.logger.error(f"Only {free / 1e6:.0f} MB free on the card, stopping the trial")
+            if self.on_floor is not None:
+                self.on_floor(free)
+            return self.interval
+
+        # The first rates include the start of the streams, a warning waits for a settled rate
+        if remaining is not None and self.rates >= 2:
+            crossed = [minutes for minutes in self.warn_minutes if remaining < minutes * 60]
+            if crossed and crossed[-1] not in self.warned:
+                self.warned.extend(minutes for minutes in crossed if minutes not in self.warned)
+                self.logger.warning(f"Storage for {format_remaining(remaining)} of recording left")
+                if self.on_warning is not None:
+                    self.on_warning(remaining)
+
+        # Closer samples as the floor nears, so that it is not overshot between two samples
+        if remaining is None:
+            return self.interval
+        return min(self.interval, max(self.min_interval, remaining / 4))
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            while self.active:
+                try:
+                    wait = self.update()
+                except OSError as e:
+                    self.logger.error(f"Error reading the free space: {e}")
+                    wait = self.interval
+                if self.wakeup.wait(wait):
+                    self.wakeup.clear()
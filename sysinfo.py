@@ -0,0 +1,236 @@
+import os
+import time
+import logging
+import threading
+import subprocess
+from collections import namedtuple
+
+
+SystemProperties = namedtuple("SystemProperties",
+                              ["free_memory", "ram_free", "clock_freq", "cpu_temp", "throttled", "timestamp"])
+
+
+class SystemSampler:
+    """
+    Samples the system properties in-process from sysfs and procfs. Values are cached for a time to live and can be
+    refreshed from a background thread. vcgencmd is only used when the sysfs entries are not available
+    """
+
+    THERMAL_ZONE = "sys/class/thermal/thermal_zone0/temp"
+    CPU_FREQ = "sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq"
+    THROTTLED = "sys/devices/platform/soc/soc:firmware/get_throttled"
+    MEMINFO = "proc/meminfo"
+
+    # Bits of the firmware throttled state
+    THROTTLE_FLAGS = {
+        0: "under-voltage",
+        1: "arm-frequency-capped",
+        2: "throttled",
+        3: "soft-temperature-limit",
+        16: "under-voltage-occurred",
+        17: "arm-frequency-capped-occurred",
+        18: "throttling-occurred",
+        19: "soft-temperature-limit-occurred",
+    }
+
+    def __init__(self, root="/", storage_path="/", ttl=5.0):
+        self.root = root
+        self.storage_path = storage_path
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.cached = None
+        self.throttle_history = 0
+
+        # Background sampling
+        self.sampler_thread = None
+        self.stop_event = threading.Event()
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def read_sysfs(self, relative_path):
+        """
+        Read a value from a file in the sysfs tree
+
+        :param relative_path: Path relative to the root
+        :return: The stripped content, None if not available
+        """
+
+        try:
+            with open(os.path.join(self.root, relative_path), "r") as fh:
+                return fh.read().strip()
+        except OSError:
+            return None
+
+    def vcgencmd(self, *args):
+        """
+        Query the firmware through vcgencmd
+
+        :param args: Arguments to vcgencmd
+        :return: The value after the '=' sign, None if not available
+        """
+
+        try:
+            output = subprocess.run(["vcgencmd", *args], capture_output=True, timeout=2).stdout.decode('utf-8')
+            return output.split('=')[1].strip()
+        except (OSError, IndexError, subprocess.SubprocessError):
+            return None
+
+    def read_temperature(self):
+        """
+        CPU temperature in degree Celsius
+
+        :return: The temperature, NaN if not available
+        """
+
+        value = self.read_sysfs(self.THERMAL_ZONE)
+        if value is not None:
+            return int(value) / 1000
+        value = self.vcgencmd("measure_temp")
+        if value is not None:
+            return float(value.split("'")[0])
+        return float("nan")
+
+    def read_clock_frequency(self):
+        """
+        CPU clock frequency in GHz
+
+        :return: The frequency, NaN if not available
+        """
+
+        value = self.read_sysfs(self.CPU_FREQ)
+        if value is not None:
+            return int(value) / 1e6     # kHz to GHz
+        value = self.vcgencmd("measure_clock", "arm")
+        if value is not None:
+            return int(value) / 1e9
+        return float("nan")
+
+    def read_throttled(self):
+        """
+        Firmware throttled state bit field
+
+        :return: The throttled state, 0 if not available
+        """
+
+        value = self.read_sysfs(self.THROTTLED)
+        if value is None:
+            value = self.vcgencmd("get_throttled")
+        try:
+            return int(value, 16)
+        except (TypeError, ValueError):
+            return 0
+
+    def read_ram_free(self):
+        """
+        Available RAM in GB
+
+        :return: The available RAM, NaN if not available
+        """
+
+        meminfo = self.read_sysfs(self.MEMINFO)
+        if meminfo is not None:
+            for line in meminfo.splitlines():
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024 / 1000      # kB to GB
+        return float("nan")
+
+    def read_free_storage(self):
+        """
+        Free storage in GB
+
+        :return: The free storage
+        """
+
+        st = os.statvfs(self.storage_path)
+        return (st.f_bavail * st.f_frsize) / 1024 / 1024 / 1000  # Convert to GB
+
+    def sample(self):
+        """
+        Read all the system properties and update the cache
+
+        :return: The sampled system properties
+        """
+
+        throttled = self.read_throttled()
+        properties = SystemProperties(free_memory=self.read_free_storage(), ram_free=self.read_ram_free(),
+                                      clock_freq=self.read_clock_frequency(), cpu_temp=self.read_temperature(),
+                                      throttled=throttled, timestamp=time.monotonic())
+
+        # Report newly raised flags
+        new_flags = throttled & ~self.throttle_history
+        if new_flags:
+            self.logger.warning(f"Throttling state changed: {', '.join(self.decode_throttled(new_flags))}")
+        self.throttle_history |= throttled
+
+        with self.lock:
+            self.cached = properties
+        return properties
+
+    def get(self, max_age=None):
+        """
+        Get the system properties, sampling only if the cached values are older than the time to live
+
+        :param max_age: Overrides the time to live
+        :return: The system properties
+        """
+
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            cached = self.cached
+        if cached is None or time.monotonic() - cached.timestamp > max_age:
+            cached = self.sample()
+        return cached
+
+    def decode_throttled(self, throttled=None):
+        """
+        Names of the flags that are set in a throttled state
+
+        :param throttled: The throttled state, defaults to all the flags seen since start
+        :return: A list of flag names
+        """
+
+        throttled = self.throttle_history if throttled is None else throttled
+        return [name for bit, name in self.THROTTLE_FLAGS.items() if throttled & (1 << bit)]
+
+    def start(self, interval=10.0):
+        """
+        Sample in the background at a fixed interval
+
+        :param interval: Time between samples in seconds
+        :return: None
+        """
+
+        if self.sampler_thread is None:
+            self.stop_event.clear()
+            self.sampler_thread = threading.Thread(target=self.run, args=(interval,), name="SystemSampler",
+                                                   daemon=True)
+            self.sampler_thread.start()
+
+    def run(self, interval):
+        """
+        Background sampling loop
+
+        :param interval: Time between samples in seconds
+        :return: None
+        """
+
+        while not self.stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.logger.error(f"Error sampling system properties: {e}")
+            self.stop_event.wait(interval)
+
+    def stop(self):
+        """
+        Stop the background sampling
+
+        :return: None
+        """
+
+        if self.sampler_thread is not None:
+            self.stop_event.set()
+            self.sampler_thread.join()
+            self.sampler_thread = None
@@ -0,0 +1,293 @@
+import json
+import time
+import select
+import socket
+import logging
+import threading
+import collections
+import metrics
+from IMU.pipeline import PipelineStage
+
+
+# Fields of a GPS fix in the shared state of the DAQ
+GPS_FIX_FIELDS = ("time", "lat", "lon", "alt", "speed", "track", "mode")
+
+
+def gps_fix(record):
+    """
+    The fields of a TPV report that are streamed
+
+    :param record: The TPV report
+    :return: A dict
+    """
+
+    return {field: record.get(field) for field in GPS_FIX_FIELDS}
+
+
+class Subscriber:
+    """
+    A listener of the stream, with a bounded queue of messages. When the queue is full the oldest message is dropped,
+    publishing never waits for a listener
+    """
+
+    __slots__ = ("address", "messages", "last_seen", "sent", "dropped", "reported")
+
+    def __init__(self, address, queue_size):
+        self.address = address
+        self.messages = collections.deque(maxlen=queue_size)
+        self.last_seen = time.monotonic()
+        self.sent = 0
+        self.dropped = 0
+        # Drops already counted in the metrics
+        self.reported = 0
+
+    def put(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+        self.messages.append(message)
+
+
+class TelemetryServer(threading.Thread):
+    """
+    Live stream of the decimated IMU samples, the GPS fixes and health metrics over UDP. A listener subscribes by
+    sending "subscribe" to the port and renews the subscription at least every timeout, it then gets one JSON message
+    per datagram. "unsubscribe" ends the stream
+    """
+
+    def __init__(self, port=9106, context=None, registry=metrics.REGISTRY, queue_size=64, subscriber_timeout=30,
+                 max_subscribers=8, interval=0.02, health_interval=1.0):
+        """
+        :param port: UDP port to listen on
+        :param context: Shared state of the DAQ, for the GPS fixes
+        :param registry: Metrics for the health messages
+        :param queue_size: Messages queued per listener
+        :param subscriber_timeout: Seconds after which a silent listener is dropped
+        :param max_subscribers: Most listeners at a time
+        :param interval: Seconds between the sends
+        :param health_interval: Seconds between the health messages
+        """
+
+        threading.Thread.__init__(self, name="Telemetry", daemon=True)
+        self.port = port
+        self.context = context if context is not None else {}
+        self.registry = registry
+        self.queue_size = queue_size
+        self.subscriber_timeout = subscriber_timeout
+        self.max_subscribers = max_subscribers
+        self.interval = interval
+        self.health_interval = health_interval
+
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.sock = None
+        self.cpu_seconds = 0.0
+        self.last_fix = None
+
+        # Logging
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # Metrics
+        self.subscribers_gauge = self.registry.gauge("telemetry_subscribers", "Listeners of the live stream")
+        self.sent_total = self.registry.counter("telemetry_messages_sent_total", "Messages sent to the listeners")
+        self.dropped_total = self.registry.counter("telemetry_messages_dropped_total",
+                                                      "Messages dropped for slow listeners")
+
+    @property
+    def active(self):
+        return bool(self.subscribers)
+
+    def publish(self, kind, payload):
+        """
+        Queue a message for every listener, without blocking. Does nothing without listeners
+
+        :param kind: Type of the message, imu, gps or health
+        :param payload: A JSON serializable dict
+        :return: None
+        """
+
+        if not self.subscribers:
+            return
+        message = json.dumps(dict(payload, type=kind), separators=(",", ":")).encode()
+        with self.lock:
+            for subscriber in self.subscribers.values():
+                subscriber.put(message)
+
+    def handle_request(self):
+        try:
+            data, address = self.sock.recvfrom(64)
+        except OSError:
+            return
+        command = data.strip().lower()
+        with self.lock:
+            if command == b"subscribe":
+                if address in self.subscribers:
+                    self.subscribers[address].last_seen = time.monotonic()
+                elif len(self.subscribers) < self.max_subscribers:
+                    self.subscribers[address] = Subscriber(address, self.queue_size)
+                    self.logger.info(f"Telemetry listener {address[0]}:{address[1]} subscribed")
+            elif command == b"unsubscribe":
+                self.subscribers.pop(address, None)
+            self.subscribers_gauge.set(len(self.subscribers))
+
+    def publish_state(self, now, next_health):
+        """
+        Queue the GPS fix if it changed and the health metrics when they are due
+
+        :param now: Monotonic time
+        :param next_health: Monotonic time of the next health message
+        :return: Monotonic time of the next health message
+        """
+
+        fix = self.context.get("gps_fix")
+        if fix is not None and fix is not self.last_fix:
+            self.last_fix = fix
+            self.publish("gps", fix)
+        if now >= next_health:
+            self.registry.collect()
+            self.publish("health", {
+                "time": time.time(),
+                "imu_samples": self.registry.total("imu_samples_total"),
+                "imu_fifo_overruns": self.registry.total("imu_fifo_overruns_total"),
+                "imu_queue_depth": self.registry.value("imu_queue_depth"),
+                "writer_bytes": self.registry.total("writer_bytes_total"),
+                "gps_fix_mode": self.registry.value("gps_fix_mode"),
+                "gps_satellites": self.registry.value("gps_satellites_used"),
+                "cpu_temperature": self.registry.value("cpu_temperature_celsius"),
+                "cpu_load": self.registry.value("cpu_load"),
+            })
+            next_health = now + self.health_interval
+        return next_health
+
+    def send(self):
+        """
+        Send the queued messages and drop the listeners that went silent
+
+        :return: None
+        """
+
+        now = time.monotonic()
+        sent = dropped = 0
+        with self.lock:
+            for address, subscriber in list(self.subscribers.items()):
+                if now - subscriber.last_seen > self.subscriber_timeout:
+                    del self.subscribers[address]
+                    self.logger.info(f"Telemetry listener {address[0]}:{address[1]} timed out")
+                    continue
+                while subscriber.messages:
+                    try:
+                        self.sock.sendto(subscriber.messages[0], address)
+                    except BlockingIOError:
+                        break
+                    except OSError:
+                        # E.g. the listener is unreachable, the message is dropped
+                        subscriber.dropped += 1
+                    else:
+                        subscriber.sent += 1
+                        sent += 1
+                    subscriber.messages.popleft()
+                dropped += subscriber.dropped - subscriber.reported
+                subscriber.reported = subscriber.dropped
+            self.subscribers_gauge.set(len(self.subscribers))
+        # The counters are only written from this thread
+        if sent:
+            self.sent_total.inc(sent)
+        if dropped:
+            self.dropped_total.inc(dropped)
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("0.0.0.0", self.port))
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        self.logger.info(f"Telemetry on UDP port {self.port}")
+        super().start()
+
+    def run(self):
+        next_health = time.monotonic()
+        while self.running:
+            readable, _, _ = select.select([self.sock], [], [], self.interval)
+            cpu_start = time.thread_time()
+            if readable:
+                self.handle_request()
+            if self.subscribers:
+                next_health = self.publish_state(time.monotonic(), next_health)
+                self.send()
+            self.cpu_seconds += time.thread_time() - cpu_start
+        self.sock.close()
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join()
+
+    def stats(self):
+        """
+        Counters of the listeners
+
+        :return: A dict of the address to the messages sent and dropped
+        """
+
+        with self.lock:
+            return {f"{a[0]}:{a[1]}": {"sent": s.sent, "dropped": s.dropped} for a, s in self.subscribers.items()}
+
+
+class TelemetryStage(PipelineStage):
+    """
+    IMU stage that streams the samples, decimated by block averages to the telemetry rate. It runs in the pipeline
+    thread, so a busy stream never delays the FIFO reads or imu.dat
+    """
+
+    name = "telemetry"
+
+    def __init__(self, odr_hz, prefix="", context=None, rate_hz=50):
+        """
+        :param odr_hz: Output data rate of the samples
+        :param prefix: Prefix of the sensor in the messages
+        :param context: Shared state of the DAQ, with the telemetry server
+        :param rate_hz: Rate of the streamed samples
+        """
+
+        super().__init__(odr_hz, prefix=prefix, context=context)
+        self.block = max(1, round(odr_hz / rate_hz))
+        self.rate_hz = odr_hz / self.block
+        self.sums = [0] * 6
+        self.count = 0
+        self.start_time = None
+
+    def open(self, save_dir):
+        self.start_time = time.time()
+        self.sums = [0] * 6
+        self.count = 0
+
+    def process(self, samples, offset):
+        server = self.context.get("telemetry")
+        if server is None or not server.active:
+            self.count = 0
+            self.sums = [0] * 6
+            return
+
+        rows = []
+        total = len(samples) // 6
+        position = 0
+        scales = (self.GYRO_DPS_PER_LSB,) * 3 + (self.ACCEL_G_PER_LSB,) * 3
+        while position < total:
+            take = min(self.block - self.count, total - position)
+            segment = samples[position * 6:(position + take) * 6]
+            for c in range(6):
+                self.sums[c] += sum(segment[c::6])
+            self.count += take
+            position += take
+            if self.count == self.block:
+                rows.append([round(self.sums[c] / self.block * scales[c], 4) for c in range(6)])
+                self.sums = [0] * 6
+                self.count = 0
+
+        if rows:
+            # Time of the first streamed sample, from the sample offset at the nominal rate
+            first = offset + position - self.count - len(rows) * self.block
+            server.publish("imu", {"sensor": self.prefix.rstrip("_") or "imu", "rate_hz": self.rate_hz,
+                                   "time": self.start_time + first / self.odr_hz,
+                                   "columns": ["gx", "gy", "gz", "ax_g", "ay_g", "az_g"], "samples": rows})
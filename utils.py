@@ -1,16 +1,28 @@
+import os
+import json
 import time
 import queue
+import metrics
 
 
-def file_writer(data_queue, output_file):
+def file_writer(data_queue, output_file, buffer_size=4096, flush="buffered"):
     """
     Write data from a queue to a file.
 
     :param data_queue: The queue handing the data
     :param output_file: Path to the file to append the data from queue
+    :param buffer_size: Bytes to accumulate before a write-back, larger values mean fewer wakeups of the storage
+    :param flush: "buffered" leaves the write-back of the page cache to the kernel, "fsync" syncs every write so that
+        a power cut loses at most one buffer
     :return: None
     """
 
+    # Metrics
+    labels = {"file": os.path.basename(output_file)}
+    bytes_total = metrics.REGISTRY.counter("writer_bytes_total", "Bytes written to the data files", labels)
+    write_seconds = metrics.REGISTRY.histogram("writer_write_seconds", "Duration of a buffered write", labels,
+                                               buckets=(0.0001, 0.001, 0.01, 0.1, 1))
+
     with open(output_file, "ab") as fh:
         buffer = bytearray()
         while True:
@@ -19,9 +31,14 @@ def file_writer(data_queue, output_file):
                 if encoded_data is None:
                     break
                 buffer.extend(encoded_data)
-                if len(buffer) > 4096:  # Write to file when buffer exceeds 4KB
+                if len(buffer) > buffer_size:  # Write to file when buffer exceeds the buffer size
+                    write_start = time.perf_counter()
                     fh.write(buffer)
                     fh.flush()
+                    if flush == "fsync":
+                        os.fsync(fh.fileno())
+                    write_seconds.observe(time.perf_counter() - write_start)
+                    bytes_total.inc(len(buffer))
                     buffer.clear()
             except queue.Empty:
                 continue
@@ -31,3 +48,21 @@ def file_writer(data_queue, output_file):
         if buffer:
             fh.write(buffer)
             fh.flush()
+            bytes_total.inc(len(buffer))
+        if flush == "fsync":
+            os.fsync(fh.fileno())
+
+
+def write_metadata(save_dir, name, metadata):
+    """
+    Write the metadata of a sensor next to its data
+
+    :param save_dir: The trial directory
+    :param name: Name of the sensor, the file is <name>.meta
+    :param metadata: A JSON serializable dict
+    :return: None
+    """
+
+    with open(os.path.join(save_dir, name + ".meta"), "w") as fh:
+        json_string = json.dumps(metadata)
+        fh.write(json_string + "\n")